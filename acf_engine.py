@@ -0,0 +1,155 @@
+# Module for complex autocorrelation (ACF) analysis of Grape IQ data, single Doppler peak algorithm
+# Zero lag and one lag ACF are calculated for every time window at once from a reshaped array,
+# then Doppler shift, frequency spread and S+N level per window, replacing the per-sample Python loop
+# acf_table extends this to lags 0 to max_lag for every center frequency at once, with noise corrected estimators
+
+import numpy as np
+
+def acf_doppler_spread(data,fs,time_window=60,length=None):
+    # data is the complex IQ vector for one frequency, fs the sample rate and time_window the seconds per window
+    # The one lag product for the last sample of a window uses the first sample of the next, so data must hold
+    # length*m_samples+1 samples. length defaults to as many whole windows as data allows
+    # Returns arrays, one value per window, of Doppler (Hz), spread (mHz) and S+N level (dB), unrounded
+    m_samples=int(fs*time_window)
+    if length is None:
+        length=(len(data)-1)//m_samples
+    if len(data) < length*m_samples+1:
+        raise ValueError("Need {!s} samples for {!s} time windows, only {!s} available".format(length*m_samples+1,length,len(data)))
+
+    data=np.asarray(data[0:length*m_samples+1],dtype=np.complex128)   # accumulate the sums in double precision
+    x0=np.reshape(data[0:length*m_samples],(length,m_samples))       # views, one row per time window
+    x1=np.reshape(data[1:length*m_samples+1],(length,m_samples))     # the same, one sample later
+
+    R_T0=np.sum(x0*np.conjugate(x0),axis=1)             # ACF function at zero lag
+    R_Ts=np.sum(x0*np.conjugate(x1),axis=1)             # ACF function at one lag
+
+    tau=1/float(fs)                                     # one lag in seconds, fs from metadata may be long double
+    freq=-(1/(2*np.pi*tau))*np.angle(R_Ts)
+    real=x0.real                                        # with very small freq shifts have to add 'DC' component
+    level=np.std(real,axis=1)+np.average(real,axis=1)   # matches expected from 20*log10(65535) as 16 bit full scale
+    dB_level=20*np.log10(level)
+    spread=(1.414/(2*np.pi*tau))*np.sqrt(np.abs(np.log((R_T0/np.abs(R_Ts)))))*1000    # spread in milliHertz
+    return freq,spread,dB_level
+
+# Multi-lag ACF for every time window and every center frequency in one call, and moment estimators from it.
+# With white noise the noise adds to the zero lag only, so estimators from lags 1 and up are not biased by it
+# and the signal power is found by extrapolating the ACF magnitude back to zero lag:
+#   lag1        Doppler from the lag 1 phase and spread from lags 0 and 1, as acf_doppler_spread, no SNR
+#   pulse_pair  noise corrected pulse pair, Doppler from the lag 1 phase, spread and signal power from lags 1 and 2
+#   multilag    Doppler from the slope of the phase over lags 1 to max_lag, spread and signal power from a fit
+#               of log magnitude against lag squared
+# Spread is the standard deviation in mHz of a Gaussian Doppler spectrum, SNR the signal over noise power in dB
+acf_methods=['lag1','pulse_pair','multilag']
+
+def acf_lags(data,fs,time_window=60,max_lag=2,length=None):
+    # ACF at lags 0 to max_lag of every time window, for every center frequency at once
+    # data is complex IQ, 1-D for one frequency or (samples x frequencies) as read with sub_channel None
+    # Lags for the last samples of a window use the first samples of the next, so data must hold
+    # length*m_samples+max_lag samples. length defaults to as many whole windows as data allows
+    # Returns R (frequencies x length x max_lag+1), R[...,k] the sum of x[n]*conj(x[n+k]) over the window
+    m_samples=int(fs*time_window)
+    data=np.asarray(data)
+    if data.ndim == 1:
+        data=data[:,np.newaxis]
+    if length is None:
+        length=(data.shape[0]-max_lag)//m_samples
+    if data.shape[0] < length*m_samples+max_lag:
+        raise ValueError("Need {!s} samples for {!s} time windows, only {!s} available".format(length*m_samples+max_lag,length,data.shape[0]))
+
+    n_freq=data.shape[1]
+    n=length*m_samples
+    x=np.asarray(data[0:n+max_lag].T,dtype=np.complex128)              # frequencies x samples, double precision sums
+    x0=np.reshape(x[:,0:n],(n_freq,length,m_samples))                  # one row per time window
+    R=np.empty((n_freq,length,max_lag+1),dtype=np.complex128)
+    for k in range(0,max_lag+1):
+        R[:,:,k]=np.sum(x0*np.conjugate(np.reshape(x[:,k:k+n],(n_freq,length,m_samples))),axis=2)
+    return R
+
+def acf_moments(R,fs,method='pulse_pair'):
+    # Doppler (Hz), spread (mHz) and SNR (dB) from R as returned by acf_lags, one value per frequency and window
+    # pulse_pair needs lags to 2, multilag lags to at least 2 and uses all lags given
+    if method not in acf_methods:
+        raise ValueError("method must be one of {!s}, not {!s}".format(acf_methods,method))
+    tau=1/float(fs)                                     # one lag in seconds, fs from metadata may be long double
+    R0=R[...,0].real
+    max_lag=R.shape[-1]-1
+    if method != 'lag1' and max_lag < 2:
+        raise ValueError("{!s} needs ACF lags to at least 2, only {!s} given".format(method,max_lag))
+
+    with np.errstate(divide='ignore',invalid='ignore'):
+        if method == 'lag1':
+            freq=-(1/(2*np.pi*tau))*np.angle(R[...,1])
+            spread=(1.414/(2*np.pi*tau))*np.sqrt(np.abs(np.log(R0/np.abs(R[...,1]))))*1000
+            return freq,spread,np.full(R0.shape,np.nan)
+
+        lags=np.arange(1,max_lag+1)
+        log_mag=np.log(np.abs(R[...,1:]))
+        if method == 'pulse_pair':
+            freq=-(1/(2*np.pi*tau))*np.angle(R[...,1])
+            slope=(log_mag[...,1]-log_mag[...,0])/3                 # log magnitude per lag squared, lags 1 and 2
+            log_signal=log_mag[...,0]-slope
+        else:
+            # Least squares through the origin of the phase unwrapped over lags, and of log magnitude on lag squared
+            phase=np.unwrap(np.angle(R[...,1:]),axis=-1)
+            freq=-(1/(2*np.pi*tau))*np.sum(phase*lags,axis=-1)/np.sum(lags**2)
+            k2=lags**2-np.mean(lags**2)
+            slope=np.sum(log_mag*k2,axis=-1)/np.sum(k2**2)
+            log_signal=np.mean(log_mag,axis=-1)-slope*np.mean(lags**2)
+        spread=np.sqrt(2*np.maximum(-slope,0))/(2*np.pi*tau)*1000   # Gaussian |R(k)| falls as exp(-(2pi sigma k tau)^2/2)
+        signal=np.exp(log_signal)
+        snr=10*np.log10(signal/np.maximum(R0-signal,0))
+    return freq,spread,snr
+
+def acf_table(data,fs,time_window=60,max_lag=4,length=None):
+    # All estimators for every center frequency and time window from one multi-lag ACF, for comparison without
+    # re-reading the data. data and length as acf_lags
+    # Returns a dictionary of (frequencies x length) arrays: level (dB), as acf_doppler_spread, and
+    # doppler_method (Hz), spread_method (mHz) and snr_method (dB) for each method in acf_methods
+    R=acf_lags(data,fs,time_window,max_lag,length)
+    (n_freq,length,n_lags)=R.shape
+    m_samples=int(fs*time_window)
+    data=np.asarray(data)
+    if data.ndim == 1:
+        data=data[:,np.newaxis]
+    real=np.reshape(np.asarray(data[0:length*m_samples].T.real,dtype=np.float64),(n_freq,length,m_samples))
+    table={'level':20*np.log10(np.std(real,axis=2)+np.average(real,axis=2))}
+    for method in acf_methods:
+        (table['doppler_'+method],table['spread_'+method],table['snr_'+method])=acf_moments(R,fs,method)
+    return table
+
+def window_sums(v,starts,m_samples):
+    # Sum of v over m_samples from each of starts, from one cumulative sum so the cost does not grow with overlap
+    # NaN samples (gaps) make the sum of every window holding them NaN, without spreading to later windows
+    bad=np.isnan(v)
+    c=np.concatenate(([0],np.cumsum(np.where(bad,0,v))))
+    n_bad=np.concatenate(([0],np.cumsum(bad)))
+    sums=c[starts+m_samples]-c[starts]
+    return np.where(n_bad[starts+m_samples]-n_bad[starts] > 0,np.nan,sums)
+
+def acf_doppler_spread_sliding(data,fs,time_window=60,hop=1,length=None):
+    # As acf_doppler_spread, but for windows of time_window seconds starting every hop seconds, so they overlap
+    # when hop is less than time_window. The zero lag and one lag ACF sums, and the sums of the real part for the
+    # level, come from cumulative sums of x*conj(x) and x[n]*conj(x[n+1]), so the cost is O(samples) for any
+    # window and hop. data must hold (length-1)*hop_samples+m_samples+1 samples, length defaults to as many
+    # windows as data allows. Returns Doppler (Hz), spread (mHz) and S+N level (dB), one value per window
+    m_samples=int(round(fs*time_window))
+    hop_samples=int(round(fs*hop))
+    if length is None:
+        length=(len(data)-1-m_samples)//hop_samples+1
+    n=(length-1)*hop_samples+m_samples+1
+    if len(data) < n:
+        raise ValueError("Need {!s} samples for {!s} time windows, only {!s} available".format(n,length,len(data)))
+
+    data=np.asarray(data[0:n],dtype=np.complex128)     # accumulate the sums in double precision
+    starts=np.arange(length)*hop_samples
+    R_T0=window_sums((data[0:n-1]*np.conjugate(data[0:n-1])).real,starts,m_samples)   # ACF function at zero lag
+    R_Ts=window_sums(data[0:n-1]*np.conjugate(data[1:n]),starts,m_samples)            # ACF function at one lag
+
+    tau=1/float(fs)                                     # one lag in seconds, fs from metadata may be long double
+    freq=-(1/(2*np.pi*tau))*np.angle(R_Ts)
+    real=data[0:n-1].real                               # level as acf_doppler_spread, std from the mean square
+    mean=window_sums(real,starts,m_samples)/m_samples
+    std=np.sqrt(np.maximum(window_sums(real**2,starts,m_samples)/m_samples-mean**2,0))
+    dB_level=20*np.log10(std+mean)
+    spread=(1.414/(2*np.pi*tau))*np.sqrt(np.abs(np.log((R_T0/np.abs(R_Ts)))))*1000    # spread in milliHertz
+    return freq,spread,dB_level
@@ -0,0 +1,171 @@
+# Module to keep a catalog of the metadata and file coverage of each digital RF channel
+# Reading the metadata takes a DigitalMetadataReader, a DigitalRFReader and several HDF5 reads, repeated by every
+# script at startup. The catalog holds the results as a JSON file per channel so later runs need only a directory
+# scan and a dictionary lookup. It is rebuilt whenever a directory in the channel is newer than the catalog.
+# The catalog also holds the continuous blocks of the channel, an index from UTC time to sample ranges that
+# shows where the gaps are without probing the DRF files.
+#
+# Build or refresh the catalog for a channel with one command line argument, the channel name, run:
+#     python3 channel_catalog.py ch0_G4HZX
+# Files go into ./data/catalog/channel.json
+
+import numpy as np
+import os
+import sys
+import json
+from datetime import datetime, timedelta
+import pytz
+import digital_rf as drf
+import maidenhead as mh
+
+base_directory='./'
+catalog_dir=os.path.join(base_directory,'data','catalog')
+catalog_version=2   # increase when the catalog contents change, so that older catalogs are rebuilt
+
+def channel_mtime(drf_channel_dir):
+    # Latest modification time of the channel directory and its subdirectories, including metadata
+    # Adding, removing or renaming a file changes the mtime of the directory that holds it
+    mtime=os.stat(drf_channel_dir).st_mtime_ns
+    for entry in os.scandir(drf_channel_dir):
+        if entry.is_dir():
+            mtime=max(mtime,entry.stat().st_mtime_ns)
+    return mtime
+
+def read_metadata_field(dmr,fields,start_idx,field):
+    # Value of field at the first metadata sample, or None if the channel does not have it
+    if field not in fields:
+        return None
+    data_dict=dmr.read(start_idx,start_idx+1,field)  # data_dict is an ordered dictionary keyed by sample index
+    for key in data_dict.keys():
+        return data_dict[key]
+
+def file_coverage(drf_channel_dir,fs):
+    # Per-hour coverage of the rf@*.h5 files, list of [subdirectory, number of files, first and last file start sample]
+    # File names are the file start time in unix seconds, e.g. rf@1712534400.000.h5
+    coverage=[]
+    for entry in sorted(os.scandir(drf_channel_dir),key=lambda e: e.name):
+        if not entry.is_dir() or entry.name == 'metadata':
+            continue
+        starts=sorted(int(round(float(f.name[3:-3])*float(fs))) for f in os.scandir(entry.path)
+                      if f.name.startswith('rf@') and f.name.endswith('.h5'))
+        if len(starts) > 0:
+            coverage.append([entry.name,len(starts),starts[0],starts[-1]])
+    return coverage
+
+def build_catalog(data_dir,channel):
+    # Read the metadata of channel from the DRF files into a catalog dictionary
+    drf_channel_dir=os.path.join(data_dir,channel)
+    mtime=channel_mtime(drf_channel_dir)          # before reading, so a file written during the build forces a rebuild
+    dmr=drf.DigitalMetadataReader(os.path.join(drf_channel_dir,'metadata'))
+    do=drf.DigitalRFReader(data_dir)
+
+    s0, s1=do.get_bounds(channel)
+    first_sample, last_sample=dmr.get_bounds()
+    start_idx=int(np.uint64(first_sample))
+    fields=dmr.get_fields()                       # Returns a python list of field names
+
+    theCallsign=read_metadata_field(dmr,fields,start_idx,'callsign')
+    if theCallsign is None:                       # if no callsign e.g. from Grape 1 DRF then extract from channel name
+        theCallsign=channel.partition('_')[2]
+    theCallsign=theCallsign.replace('/','_')      # if there is a / in the callsign it would mess path name, so replace with _
+    freqList=read_metadata_field(dmr,fields,start_idx,'center_frequencies')
+    theLatitude=read_metadata_field(dmr,fields,start_idx,'lat')
+    theLongitude=read_metadata_field(dmr,fields,start_idx,'long')
+    theGridSquare=read_metadata_field(dmr,fields,start_idx,'grid_square')
+    if theGridSquare is None:                     # If there is not, e.g. Grape 1 DRF then calculate from lat lon
+        theGridSquare=mh.to_maiden(theLatitude,theLongitude)
+    theReceiverName=read_metadata_field(dmr,fields,start_idx,'receiver_name')
+    if theReceiverName is None:                   # Use generic if not present
+        theReceiverName='Grape'
+
+    properties=do.get_properties(channel)
+    fs=properties['samples_per_second']
+
+    return {'version':catalog_version,
+            'channel':channel,
+            'drf_dir':os.path.abspath(drf_channel_dir),
+            'drf_mtime':mtime,
+            'callsign':str(theCallsign),
+            'grid_square':str(theGridSquare),
+            'receiver_name':str(theReceiverName),
+            'lat':float(theLatitude),
+            'long':float(theLongitude),
+            'center_frequencies':[float(f) for f in np.atleast_1d(freqList)],
+            'sample_rate_numerator':int(properties['sample_rate_numerator']),
+            'sample_rate_denominator':int(properties['sample_rate_denominator']),
+            's0':int(s0),
+            's1':int(s1),
+            'coverage':file_coverage(drf_channel_dir,fs),
+            'blocks':[[int(sinx),int(nsamps)] for (sinx,nsamps) in do.get_continuous_blocks(s0,s1,channel).items()]}
+
+loaded={}          # catalogs already loaded by this process, by JSON file path
+
+def load_catalog(data_dir,channel,directory=catalog_dir):
+    # Catalog dictionary for channel, from the JSON file if it is up to date, otherwise rebuilt and saved
+    # A catalog loaded before in this process is returned as it is while up to date, so load_metadata.py and the
+    # script calling it read and parse the JSON file once between them
+    fpath=os.path.join(directory,channel+'.json')
+    drf_channel_dir=os.path.join(data_dir,channel)
+    catalog=loaded.get(os.path.abspath(fpath))
+    if catalog is not None and catalog['drf_dir'] == os.path.abspath(drf_channel_dir) and \
+       channel_mtime(drf_channel_dir) <= catalog['drf_mtime']:
+        return catalog
+    if os.path.isfile(fpath):
+        with open(fpath) as fl:
+            catalog=json.load(fl)
+        if catalog.get('version') == catalog_version and catalog['drf_dir'] == os.path.abspath(drf_channel_dir) and \
+           channel_mtime(drf_channel_dir) <= catalog['drf_mtime']:
+            loaded[os.path.abspath(fpath)]=catalog
+            return catalog
+
+    catalog=build_catalog(data_dir,channel)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    with open(fpath+'.tmp','w') as fl:
+        json.dump(catalog,fl,indent=1)
+    os.replace(fpath+'.tmp',fpath)
+    loaded[os.path.abspath(fpath)]=catalog
+    return catalog
+
+def sample_rate(catalog):
+    # Samples per second as np.longdouble, the type digital_rf gives in its properties
+    return np.longdouble(catalog['sample_rate_numerator'])/np.longdouble(catalog['sample_rate_denominator'])
+
+def utc_to_sample(catalog,date,hours=0):
+    # Sample index at hours after 00:00 UTC on date, a YYYY-MM-DD string as given by load_metadata
+    # Independent of where the data starts, so a channel that starts late or has gaps is not shifted in time
+    t=datetime.strptime(date,'%Y-%m-%d').replace(tzinfo=pytz.utc)+timedelta(hours=hours)
+    return int(round(t.timestamp()*float(sample_rate(catalog))))
+
+def block_index(catalog):
+    # Continuous blocks as an (n,2) int64 array of start sample and number of samples, made once per catalog
+    if 'block_index' not in catalog:
+        catalog['block_index']=np.array(catalog['blocks'],dtype=np.int64).reshape(-1,2)
+    return catalog['block_index']
+
+def covered_ranges(catalog,start_sample,vector_length):
+    # List of (start sample, number of samples) for the parts of start_sample..start_sample+vector_length-1 holding data
+    blocks=block_index(catalog)
+    start=int(start_sample)
+    end=start+int(vector_length)
+    i=max(int(np.searchsorted(blocks[:,0],start,side='right'))-1,0)   # last block starting at or before start
+    ranges=[]
+    while i < len(blocks) and blocks[i,0] < end:
+        b0=max(int(blocks[i,0]),start)
+        b1=min(int(blocks[i,0]+blocks[i,1]),end)
+        if b1 > b0:
+            ranges.append((b0,b1-b0))
+        i=i+1
+    return ranges
+
+def is_covered(catalog,start_sample,vector_length):
+    # True if there is data for every sample of start_sample..start_sample+vector_length-1
+    return covered_ranges(catalog,start_sample,vector_length) == [(int(start_sample),int(vector_length))]
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print ("Rerun with channel name as single command line argument")
+        exit()
+    data_dir=os.path.join(base_directory,'data','psws_grapeDRF')
+    catalog=load_catalog(data_dir,sys.argv[1])
+    print("Catalog for ",sys.argv[1]," is ",os.path.join(catalog_dir,sys.argv[1]+'.json'))
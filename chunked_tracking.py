@@ -0,0 +1,166 @@
+# Module to run the CWT peak finding and Doppler tracking of a long span, e.g. a day or a week, in chunks of minutes
+# on a pool of worker processes, as used by grape_fft_CWT_tracking_prophet.py
+# Peaks: every minute's spectrum and CWT peaks are independent of the other minutes, so the span is split into
+# chunks that each read, FFT, find and refine their peaks (see cwt_peaks.py and peak_refine.py) and the results
+# are joined end to end, the same as for the span in one piece.
+# Tracking: each chunk after the first starts overlap minutes early, trains its trackers on the first n_train of
+# those minutes in level order and tracks to the end of the chunk. The fragment's modes are matched to the tracks
+# so far by the number of overlap minutes in which they took the same peak, the same Doppler and level. Prophet
+# predicts from the last n_train minutes only, so once a fragment has taken the same peaks as the tracks so far for
+# n_train minutes its predictions, and so its tracks, are those of the serial run, and it takes over from there.
+# The filters' state depends on every minute so far, so a fragment only converges on the serial run, and where two
+# modes cross closely can take the other branch; they track a week in about a second, so are best run serially.
+# Workers are forked, so scripts need no main guard. Where fork is not available, e.g. Windows, or with one
+# worker, chunks run one after another in this process.
+
+import numpy as np
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from scipy.fft import fft, fftfreq, fftshift
+from scipy.optimize import linear_sum_assignment
+import digital_rf as drf
+
+import drf_reader                 # this is a module in this directory to read IQ data a block at a time
+import spectrogram_engine         # this is a module in this directory for the batched FFT and zoom spectra
+import cwt_peaks                  # this is a module in this directory for the CWT peaks of all minutes at once
+import peak_refine                # this is a module in this directory to refine the CWT peaks of all minutes at once
+import doppler_tracker            # this is a module in this directory to track the Doppler of each mode
+
+def pool_map(function,jobs,workers=1):
+    # [function(job) for job in jobs], on up to workers forked processes where there is more than one job
+    if workers > 1 and len(jobs) > 1 and 'fork' in multiprocessing.get_all_start_methods():
+        with ProcessPoolExecutor(max_workers=min(workers,len(jobs)),mp_context=multiprocessing.get_context('fork')) as pool:
+            return list(pool.map(function,jobs))
+    return [function(job) for job in jobs]
+
+def chunk_bounds(length,chunk):
+    # (start,stop) minutes of each chunk of a span of length minutes, chunk minutes each, the last may be shorter
+    chunk=max(int(chunk),1)
+    return [(start,min(start+chunk,length)) for start in range(0,length,chunk)]
+
+def refine_modes(spectra,top,x,radii):
+    # Refine the n highest peaks of every minute: spectra is (minutes x frequency bins) in dB, top the bin indices
+    # of the peaks of each minute highest first, -1 for none, x the frequency of each bin. Looks radii[k] bins
+    # either side of the kth peak for a true maximum, 0 to keep the CWF peak, then interpolates frequency from the
+    # linear levels either side
+    # Returns (minutes x n) frequencies and levels of the peaks, reordered where refinement changed the order of levels
+    rows=np.arange(len(top))
+    freq=np.full(top.shape,np.nan)
+    level=np.full(top.shape,np.nan)
+    for k in range(0,top.shape[1]):
+        (index,freq[:,k],level[:,k],width)=peak_refine.refine_peaks(spectra,top[:,k],x,rows,local_radius=radii[k],interp_radius=2)
+    order=np.argsort(-level,axis=1,kind='stable')  # CWT output was 1st always higher level, but either side and interp can change so reorder
+    return np.take_along_axis(freq,order,axis=1),np.take_along_axis(level,order,axis=1)
+
+def chunk_peaks(job):
+    # Candidate peaks of the minutes of one chunk, job as built by span_peaks. Returns a dict of arrays as span_peaks
+    (data_dir,channel,catalog,s,start,stop,m_samples,fs,sub_channel,n_modes,zoom,Hann_factor)=job
+    length=stop-start
+    do=drf.DigitalRFReader(data_dir)
+    frames=np.full((length,m_samples),complex(np.nan,np.nan),dtype=np.complex64)   # NaN in gaps
+    read_ok=np.zeros(length,dtype=bool)
+    for (j,data) in drf_reader.read_windows(do,channel,s+start*m_samples,length,m_samples,sub_channel,catalog=catalog):
+        frames[j]=data
+        read_ok[j]=True
+    x=fftshift(fftfreq(m_samples,1/fs))           # fs as in the metadata, a long double, x is too
+    spectra=fftshift(fft(frames,axis=1,norm="forward")*Hann_factor,axes=1)   # fftshift moves 0 Hz to centre
+    spectra=20*np.log10(np.abs(spectra))                                     # convert to dB
+
+    # CWT peaks as scipy find_peaks_cwt, 2,4 is empirical selection for one-hop widths, 1,4 the narrower setting
+    # The n_modes highest peaks of each minute for both settings, -1 if a minute has fewer
+    rows=np.arange(length)
+    (minute,index,level,width)=cwt_peaks.find_peaks_batch(spectra,np.arange(2,4))
+    top_wide=peak_refine.strongest_peaks(minute,index,level,length,n_modes)
+    (minute,index,level,width)=cwt_peaks.find_peaks_batch(spectra,np.arange(1,4))
+    top_narrow=peak_refine.strongest_peaks(minute,index,level,length,n_modes)
+
+    found=top_wide >= 0
+    peaks={'read_ok':read_ok,
+           'freq_max':np.where(found,x[np.maximum(top_wide,0)],np.nan),
+           'level_max':np.where(found,spectra[rows[:,np.newaxis],np.maximum(top_wide,0)],np.nan)}
+    # Only with the wider CWF setting of (2,4) we look either side of peak for a true maximum level, one bin for
+    # the 1st peak and two for the others. with (1,4) risk of latching on to other peak
+    (peaks['freq_wide'],peaks['level_wide'])=refine_modes(spectra,top_wide,x,[1]+[2]*(n_modes-1))
+    (peaks['freq_narrow'],peaks['level_narrow'])=refine_modes(spectra,top_narrow,x,[0]*n_modes)
+    if zoom:
+        for name in ['wide','narrow']:
+            peaks['zoom_'+name]=np.stack([spectrogram_engine.zoom_peak_frequency(frames,float(fs),peaks['freq_'+name][:,k])
+                                          for k in range(0,n_modes)],axis=1)
+    return peaks
+
+def span_peaks(data_dir,channel,catalog,s,length,m_samples,fs,sub_channel,n_modes,zoom=False,Hann_factor=1.63,chunk=None,workers=1):
+    # Candidate peaks of every minute of length minutes from sample s, the whole span as one chunk unless chunk
+    # minutes are given. Returns a dict of arrays, one row per minute: read_ok, False in a gap, freq_max and
+    # level_max the (2,4) CWF peaks as found, freq_wide and level_wide the refined (2,4) peaks, freq_narrow and
+    # level_narrow the (1,4) peaks, and with zoom, zoom_wide and zoom_narrow the chirp-z refined Doppler of both
+    jobs=[(data_dir,channel,catalog,s,start,stop,m_samples,fs,sub_channel,n_modes,zoom,Hann_factor)
+          for (start,stop) in chunk_bounds(length,length if chunk is None else chunk)]
+    parts=pool_map(chunk_peaks,jobs,workers)
+    return {key:np.concatenate([part[key] for part in parts]) for key in parts[0]}
+
+def track_chunk(job):
+    # doppler_tracker.track_modes of one chunk, job as built by track_chunks
+    (time,freqs,levels,n_modes,backend,assignment,n_train,settings)=job
+    return doppler_tracker.track_modes(time,freqs,levels,n_modes,backend,assignment,n_train,**settings)
+
+def match_modes(freq,level,freq_new,level_new):
+    # Column of (minutes x modes) freq_new and level_new matching each mode of freq and level, most minutes with
+    # the same peak, the same Doppler and level, then least mean Doppler difference
+    same=np.sum((freq[:,:,np.newaxis] == freq_new[:,np.newaxis,:]) & (level[:,:,np.newaxis] == level_new[:,np.newaxis,:]),axis=0)
+    difference=np.abs(freq[:,:,np.newaxis]-freq_new[:,np.newaxis,:])
+    count=np.sum(np.isfinite(difference),axis=0)
+    with np.errstate(invalid='ignore'):
+        difference=np.where(count > 0,np.nansum(difference,axis=0)/count,np.inf)
+    cost=-same+np.arctan(difference)/np.pi         # a difference never outweighs one minute of the same peak
+    return linear_sum_assignment(cost)[1]
+
+def same_peaks(freq,level,freq_new,level_new):
+    # True for each minute where every mode has the same Doppler and level in both, or no peak in both
+    same=lambda a,b:(a == b) | (np.isnan(a) & np.isnan(b))
+    return np.all(same(freq,freq_new) & same(level,level_new),axis=1)
+
+def track_chunks(time,freqs,levels,n_modes=2,backend='alpha_beta',assignment='hungarian',n_train=10,chunk=360,overlap=60,
+                 workers=1,**settings):
+    # As doppler_tracker.track_modes, returning the same arrays, but tracking chunks of chunk minutes, each after
+    # the first starting overlap minutes early, on up to workers processes and stitching the fragments together
+    # The overlap holds a fragment's n_train training minutes, then with a tracker of finite memory the memory
+    # minutes of the same peaks as the tracks so far that it needs before it can take over as the serial run would
+    memory=doppler_tracker.make_tracker(backend,n_train=n_train,**settings).memory
+    needed=n_train+(1 if memory is None else memory)
+    if overlap < needed:
+        raise ValueError("overlap must be at least {!s} minutes, n_train and {!s} more, not {!s}".format(needed,needed-n_train,overlap))
+    freqs=np.asarray(freqs,dtype=np.float64)
+    levels=np.asarray(levels,dtype=np.float64)
+    bounds=chunk_bounds(len(freqs),chunk)
+    first=[max(start-overlap,0) for (start,stop) in bounds]
+    jobs=[(time[r0:stop],freqs[r0:stop],levels[r0:stop],n_modes,backend,assignment,n_train,settings)
+          for (r0,(start,stop)) in zip(first,bounds)]
+    fragments=pool_map(track_chunk,jobs,workers)
+
+    # Stitch on each fragment, its modes in the order of the tracks so far as matched over the last n_train minutes
+    # of the overlap, by when it has settled. With a tracker of finite memory the fragment takes over after memory
+    # minutes of the same peaks as the tracks so far, from when its predictions are those of the serial run, so
+    # the overlap should be a few times n_train. Otherwise, or failing that, it takes over at its chunk start
+    freqs=np.hstack((freqs,np.full((len(freqs),max(n_modes-freqs.shape[1],0)),np.nan)))
+    levels=np.hstack((levels,np.full((len(levels),max(n_modes-levels.shape[1],0)),np.nan)))
+    tracks=[np.concatenate((track,np.full((len(freqs)-len(track),)+track.shape[1:],np.nan if track.ndim == 2 else False)))
+            for track in fragments[0]]
+    (freq,level,swapped)=(tracks[0],tracks[1],tracks[5])
+    for (r0,(start,stop),fragment) in list(zip(first,bounds,fragments))[1:]:
+        last=max(r0+n_train,start-n_train)
+        order=match_modes(freq[last:start],level[last:start],fragment[0][last-r0:start-r0],fragment[1][last-r0:start-r0])
+        fragment=[array[:,order] for array in fragment[0:5]]
+        switch=start
+        if memory is not None:
+            agree=np.concatenate(([0],np.cumsum(same_peaks(freq[r0:start],level[r0:start],fragment[0][0:start-r0],fragment[1][0:start-r0]))))
+            runs=np.nonzero(agree[memory:]-agree[:-memory] == memory)[0]+memory   # rows after memory agreeing minutes
+            runs=runs[runs >= n_train]
+            if len(runs) > 0:
+                switch=r0+runs[0]
+            else:
+                print ("Chunk from minute {!s} never took the same peaks as the tracks so far for {!s} minutes of its overlap,"
+                       " so its tracks may differ from a single run, a longer overlap may help".format(start,memory))
+        for (track,array) in zip(tracks[0:5],fragment):
+            track[switch:stop]=array[switch-r0:]
+        swapped[switch:stop]=doppler_tracker.level_order_swapped(freq[switch:stop],level[switch:stop],freqs[switch:stop],levels[switch:stop])
+    return tuple(tracks)
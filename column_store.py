@@ -0,0 +1,163 @@
+# Module to build and read a column store of Grape IQ data, an optional faster alternative to the DRF files
+# Each channel is de-interleaved into flat complex64 .npy files, one per center frequency per day, that are
+# opened with np.memmap. Repeat analyses of the same station and day then read straight from the page cache
+# with no HDF5 decode. The readers in drf_reader.py use the store when it covers the requested samples and is
+# newer than the DRF files, otherwise they read the DRF files as before.
+#
+# Build the store for a channel with one command line argument, the channel name, run:
+#     python3 column_store.py ch0_G4HZX
+# Files go into ./data/column_store/channel/YYYY-MM-DD with an index.json describing the day
+
+import numpy as np
+import os
+import sys
+import json
+import shutil
+from datetime import datetime, timedelta
+import pytz
+import digital_rf as drf
+
+import load_metadata              # this is a module in this directory to read digital RF metadata
+
+base_directory='./'
+store_dir=os.path.join(base_directory,'data','column_store')
+
+def day_start_sample(day,fs):
+    # Sample index of 00:00 UTC on day, a date
+    t=datetime(day.year,day.month,day.day,tzinfo=pytz.utc)
+    return int(round(t.timestamp()*float(fs)))
+
+def drf_day_mtime(drf_channel_dir,day):
+    # Latest modification time of the DRF subdirectories and files holding data for day
+    # DRF subdirectories are named by their start time, e.g. 2024-04-08T05-00-00
+    mtime=0
+    day_str=day.strftime('%Y-%m-%d')
+    for entry in os.scandir(drf_channel_dir):
+        if entry.is_dir() and entry.name.startswith(day_str):
+            mtime=max(mtime,entry.stat().st_mtime_ns)
+            for sub_entry in os.scandir(entry.path):
+                mtime=max(mtime,sub_entry.stat().st_mtime_ns)
+    return mtime
+
+def build_day(do,data_dir,channel,day,freqList,fs,directory=store_dir,block_samples=36000):
+    # Build the store for one day of channel, reading the DRF data block_samples at a time (default one hour)
+    # so that memory use stays bounded. Written to a temporary directory that then replaces any earlier build
+    n_freq=len(freqList)
+    s_day=day_start_sample(day,fs)
+    n_day=int(round(86400*float(fs)))
+    blks=do.get_continuous_blocks(s_day,s_day+n_day-1,channel)
+
+    out_dir=os.path.join(directory,channel,day.strftime('%Y-%m-%d'))
+    tmp_dir=out_dir+'.tmp'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    columns=[]
+    for i in range(0,n_freq):
+        fpath=os.path.join(tmp_dir,'f{!s}.npy'.format(i))
+        columns.append(np.lib.format.open_memmap(fpath,mode='w+',dtype=np.complex64,shape=(n_day,)))
+
+    for (sinx,nsamps) in blks.items():
+        for k in range(0,nsamps,block_samples):
+            n=min(block_samples,nsamps-k)
+            data=do.read_vector(sinx+k,n,channel)
+            if data.ndim == 1:                          # single channel Grape so 1 dimensional data array
+                data=data[:,np.newaxis]
+            i0=sinx+k-s_day
+            for i in range(0,n_freq):
+                columns[i][i0:i0+n]=data[:,i]
+    for column in columns:
+        column.flush()
+    del columns
+
+    index={'channel':channel,
+           'date':day.strftime('%Y-%m-%d'),
+           'fs':float(fs),
+           'start_sample':s_day,
+           'n_samples':n_day,
+           'center_frequencies':[float(f) for f in freqList],
+           'blocks':[[int(sinx),int(nsamps)] for (sinx,nsamps) in blks.items()],
+           'drf_dir':os.path.abspath(os.path.join(data_dir,channel)),
+           'drf_mtime':drf_day_mtime(os.path.join(data_dir,channel),day)}
+    with open(os.path.join(tmp_dir,'index.json'),'w') as fl:
+        json.dump(index,fl,indent=1)
+
+    if os.path.exists(out_dir):
+        shutil.rmtree(out_dir)
+    os.rename(tmp_dir,out_dir)
+    print("Column store for ",channel," ",index['date']," written to ",out_dir)
+
+def build_store(data_dir,channel,directory=store_dir):
+    # Build the store for every day of data in channel
+    (date,freqList,s1,s0,fs,theCallsign,grid,lat,lon) = load_metadata.load_grape_drf_metadata(data_dir,channel)
+    do=drf.DigitalRFReader(data_dir)
+    day=datetime.fromtimestamp(s0/float(fs),pytz.utc).date()
+    last_day=datetime.fromtimestamp(s1/float(fs),pytz.utc).date()
+    while day <= last_day:
+        build_day(do,data_dir,channel,day,freqList,fs,directory)
+        day=day+timedelta(days=1)
+
+_store_cache={}     # index of each valid store day of a channel, as found by this process
+
+def store_days(channel,directory=store_dir):
+    # List of the index of each store day of channel that is newer than its DRF data, looked up once per process
+    key=(directory,channel)
+    if key not in _store_cache:
+        days=[]
+        channel_dir=os.path.join(directory,channel)
+        if os.path.isdir(channel_dir):
+            for day_name in sorted(os.listdir(channel_dir)):
+                fpath=os.path.join(channel_dir,day_name,'index.json')
+                if day_name.endswith('.tmp') or not os.path.isfile(fpath):
+                    continue
+                with open(fpath) as fl:
+                    index=json.load(fl)
+                day=datetime.strptime(index['date'],'%Y-%m-%d').date()
+                if not os.path.isdir(index['drf_dir']) or drf_day_mtime(index['drf_dir'],day) > index['drf_mtime']:
+                    print("Column store for ",channel," ",index['date']," is out of date, using DRF data")
+                    continue
+                index['path']=os.path.join(channel_dir,day_name)
+                days.append(index)
+        _store_cache[key]=days
+    return _store_cache[key]
+
+def read_vector(channel,start_sample,vector_length,sub_channel=None,directory=store_dir):
+    # Read vector_length samples of one frequency from the store, as DigitalRFReader.read_vector with an
+    # integer sub_channel (or None for single channel Grape). Returns a read-only memmap view where possible.
+    # Returns None if the store does not hold every requested sample, so the caller can use the DRF files.
+    days=store_days(channel,directory)
+    if len(days) == 0:
+        return None
+    parts=[]
+    s=int(start_sample)
+    end=s+int(vector_length)
+    while s < end:
+        index=None
+        for day_index in days:
+            if day_index['start_sample'] <= s < day_index['start_sample']+day_index['n_samples']:
+                index=day_index
+                break
+        if index is None:
+            return None
+        if sub_channel is None:
+            if len(index['center_frequencies']) > 1:
+                return None                             # all frequencies wanted, leave that to the DRF reader
+            sub_channel=0
+        n=min(end,index['start_sample']+index['n_samples'])-s
+        if not any(b0 <= s and s+n <= b0+nb for (b0,nb) in index['blocks']):
+            return None                                 # gap in the data within this request
+        column=np.load(os.path.join(index['path'],'f{!s}.npy'.format(sub_channel)),mmap_mode='r')
+        i0=s-index['start_sample']
+        parts.append(column[i0:i0+n])
+        s=s+n
+    if len(parts) == 1:
+        return parts[0]
+    return np.concatenate(parts)
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print ("Rerun with channel name as single command line argument")
+        exit()
+    data_dir=os.path.join(base_directory,'data','psws_grapeDRF')
+    build_store(data_dir,sys.argv[1])
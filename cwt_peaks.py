@@ -0,0 +1,140 @@
+# Module to find spectral peaks by continuous wavelet transform (CWT) for every minute of a spectrogram at once
+# scipy.signal.find_peaks_cwt works on one spectrum per call, building the Ricker wavelet bank, the CWT and the
+# ridge lines from scratch each time. Here each Ricker wavelet is convolved along the frequency axis of the whole
+# (minutes x frequency bins) dB matrix in one call, and the ridge lines of all minutes and bins are followed
+# together, one wavelet width at a time, with array operations.
+# Ridge lines link relative maxima across widths that are within max_distances, default widths/4, as in
+# find_peaks_cwt. For the narrow banks of the CWT scripts, e.g. widths 1 to 3, this is under one bin, so a ridge
+# line stays in its frequency bin and linking is a per bin state update. Wider banks fall back to find_peaks_cwt
+# minute by minute. With the find_peaks_cwt defaults the peaks are those of find_peaks_cwt for each minute.
+
+import numpy as np
+from scipy import signal
+
+def ricker(points,a):
+    # Ricker (Mexican hat) wavelet of points samples and width a, as used by scipy.signal.find_peaks_cwt
+    A=2/(np.sqrt(3*a)*(np.pi**0.25))
+    wsq=a**2
+    vec=np.arange(0,points)-(points-1.0)/2
+    xsq=vec**2
+    return A*(1-xsq/wsq)*np.exp(-xsq/(2*wsq))
+
+def cwt_matrix(levels,widths):
+    # Ricker CWT along each row of levels, (minutes x frequency bins), for each of widths
+    # Returns (widths x minutes x frequency bins), rows with NaN, e.g. minutes in a data gap, stay NaN
+    levels=np.atleast_2d(np.asarray(levels,dtype=np.float64))
+    n_bins=levels.shape[1]
+    cwt=np.empty((len(widths),)+levels.shape)
+    for (k,width) in enumerate(widths):
+        kernel=ricker(min(10*width,n_bins),width)[::-1]
+        cwt[k]=signal.convolve(levels,kernel[np.newaxis,:],mode='same',method='direct')
+    return cwt
+
+def noise_floor(row_one,window_size,noise_perc=10,block_rows=60):
+    # noise_perc percentile of row_one, (minutes x frequency bins), over window_size bins about each bin, windows
+    # truncated at the ends, as the noise in the SNR test of find_peaks_cwt (scipy.stats.scoreatpercentile)
+    # Sorted windows of block_rows minutes at a time bound the memory for long spans
+    (n_rows,n_bins)=row_one.shape
+    (hf_window,odd)=divmod(window_size,2)
+    noise=np.empty(row_one.shape)
+
+    def percentile(sorted_windows):
+        idx=noise_perc/100.*(sorted_windows.shape[-1]-1)
+        i=int(idx)
+        if i == idx:
+            return sorted_windows[...,i]
+        (w0,w1)=(i+1-idx,idx-i)
+        return (sorted_windows[...,i]*w0+sorted_windows[...,i+1]*w1)/(w0+w1)
+
+    # bins whose window is whole, from a strided view of the windows
+    first=hf_window                                 # window of bin ind starts at ind-hf_window
+    last=n_bins-hf_window-odd                       # and ends at ind+hf_window+odd
+    if last >= first:
+        for r in range(0,n_rows,block_rows):
+            windows=np.lib.stride_tricks.sliding_window_view(row_one[r:r+block_rows],window_size,axis=1)
+            noise[r:r+block_rows,first:last+1]=percentile(np.sort(windows,axis=-1))
+    # truncated windows at each end of the spectrum
+    for ind in list(range(0,min(first,n_bins)))+list(range(max(last+1,first),n_bins)):
+        window_start=max(ind-hf_window,0)
+        window_end=min(ind+hf_window+odd,n_bins)
+        noise[:,ind]=percentile(np.sort(row_one[:,window_start:window_end],axis=1))
+    return noise
+
+def find_peaks_batch(levels,widths,max_distances=None,gap_thresh=None,min_length=None,min_snr=1,noise_perc=10,window_size=None):
+    # find_peaks_cwt for every row of levels, (minutes x frequency bins) in dB, in one batch. Arguments as
+    # scipy.signal.find_peaks_cwt
+    # Returns flat arrays, one element per peak, sorted by minute then bin: minute, bin index, level (dB) at the
+    # bin and width, the wavelet width at which the CWT of the ridge line is largest, a scale of the peak in bins
+    # Use peak_lists to split them into the peak indices of each minute
+    levels=np.atleast_2d(np.asarray(levels,dtype=np.float64))
+    widths=np.atleast_1d(np.asarray(widths))
+    (n_rows,n_bins)=levels.shape
+    if gap_thresh is None:
+        gap_thresh=np.ceil(widths[0])
+    if max_distances is None:
+        max_distances=widths/4.0
+    if min_length is None:
+        min_length=np.ceil(len(widths)/4)
+    if window_size is None:
+        window_size=np.ceil(n_bins/20)
+    window_size=int(window_size)
+
+    cwt=cwt_matrix(levels,widths)
+    if np.any(np.asarray(max_distances)[0:len(widths)] >= 1):
+        # ridge lines may move between bins, so use scipy for each minute, widths from the CWT at the peaks
+        peaks=[signal.find_peaks_cwt(levels[j],widths,max_distances=max_distances,gap_thresh=gap_thresh,
+                                     min_length=min_length,min_snr=min_snr,noise_perc=noise_perc,window_size=window_size)
+               if np.all(np.isfinite(levels[j])) else np.array([],dtype=int) for j in range(0,n_rows)]
+        minute=np.repeat(np.arange(n_rows),[len(p) for p in peaks])
+        index=np.concatenate(peaks+[np.array([],dtype=int)]).astype(int)
+        width=widths[np.argmax(cwt[:,minute,index],axis=0)] if len(index) > 0 else widths[0:0]
+        return minute,index,levels[minute,index],width
+
+    # relative maxima along frequency of each width, the end bins are never maxima
+    maxima=np.zeros(cwt.shape,dtype=bool)
+    maxima[:,:,1:-1]=(cwt[:,:,1:-1] > cwt[:,:,0:-2]) & (cwt[:,:,1:-1] > cwt[:,:,2:])
+
+    # Follow the ridge lines from the widest wavelet down, one active line at most per minute and bin
+    active=np.zeros((n_rows,n_bins),dtype=bool)
+    gap=np.zeros((n_rows,n_bins),dtype=int)        # widths since the line last had a maximum
+    line_length=np.zeros((n_rows,n_bins),dtype=int)
+    low_row=np.zeros((n_rows,n_bins),dtype=int)    # narrowest width of the line so far
+    best_row=np.zeros((n_rows,n_bins),dtype=int)   # width of the largest CWT of the line so far
+    lines=[]                                        # finished lines as (minute, bin, length, low_row, best_row)
+
+    def finish(done):
+        (rows,cols)=np.nonzero(done)
+        lines.append((rows,cols,line_length[rows,cols],low_row[rows,cols],best_row[rows,cols]))
+
+    for row in range(len(widths)-1,-1,-1):
+        gap[active]+=1
+        extend=maxima[row] & active
+        start=maxima[row] & ~active
+        larger=extend & (cwt[row] > cwt[best_row,np.arange(n_rows)[:,np.newaxis],np.arange(n_bins)])
+        best_row[larger]=row
+        line_length[extend]+=1
+        line_length[start]=1
+        best_row[start]=row
+        low_row[maxima[row]]=row
+        gap[maxima[row]]=0
+        active|=start
+        done=active & (gap > gap_thresh)
+        finish(done)
+        active&=~done
+    finish(active)
+
+    (minute,index,length,low,best)=(np.concatenate(a) for a in zip(*lines))
+
+    # keep lines long enough and whose CWT at the narrowest width stands above the local noise floor
+    noise=noise_floor(cwt[0],window_size,noise_perc)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        snr=np.abs(cwt[low,minute,index]/noise[minute,index])
+    keep=(length >= min_length) & ~(snr < min_snr)  # NaN SNR is kept, as find_peaks_cwt
+    (minute,index,best)=(minute[keep],index[keep],best[keep])
+    order=np.lexsort((index,minute))
+    (minute,index,best)=(minute[order],index[order],best[order])
+    return minute,index,levels[minute,index],widths[best]
+
+def peak_lists(minute,values,n_rows):
+    # Split values of the peaks returned by find_peaks_batch into a list of one array per minute
+    return np.split(values,np.searchsorted(minute,np.arange(1,n_rows)))
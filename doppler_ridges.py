@@ -0,0 +1,132 @@
+# Module to extract the K best Doppler ridges, continuous traces of high level, through a spectrogram by dynamic
+# programming (Viterbi), rather than by the minute by minute peak assignment of grape_fft_CWT_tracking_prophet.py
+# A ridge takes one frequency bin each minute. Its score is the sum of its levels (dB) less penalty times the square
+# of each step in bins from one minute to the next, steps of at most max_step bins. The best ridge comes from one
+# forward pass over the minutes, each a maximum over the 2*max_step+1 steps into every bin at once, so the cost is
+# O(minutes x bins x steps), then a backtrack. The next best is found with guard bins either side of the ridges so
+# far removed, as the NumFrequencyBins of MATLAB's tfridge, and so on for K ridges. Ridges are in score order, so
+# where two traces cross a ridge may keep to the stronger, as a track would, rather than cross with its trace.
+# Minutes in a gap (all NaN) add no level, and ridges run through them at up to max_step bins a minute.
+# read_synthspec and compare_synthspec set the ridges against the modes of synthspec.py's *_synthspec.csv output.
+
+import numpy as np
+import csv
+from datetime import datetime
+from scipy.optimize import linear_sum_assignment
+
+import peak_refine                # this is a module in this directory to refine spectral peaks
+
+def best_ridge(levels,max_step=6,penalty=0.1,allowed=None):
+    # Bin of the best ridge in each minute of levels, (minutes x bins) in dB, NaN rows for gaps, only through bins
+    # where allowed, a (minutes x bins) boolean array, is True. Returns the bin of each minute and the ridge's score
+    levels=np.asarray(levels,dtype=np.float64)
+    (n_rows,n_bins)=levels.shape
+    gap=np.all(np.isnan(levels),axis=1)
+    score=np.where(np.isnan(levels),-np.inf,levels)
+    score[gap]=0.0
+    if allowed is not None:
+        score=np.where(allowed,score,-np.inf)
+    steps=np.arange(max_step,-max_step-1,-1)       # step into bin f from bin f-step, the window order below
+    step_cost=penalty*steps**2
+    back=np.zeros((n_rows,n_bins),dtype=np.int16)  # step taken into each bin of each minute on its best path
+    total=score[0].copy()
+    padded=np.full(n_bins+2*max_step,-np.inf)
+    for j in range(1,n_rows):
+        padded[max_step:max_step+n_bins]=total
+        moves=np.lib.stride_tricks.sliding_window_view(padded,2*max_step+1)-step_cost   # (bins x steps)
+        best=np.argmax(moves,axis=1)
+        total=moves[np.arange(n_bins),best]+score[j]
+        back[j]=steps[best]
+    index=np.empty(n_rows,dtype=int)
+    index[-1]=np.argmax(total)
+    for j in range(n_rows-1,0,-1):
+        index[j-1]=index[j]-back[j,index[j]]
+    return index,total[index[-1]]
+
+def extract_ridges(levels,n_ridges=2,max_step=6,penalty=0.1,guard=3,allowed=None):
+    # Bins of the n_ridges best ridges through levels, (minutes x bins) in dB, each found with guard bins either
+    # side of the ones before removed. Returns (minutes x n_ridges) bins, best ridge first, and the score of each
+    levels=np.asarray(levels,dtype=np.float64)
+    (n_rows,n_bins)=levels.shape
+    allowed=np.ones(levels.shape,dtype=bool) if allowed is None else np.array(allowed,dtype=bool)
+    index=np.full((n_rows,n_ridges),-1)
+    scores=np.full(n_ridges,-np.inf)
+    rows=np.arange(n_rows)
+    for k in range(0,n_ridges):
+        if not np.all(np.any(allowed,axis=1)):     # no bins left in some minute for another ridge
+            break
+        (index[:,k],scores[k])=best_ridge(levels,max_step,penalty,allowed)
+        for offset in range(-guard,guard+1):
+            allowed[rows,np.clip(index[:,k]+offset,0,n_bins-1)]=False
+    return index,scores
+
+def ridge_series(levels,index,x,min_snr=6):
+    # Doppler (Hz) and level (dB) of each ridge, index as from extract_ridges, x the frequency of each bin. The
+    # Doppler is interpolated from the linear levels two bins either side, see peak_refine.py. NaN in gaps, and
+    # where the level is less than min_snr dB above the median level of the minute, the ridge crossing the noise
+    levels=np.asarray(levels,dtype=np.float64)
+    rows=np.arange(levels.shape[0])[:,np.newaxis]
+    gap=np.all(np.isnan(levels),axis=1)
+    noise=np.full(levels.shape[0],np.nan)
+    noise[~gap]=np.nanmedian(levels[~gap],axis=1)
+    index=np.where(gap[:,np.newaxis],-1,index)
+    freq=peak_refine.interpolate_frequency(levels,index,x,rows,radius=2)
+    level=np.where(index >= 0,levels[rows,np.maximum(index,0)],np.nan)
+    weak=~(level >= noise[:,np.newaxis]+min_snr)
+    return np.where(weak,np.nan,freq),np.where(weak,np.nan,level)
+
+def read_synthspec(fpath,date):
+    # Synthetic Doppler of each propagation mode from a *_synthspec.csv file of synthspec.py, times as hours from
+    # 00:00 UTC on date, a YYYY-MM-DD string. Returns a dictionary of mode, e.g. 1F, to (hours, Doppler, color)
+    day=datetime.strptime(date,'%Y-%m-%d')
+    modes={}
+    with open(fpath) as csv_file:
+        reader=csv.reader(csv_file)
+        header=next(reader)                        # one quoted field of all the labels
+        for row in reader:
+            try:
+                hour=(datetime.strptime(row[0],'%Y-%m-%d %H:%M:%S')-day).total_seconds()/3600
+                doppler=float(row[12])
+            except (ValueError,IndexError):
+                continue
+            modes.setdefault(row[2],([],[],row[3]))
+            modes[row[2]][0].append(hour)
+            modes[row[2]][1].append(doppler)
+    result={}
+    for mode in modes:
+        (hours,doppler,color)=modes[mode]
+        order=np.argsort(hours)
+        result[mode]=(np.asarray(hours)[order],np.asarray(doppler)[order],color)
+    return result
+
+def synth_at(time,hours,doppler,max_gap=10):
+    # Synthetic Doppler of one mode interpolated to time, in hours, NaN further than max_gap minutes from its samples
+    time=np.asarray(time,dtype=np.float64)
+    if len(hours) == 0:
+        return np.full(len(time),np.nan)
+    at=np.interp(time,hours,doppler)
+    after=np.clip(np.searchsorted(hours,time),0,len(hours)-1)
+    before=np.clip(after-1,0,len(hours)-1)
+    distance=np.minimum(np.abs(hours[after]-time),np.abs(hours[before]-time))*60
+    return np.where((distance <= max_gap) & (time >= hours[0]) & (time <= hours[-1]),at,np.nan)
+
+def compare_synthspec(time,freq,synth,max_gap=10):
+    # Match each ridge, freq as (minutes x ridges) at time in hours, to the synthetic mode it is closest to, as
+    # read_synthspec, least total rms Doppler difference over the minutes both have
+    # Returns a list per ridge of (mode, rms difference in Hz, minutes compared), (None, NaN, 0) if unmatched
+    names=list(synth)
+    rms=np.full((freq.shape[1],len(names)),np.inf)
+    count=np.zeros((freq.shape[1],len(names)),dtype=int)
+    for (m,name) in enumerate(names):
+        expected=synth_at(time,synth[name][0],synth[name][1],max_gap)
+        difference=freq-expected[:,np.newaxis]
+        count[:,m]=np.sum(np.isfinite(difference),axis=0)
+        with np.errstate(invalid='ignore',divide='ignore'):
+            rms[:,m]=np.where(count[:,m] > 0,np.sqrt(np.nansum(difference**2,axis=0)/count[:,m]),np.inf)
+    result=[(None,np.nan,0)]*freq.shape[1]
+    if len(names) > 0:
+        (ridges,cols)=linear_sum_assignment(np.where(np.isfinite(rms),rms,1e6))
+        for (k,m) in zip(ridges,cols):
+            if np.isfinite(rms[k,m]):
+                result[k]=(names[m],rms[k,m],count[k,m])
+    return result
@@ -0,0 +1,243 @@
+# Module to track the Doppler of N propagation modes through the minutes of a spectrogram, a minute at a time
+# Each minute the tracker of each mode predicts its Doppler, the peaks of that minute (see cwt_peaks.py and
+# peak_refine.py) are assigned to the modes by least total squared Doppler difference from the predictions, and each
+# tracker is updated with its peak. The trackers share one interface, predict and update, so backends plug in:
+#   alpha_beta  alpha-beta filter of Doppler and Doppler rate, the default
+#   kalman      Kalman filter with a constant Doppler rate model, prediction bounds from its variance
+#   prophet     Facebook Prophet fitted to the last n_train minutes at every step, as the original tracking in
+#               grape_fft_CWT_tracking_prophet.py, kept for comparison. Needs the prophet package and takes
+#               about a second per mode per minute, where the filters take microseconds
+# The filters start from a robust straight line fit to the training set, Prophet from the training set itself.
+# A peak more than gate Hz from a filter's prediction, or at or below level_threshold dB, is still assigned to
+# the mode but does not update the filter, which coasts on its Doppler rate. A filter that has coasted for
+# max_coast minutes restarts from its next peak above the level threshold.
+# Each tracker's memory is the number of its latest minutes its predictions depend on, None for the filters whose
+# state depends on every minute so far, n_train for Prophet. chunked_tracking.py uses it to stitch chunks exactly.
+
+import numpy as np
+import inspect
+from scipy import stats
+from scipy.optimize import linear_sum_assignment
+
+tracker_backends=['alpha_beta','kalman','prophet']
+assignment_methods=['hungarian','nearest']
+
+class AlphaBetaTracker:
+    # Doppler (Hz) and Doppler rate (Hz per minute) of one mode, times t in minutes
+    memory=None
+    def __init__(self,alpha=0.5,beta=0.1,gate=0.5,level_threshold=-80,max_coast=10):
+        self.alpha=alpha
+        self.beta=beta
+        self.gate=gate
+        self.level_threshold=level_threshold
+        self.max_coast=max_coast
+        self.t=None                  # time of the last update, None until the first peak above the threshold
+        self.freq=np.nan
+        self.rate=0.0
+
+    def predict(self,t):
+        # Predicted Doppler at t and its lower and upper bounds, NaN before the first update
+        if self.t is None:
+            return np.nan,np.nan,np.nan
+        freq=self.freq+self.rate*(t-self.t)
+        return freq,freq-self.gate,freq+self.gate
+
+    def start(self,t,freq,rate=0.0):
+        (self.t,self.freq,self.rate)=(t,freq,rate)
+
+    def train(self,t,freq,level):
+        # Start from the training set, arrays of times, Doppler and levels assigned to the mode, by a Theil-Sen line
+        # through those above the level threshold, robust to the odd peak of another mode in the training set
+        ok=np.isfinite(freq) & (level > self.level_threshold)
+        if np.count_nonzero(ok) > 1:
+            (slope,intercept)=stats.theilslopes(freq[ok],t[ok])[0:2]
+            self.start(t[ok][-1],intercept+slope*t[ok][-1],slope)
+        elif np.count_nonzero(ok) == 1:
+            self.start(t[ok][0],freq[ok][0])
+
+    def accept(self,t,freq,level):
+        # True if the peak at t should update the filter. Starts the filter, or restarts it after max_coast
+        # minutes without an update, from a peak above the level threshold, returning False as it is used
+        if not (np.isfinite(freq) and level > self.level_threshold):
+            return False
+        if self.t is None or t-self.t > self.max_coast:
+            self.start(t,freq)
+            return False
+        return abs(freq-self.predict(t)[0]) <= self.gate
+
+    def update(self,t,freq,level):
+        # Update with the peak assigned to the mode at t, NaN if none
+        if not self.accept(t,freq,level):
+            return
+        dt=t-self.t
+        residual=freq-self.predict(t)[0]
+        self.freq=self.freq+self.rate*dt+self.alpha*residual
+        if dt > 0:
+            self.rate=self.rate+self.beta*residual/dt
+        self.t=t
+
+class KalmanTracker(AlphaBetaTracker):
+    # As AlphaBetaTracker, but the gains follow from a constant Doppler rate model with white noise acceleration
+    # of q Hz^2 per minute^3 and Doppler measurement variance r Hz^2. Bounds are two standard deviations of the
+    # predicted measurement
+    def __init__(self,q=1e-4,r=4e-4,gate=0.5,level_threshold=-80,max_coast=10):
+        AlphaBetaTracker.__init__(self,gate=gate,level_threshold=level_threshold,max_coast=max_coast)
+        self.q=q
+        self.r=r
+        self.P=None
+
+    def covariance(self,t):
+        # State covariance predicted to t
+        dt=t-self.t
+        F=np.array([[1,dt],[0,1]])
+        Q=self.q*np.array([[dt**3/3,dt**2/2],[dt**2/2,dt]])
+        return F@self.P@F.T+Q
+
+    def predict(self,t):
+        if self.t is None:
+            return np.nan,np.nan,np.nan
+        freq=self.freq+self.rate*(t-self.t)
+        sd=np.sqrt(self.covariance(t)[0,0]+self.r)
+        return freq,freq-2*sd,freq+2*sd
+
+    def start(self,t,freq,rate=0.0):
+        AlphaBetaTracker.start(self,t,freq,rate)
+        self.P=np.diag([self.r,0.01])          # Doppler known to the measurement, rate to 0.1 Hz per minute
+
+    def update(self,t,freq,level):
+        if not self.accept(t,freq,level):
+            return
+        P=self.covariance(t)
+        gain=P[:,0]/(P[0,0]+self.r)
+        residual=freq-self.predict(t)[0]
+        self.freq=self.freq+self.rate*(t-self.t)+gain[0]*residual
+        self.rate=self.rate+gain[1]*residual
+        self.P=P-np.outer(gain,P[0,:])
+        self.t=t
+
+class ProphetTracker:
+    # Facebook Prophet fitted to the Doppler of the last n_train minutes assigned to the mode, predicting lead
+    # minutes after the last of them as Prophet looks lagged. Doppler at levels at or below level_threshold is
+    # replaced by the median of the rest, unless 8 or more are, as trainingQc did
+    def __init__(self,n_train=10,lead=3,level_threshold=-80):
+        from prophet import Prophet            # optional, only needed for this backend
+        import logging
+        logging.getLogger('prophet').setLevel(logging.WARNING)
+        logger=logging.getLogger('cmdstanpy')
+        logger.addHandler(logging.NullHandler())
+        logger.propagate=False
+        logger.setLevel(logging.CRITICAL)
+        self.Prophet=Prophet
+        self.n_train=n_train
+        self.memory=n_train
+        self.lead=lead
+        self.level_threshold=level_threshold
+        self.times=[]
+        self.freqs=[]
+        self.levels=[]
+
+    def predict(self,t):
+        from pandas import DataFrame, to_datetime, Timedelta
+        if len(self.times) < self.n_train:
+            return np.nan,np.nan,np.nan
+        freq=np.array(self.freqs[-self.n_train:],dtype=np.float64)
+        freq[~(np.array(self.levels[-self.n_train:]) > self.level_threshold)]=np.nan
+        if np.count_nonzero(np.isnan(freq)) < 8:
+            freq[np.isnan(freq)]=np.nanmedian(freq)
+        df=DataFrame({'ds':to_datetime(np.array(self.times[-self.n_train:])*60*1e9),'y':freq})
+        model=self.Prophet()
+        model.fit(df)
+        # Prophet samples the bounds from NumPy's global generator, seeded so a rerun or chunk gives the same and
+        # restored after so that other users of np.random in the run are not re-seeded
+        state=np.random.get_state()
+        try:
+            np.random.seed(0)
+            forecast=model.predict(DataFrame({'ds':[df['ds'].iloc[-1]+Timedelta(minutes=self.lead)]}))
+        finally:
+            np.random.set_state(state)
+        return forecast['yhat'].iloc[-1],forecast['yhat_lower'].iloc[-1],forecast['yhat_upper'].iloc[-1]
+
+    def train(self,t,freq,level):
+        for j in range(0,len(t)):
+            self.update(t[j],freq[j],level[j])
+
+    def update(self,t,freq,level):
+        self.times.append(t)
+        self.freqs.append(freq)
+        self.levels.append(level)
+
+def make_tracker(backend='alpha_beta',**settings):
+    # One mode's tracker of backend, settings as the keyword arguments of its class, others ignored
+    classes={'alpha_beta':AlphaBetaTracker,'kalman':KalmanTracker,'prophet':ProphetTracker}
+    if backend not in classes:
+        raise ValueError("backend must be one of {!s}, not {!s}".format(tracker_backends,backend))
+    names=inspect.signature(classes[backend]).parameters
+    return classes[backend](**{key:settings[key] for key in settings if key in names})
+
+def assign(pred,freqs,method='hungarian'):
+    # Index into freqs, the Doppler of this minute's peaks (NaN for none), of the peak for each mode, -1 if none,
+    # minimising the Doppler differences from the predictions pred. Modes with no prediction yet take the peaks
+    # left over, strongest first if freqs is in level order
+    # hungarian   least total squared difference over all modes, scipy linear_sum_assignment. Squared, as with
+    #             absolute differences both assignments tie whenever two predictions are on one side of two peaks,
+    #             and the order of the modes would decide
+    # nearest     the closest mode and peak pair first, then the next closest of those left, and so on
+    peaks=np.nonzero(np.isfinite(freqs))[0]
+    index=np.full(len(pred),-1)
+    if len(peaks) == 0:
+        return index
+    cost=(np.asarray(pred)[:,np.newaxis]-np.asarray(freqs)[peaks])**2
+    cost=np.where(np.isnan(cost),1e6+np.arange(len(peaks)),cost)
+    if method == 'hungarian':
+        (modes,cols)=linear_sum_assignment(cost)
+        index[modes]=peaks[cols]
+    elif method == 'nearest':
+        for k in np.argsort(cost,axis=None,kind='stable'):
+            (mode,col)=divmod(int(k),len(peaks))
+            if index[mode] < 0 and not np.any(index == peaks[col]):
+                index[mode]=peaks[col]
+    else:
+        raise ValueError("method must be one of {!s}, not {!s}".format(assignment_methods,method))
+    return index
+
+def level_order_swapped(freq,level,freqs,levels):
+    # True for each minute where a mode's peak, freq and level as (minutes x modes), is not the peak of the same
+    # column of freqs and levels, the peaks in level order
+    n_modes=freq.shape[1]
+    return np.any(np.isfinite(freq) & ~((freq == freqs[:,0:n_modes]) & (level == levels[:,0:n_modes])),axis=1)
+
+def track_modes(time,freqs,levels,n_modes=2,backend='alpha_beta',assignment='hungarian',n_train=10,**settings):
+    # time in hours of each minute, freqs (Hz) and levels (dB) as (minutes x peaks) for the peaks of each minute
+    # strongest first, NaN for none or for minutes in a gap. The first n_train minutes are the training set,
+    # already assigned to modes in column order, which start the trackers. settings go to make_tracker
+    # Returns (minutes x n_modes) arrays of the assigned Doppler and level, NaN where a mode had no peak, the
+    # predicted Doppler and its lower and upper bounds, NaN for the training set, and for each minute True if
+    # the assignment is not in level order, a peak listed twice counting as either column
+    freqs=np.asarray(freqs,dtype=np.float64)
+    levels=np.asarray(levels,dtype=np.float64)
+    if freqs.shape[1] < n_modes:                   # fewer peaks than modes, the rest are never found
+        pad=np.full((freqs.shape[0],n_modes-freqs.shape[1]),np.nan)
+        (freqs,levels)=(np.hstack((freqs,pad)),np.hstack((levels,pad)))
+    length=freqs.shape[0]
+    minutes=np.asarray(time,dtype=np.float64)*60
+    trackers=[make_tracker(backend,n_train=n_train,**settings) for k in range(0,n_modes)]
+    freq=np.full((length,n_modes),np.nan)
+    level=np.full((length,n_modes),np.nan)
+    pred=np.full((3,length,n_modes),np.nan)
+    swapped=np.zeros(length,dtype=bool)
+
+    n_train=min(n_train,length)
+    (freq[0:n_train],level[0:n_train])=(freqs[0:n_train,0:n_modes],levels[0:n_train,0:n_modes])
+    for k in range(0,n_modes):
+        trackers[k].train(minutes[0:n_train],freq[0:n_train,k],level[0:n_train,k])
+
+    for j in range(n_train,length):
+        for k in range(0,n_modes):
+            pred[:,j,k]=trackers[k].predict(minutes[j])
+        index=assign(pred[0,j],freqs[j],assignment)
+        for k in range(0,n_modes):
+            if index[k] >= 0:
+                (freq[j,k],level[j,k])=(freqs[j,index[k]],levels[j,index[k]])
+            trackers[k].update(minutes[j],freq[j,k],level[j,k])
+    swapped[n_train:]=level_order_swapped(freq[n_train:],level[n_train:],freqs[n_train:],levels[n_train:])
+    return freq,level,pred[0],pred[1],pred[2],swapped
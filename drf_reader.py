@@ -0,0 +1,83 @@
+# Module to read Grape IQ data from a digital_rf channel a block at a time, for a single frequency
+# Only the requested sub channel (frequency column) is read, and only one block of time windows is held
+# in memory at once, so peak memory stays bounded however long the analysis span is.
+# Where a column store (see column_store.py) holds the samples they are read from it instead of the DRF files.
+# The next blocks are read on a background thread while the caller processes the current one, so that the
+# HDF5 decode overlaps the FFT or ACF computation.
+# Given the channel catalog (see channel_catalog.py) reads are gap aware: samples in gaps are NaN in the
+# returned blocks, and time windows with gaps are skipped, found from the catalog's index of continuous blocks.
+
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+
+import column_store               # this is a module in this directory for the memory-mapped column store
+import channel_catalog            # this is a module in this directory to keep a catalog of channel metadata
+
+def read_vector(do,channel,start_sample,vector_length,sub_channel=None):
+    # As do.read_vector, with do a digital_rf DigitalRFReader, but from the column store if it holds the samples
+    data=column_store.read_vector(channel,start_sample,vector_length,sub_channel)
+    if data is None:
+        data=do.read_vector(start_sample,vector_length,channel,sub_channel)
+    return data
+
+def read_masked(do,channel,start_sample,vector_length,sub_channel=None,catalog=None):
+    # As read_vector, but with catalog given the samples in gaps between continuous blocks are NaN, rather than
+    # do.read_vector raising an IOError. Parts of the request in gaps are not read at all
+    if catalog is None:
+        return read_vector(do,channel,start_sample,vector_length,sub_channel)
+    start=int(start_sample)
+    ranges=channel_catalog.covered_ranges(catalog,start,vector_length)
+    if ranges == [(start,int(vector_length))]:
+        return read_vector(do,channel,start,vector_length,sub_channel)
+    n_freq=len(catalog['center_frequencies'])
+    if sub_channel is None and n_freq > 1:
+        shape=(int(vector_length),n_freq)
+    else:
+        shape=(int(vector_length),)
+    data=np.full(shape,complex(np.nan,np.nan),dtype=np.complex64)
+    for (sinx,nsamps) in ranges:
+        data[sinx-start:sinx-start+nsamps]=read_vector(do,channel,sinx,nsamps,sub_channel)
+    return data
+
+def read_blocks(do,channel,s,length,m_samples,sub_channel=None,block_windows=60,n_extra=0,prefetch=2,catalog=None):
+    # Generator over a span of length time windows of m_samples each, starting at sample index s
+    # do is a digital_rf DigitalRFReader, sub_channel the frequency index, None for single channel Grape
+    # Yields (j,block) where j is the index of the first time window in the block and block is a 1-D complex
+    # array of n*m_samples+n_extra samples, n=block_windows except for a shorter final block.
+    # Default of 60 one-minute windows matches the hourly rf@*.h5 files. n_extra samples beyond the
+    # block, e.g. 1 for a one lag ACF, overlap with the start of the next block.
+    # Up to prefetch blocks are read ahead on one background thread, which bounds memory to prefetch+1 blocks.
+    # One thread as do is not safe to share between threads, and h5py decodes one file at a time in any case.
+    # prefetch=0 reads each block only when it is asked for.
+    # With catalog, the channel catalog, samples in gaps are NaN, see read_masked.
+    s=int(s)                                      # s0+hours_offset*3600*fs may be float
+
+    def read(j):
+        n=min(block_windows,length-j)
+        return read_masked(do,channel,s+j*m_samples,n*m_samples+n_extra,sub_channel,catalog)
+
+    if prefetch < 1:
+        for j in range(0,length,block_windows):
+            yield j,read(j)
+        return
+
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        pending=deque()                           # bounded queue of blocks being read or read and waiting
+        for j in range(0,length,block_windows):
+            pending.append((j,pool.submit(read,j)))
+            if len(pending) > prefetch:
+                (j0,future)=pending.popleft()
+                yield j0,future.result()
+        while len(pending) > 0:
+            (j0,future)=pending.popleft()
+            yield j0,future.result()
+
+def read_windows(do,channel,s,length,m_samples,sub_channel=None,block_windows=60,prefetch=2,catalog=None):
+    # Generator as read_blocks, but yields (j,window) for each single time window of m_samples.
+    # Reads are still made block_windows at a time, windows are views into the block
+    # With catalog, windows that are not wholly within a continuous block are skipped, so j has gaps
+    for (j0,block) in read_blocks(do,channel,s,length,m_samples,sub_channel,block_windows,prefetch=prefetch,catalog=catalog):
+        for i in range(0,len(block)//m_samples):
+            if catalog is None or channel_catalog.is_covered(catalog,int(s)+(j0+i)*m_samples,m_samples):
+                yield j0+i,block[i*m_samples:(i+1)*m_samples]
@@ -4,11 +4,12 @@ import datetime
 import logging
 logger  = logging.getLogger(__name__)
 
+import re
+import hashlib
 import pickle
 
 import numpy as np
-
-from scipy import signal
+import netCDF4
 
 import matplotlib as mpl
 from matplotlib import pyplot as plt
@@ -16,6 +17,8 @@ from matplotlib import pyplot as plt
 import digital_rf as drf
 
 from eclipse_calc import solarContext
+import spectrogram_engine
+import spectrogram_pyramid
 
 mpl.rcParams['font.size']      = 12
 mpl.rcParams['font.weight']    = 'bold'
@@ -24,8 +27,9 @@ mpl.rcParams['grid.linestyle'] = ':'
 mpl.rcParams['figure.figsize'] = np.array([15, 8])
 mpl.rcParams['axes.xmargin']   = 0
 
-def load_grape_drf(sDate,eDate,data_dir,channel='ch0'):
+def load_grape_drf(sDate,eDate,data_dir,channel='ch0',contiguous=False):
     # DATA LOADING #########################
+    # contiguous=True gives each frequency its own contiguous complex64 copy instead of a column view
     meta_dir    = os.path.join(data_dir,channel,'metadata')
     do          = drf.DigitalRFReader(data_dir)
     dmr         = drf.DigitalMetadataReader(meta_dir)
@@ -75,22 +79,161 @@ def load_grape_drf(sDate,eDate,data_dir,channel='ch0'):
     for sinx, nsamps in blks.items():
         break # Get the first sample index and number of samples
 
-    bigarray_dct = {}
-    for cfreq in cntr_freqs:
-        bigarray_dct[cfreq] = np.zeros(nsamps,dtype=complex)
+    # Read the block once, all center frequencies together, then fan out one column per frequency.
+    # read_vector returns complex64 for Grape data, keep it so rather than upcasting to complex128.
+    print('Reading {!s} samples for {!s} center frequencies....'.format(nsamps,len(cntr_freqs)))
+    data    = do.read_vector(sinx, nsamps, channel)
+    if data.ndim == 1:
+        data = data[:,np.newaxis]   # Single frequency Grape returns a 1-d array
 
-    for cfreq_inx,(cfreq, bigarray) in enumerate(bigarray_dct.items()):
-        print()
-        print('Working on {!s} MHz....'.format(cfreq))
-        data = do.read_vector(sinx, nsamps, channel)
-        bigarray[:] = data[:,cfreq_inx]
+    bigarray_dct = {}
+    for cfreq_inx,cfreq in enumerate(cntr_freqs):
+        if contiguous:
+            bigarray_dct[cfreq] = np.ascontiguousarray(data[:,cfreq_inx])
+        else:
+            bigarray_dct[cfreq] = data[:,cfreq_inx]    # Zero-copy column view into the block
 
     result  = {}
     result['bigarray_dct']  = bigarray_dct
     result['latest_meta']   = latest_meta[latest_inx]
     result['properties']    = properties
-    t0                      = drf.util.sample_to_datetime(sinx,fs)
-    result['timevec_utc']   = [t0+drf.util.samples_to_timedelta(x,fs) for x in range(nsamps)]
+    # Compact timebase: start sample index and number of samples, with fs in properties.
+    # Sample times are derived on demand by sample_times().
+    result['sinx']          = int(sinx)
+    result['nsamps']        = int(nsamps)
+    return result
+
+def sample_times(result,inx=None):
+    # UTC times of the samples in a load_grape_drf result as a numpy datetime64[ns] array.
+    # inx selects sample indices relative to the start of the block, default is every sample.
+    fs      = result['properties']['samples_per_second']
+    t0      = drf.util.sample_to_datetime(result['sinx'],fs)
+    t0      = np.datetime64(t0.replace(tzinfo=None),'ns')
+    if inx is None:
+        inx = np.arange(result['nsamps'])
+    dt_ns   = np.round(np.asarray(inx,dtype=np.float64)*(1e9/float(fs))).astype(np.int64)
+    return t0 + dt_ns.astype('timedelta64[ns]')
+
+def upgrade_result(result):
+    # Results cached before the compact timebase carry 'timevec_utc', a list with one datetime per sample.
+    # Replace it with the start sample index and number of samples. Returns True if the result was changed,
+    # so that the caller can rewrite the cache.
+    if 'sinx' in result:
+        return False
+    timevec             = result.pop('timevec_utc')
+    fs                  = result['properties']['samples_per_second']
+    result['sinx']      = int(drf.util.time_to_sample(timevec[0],fs))
+    result['nsamps']    = len(timevec)
+    return True
+
+# CACHE #################################
+# Results of load_grape_drf are cached as a chunked netCDF4 file with one float32 (time,ri) variable per
+# center frequency holding the complex64 IQ samples as real,imaginary pairs. Any time range of one frequency
+# can be read without reading the rest, and a key built from the DRF files invalidates the cache.
+cache_chunk = 36000     # samples per chunk, one hour at 10 Hz
+
+def _epoch_seconds(dt):
+    # Naive datetimes are UTC, as for drf.util.time_to_sample
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=datetime.timezone.utc)
+    return dt.timestamp()
+
+def drf_cache_key(data_dir,channel,sDate,eDate):
+    # Hash of the name, size and modification time of each rf@*.h5 file that may hold samples between
+    # sDate and eDate, and of the channel properties and metadata files. Adding, replacing or touching
+    # any of them changes the key.
+    t0      = _epoch_seconds(sDate) - 86400     # files hold at most one day from their start time
+    t1      = _epoch_seconds(eDate)
+    ch_dir  = os.path.join(data_dir,channel)
+    entries = []
+    for dirpath, dirnames, fnames in os.walk(ch_dir):
+        dirnames.sort()
+        for fname in sorted(fnames):
+            if not fname.endswith('.h5'):
+                continue
+            mtch = re.match(r'rf@(\d+(?:\.\d+)?)\.h5$',fname)
+            if mtch is not None and not (t0 <= float(mtch.group(1)) < t1):
+                continue
+            fpath   = os.path.join(dirpath,fname)
+            st      = os.stat(fpath)
+            entries.append('{!s},{!s},{!s}'.format(os.path.relpath(fpath,ch_dir),st.st_size,st.st_mtime_ns))
+    return hashlib.sha1('\n'.join(entries).encode()).hexdigest()
+
+class CachedIQ(object):
+    # Complex64 IQ samples of one center frequency in a netCDF4 cache file, read only when sliced
+    def __init__(self,fpath,varname,nsamps):
+        self.fpath      = fpath
+        self.varname    = varname
+        self.shape      = (nsamps,)
+        self.dtype      = np.dtype(np.complex64)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self,key):
+        with netCDF4.Dataset(self.fpath,'r') as nc:
+            ri  = nc.variables[self.varname][key]
+        ri  = np.ascontiguousarray(np.ma.getdata(ri),dtype=np.float32)
+        return ri.view(np.complex64)[...,0]
+
+    def __array__(self,dtype=None,copy=None):
+        arr = self[:]
+        if dtype is not None:
+            arr = arr.astype(dtype)
+        return arr
+
+def save_cache(result,fpath,key):
+    # Write a load_grape_drf result to a netCDF4 cache file, via a temporary file so that an interrupted
+    # write never leaves a partial cache behind. A key of None writes no key, so that load_cache with a
+    # key never takes the cache as current
+    tmp_fpath   = fpath+'.tmp'
+    nsamps      = result['nsamps']
+    with netCDF4.Dataset(tmp_fpath,'w',format='NETCDF4') as nc:
+        if key is not None:
+            nc.cache_key    = key
+        nc.sinx         = np.int64(result['sinx'])
+        nc.nsamps       = np.int64(nsamps)
+        for mkey,val in result['latest_meta'].items():
+            nc.setncattr('meta_'+mkey,val)
+        for pkey,val in result['properties'].items():
+            if pkey != 'samples_per_second':       # long double, rebuilt from numerator and denominator
+                nc.setncattr('prop_'+pkey,val)
+
+        cfreqs  = list(result['bigarray_dct'].keys())
+        nc.createDimension('time',nsamps)
+        nc.createDimension('ri',2)
+        nc.createDimension('freq',len(cfreqs))
+        cf_var      = nc.createVariable('center_frequencies','f8',('freq',))
+        cf_var[:]   = cfreqs
+        for cfreq_inx,(cfreq,bigarray) in enumerate(result['bigarray_dct'].items()):
+            var     = nc.createVariable('iq_{!s}'.format(cfreq_inx),'f4',('time','ri'),
+                        chunksizes=(min(cache_chunk,nsamps),2))
+            var.center_frequency = cfreq
+            var[:]  = np.ascontiguousarray(bigarray,dtype=np.complex64).view(np.float32).reshape(-1,2)
+    os.replace(tmp_fpath,fpath)
+
+def load_cache(fpath,key=None):
+    # Open a netCDF4 cache file as a load_grape_drf result whose bigarray_dct values are CachedIQ,
+    # read on demand. Returns None if key is given and does not match the key the cache was built with.
+    with netCDF4.Dataset(fpath,'r') as nc:
+        if key is not None and getattr(nc,'cache_key',None) != key:
+            return None
+        nsamps      = int(nc.nsamps)
+        attrs       = {name:nc.getncattr(name) for name in nc.ncattrs()}
+        bigarray_dct = {}
+        for cfreq_inx,cfreq in enumerate(nc.variables['center_frequencies'][:].tolist()):
+            bigarray_dct[cfreq] = CachedIQ(fpath,'iq_{!s}'.format(cfreq_inx),nsamps)
+
+    latest_meta = {name[5:]:val for name,val in attrs.items() if name.startswith('meta_')}
+    properties  = {name[5:]:val for name,val in attrs.items() if name.startswith('prop_')}
+    properties['samples_per_second'] = (np.longdouble(properties['sample_rate_numerator'])
+                                        /np.longdouble(properties['sample_rate_denominator']))
+    result  = {}
+    result['bigarray_dct']  = bigarray_dct
+    result['latest_meta']   = latest_meta
+    result['properties']    = properties
+    result['sinx']          = int(attrs['sinx'])
+    result['nsamps']        = nsamps
     return result
 
 class GrapeDRF(object):
@@ -106,17 +249,31 @@ class GrapeDRF(object):
         event_fname = '{!s}-{!s}_{!s}_grapeDRF'.format(sDate_str,eDate_str,station)
         png_fname   = event_fname+'.png'
         png_fpath   = os.path.join(output_dir,png_fname)
-        ba_fpath    = os.path.join(output_dir,event_fname+'.ba.pkl')
+        nc_fpath    = os.path.join(output_dir,event_fname+'.nc')
+        ba_fpath    = os.path.join(output_dir,event_fname+'.ba.pkl')     # Whole-result pickle from earlier versions
         data_dir    = os.path.join('data','psws_grapeDRF',station)  
-
-        if not os.path.exists(ba_fpath):
-            result  = load_grape_drf(sDate,eDate,data_dir)
-            with open(ba_fpath,'wb') as fl:
-                pickle.dump(result,fl)
-        else:
-            print('Using cached file {!s}...'.format(ba_fpath))
+        cache_key   = drf_cache_key(data_dir,'ch0',sDate,eDate)
+
+        result      = None
+        if os.path.exists(nc_fpath):
+            result  = load_cache(nc_fpath,cache_key)
+            if result is None:
+                print('DRF data changed since cached file {!s} was made, reloading...'.format(nc_fpath))
+            else:
+                print('Using cached file {!s}...'.format(nc_fpath))
+        elif os.path.exists(ba_fpath):
+            # Only converted while there is no netCDF4 cache. The pickle has no key, so it may predate changes
+            # to the DRF files; its cache gets no key either, and the next run rebuilds it from the DRF files
+            print('Converting cached file {!s} to {!s}...'.format(ba_fpath,nc_fpath))
             with open(ba_fpath,'rb') as fl:
                 result = pickle.load(fl)
+            upgrade_result(result)
+            save_cache(result,nc_fpath,None)
+            print('{!s} is no longer used and can be deleted.'.format(ba_fpath))
+
+        if result is None:
+            result  = load_grape_drf(sDate,eDate,data_dir)
+            save_cache(result,nc_fpath,cache_key)
 
         self.result             = result
         self.cfreqs             = list(result['bigarray_dct'].keys())
@@ -124,11 +281,20 @@ class GrapeDRF(object):
         self.sDate              = sDate
         self.eDate              = eDate
         self.data_dir           = data_dir
+        self.station            = station
         self.event_fname        = event_fname
         self.output_dir         = output_dir
         self.png_fpath          = png_fpath
         self.cmap               = mpl.colors.LinearSegmentedColormap.from_list(" ", ["black","darkgreen","green","yellow","red"])
         self.spectrum_timevec   = None
+        self._timevec_utc       = None
+
+    @property
+    def timevec_utc(self):
+        # numpy datetime64 time of every sample, only calculated when first asked for
+        if self._timevec_utc is None:
+            self._timevec_utc = sample_times(self.result)
+        return self._timevec_utc
 
     def plot_figure(self,cfreqs=None,png_fpath=None,**kwargs):
         print('Now plotting {!s}...'.format(self.event_fname))
@@ -152,10 +318,41 @@ class GrapeDRF(object):
         fig.savefig(png_fpath,bbox_inches='tight')
         print(png_fpath)
 
+    def plot_stft(self,cfreq,ax,xlim,cmap,window_length,hop,nfft,window):
+        # Short time FFT spectrogram of the samples of cfreq within xlim, as a pcolormesh on ax
+        result  = self.result
+        bigarray = result['bigarray_dct'].get(cfreq)
+
+        # Only read and process the samples within xlim
+        inx0    = drf.util.time_to_sample(xlim[0],self.fs) - result['sinx']
+        inx1    = drf.util.time_to_sample(xlim[1],self.fs) - result['sinx']
+        inx0    = int(np.clip(inx0,0,result['nsamps']))
+        inx1    = int(np.clip(inx1,inx0,result['nsamps']))
+        bigarray = bigarray[inx0:inx1]
+
+        f, t_spec, Sxx_db = spectrogram_engine.stft_spectrogram(np.asarray(bigarray),float(self.fs),
+                window_length=window_length,hop=hop,nfft=nfft,window=window,scaling='density')
+        ts0                     = sample_times(result,[inx0]).astype(np.int64)[0]/1e9    # epoch seconds
+        ts_vec                  = ts0 + t_spec + window_length/2.                       # frame centres
+        self.spectrum_timevec   = [datetime.datetime.utcfromtimestamp(x) for x in ts_vec]
+
+        f               = f.astype('float64') # Frequency needs to be in float64 for some reason...
+        mpbl            = ax.pcolormesh(self.spectrum_timevec,f,Sxx_db,cmap=cmap)
+
+        return mpbl
+
     def plot_ax(self,cfreq,ax,cmap=None,plot_colorbar=False,
             xlim=None,
             solar_lat=None,solar_lon=None,
-            overlaySolarElevation=True,overlayEclipse=False):
+            overlaySolarElevation=True,overlayEclipse=False,
+            window_length=25.6,hop=22.4,nfft=1024,window='hann',
+            use_pyramid=False,pyramid_stat='mean'):
+        # window_length and hop are the short time FFT window and step in seconds, nfft the FFT length and
+        # window the window type, see spectrogram_engine.stft_spectrogram. The defaults are the 256 sample
+        # segments, 32 sample (1/8) overlap and 1024 point FFT of the earlier scipy.signal.spectrogram call,
+        # plotted as the same power spectral density.
+        # use_pyramid=True plots from the spectrogram pyramid instead, at the level matching the axes width,
+        # building any day that is missing or out of date. pyramid_stat is 'mean' or 'max' power.
 
         sDate   = self.sDate
         eDate   = self.eDate
@@ -175,23 +372,24 @@ class GrapeDRF(object):
             print(msg)
             return
 
-        f, t_spec, Sxx  = signal.spectrogram(bigarray,fs=self.fs,nfft=1024,window='hann',return_onesided=False)
-        if self.spectrum_timevec is None:
-            # TODO: Make this more clean in the future.
-            ts0                     = min(result['timevec_utc']).timestamp()
-            ts1                     = max(result['timevec_utc']).timestamp()
-            ts_vec                  = np.linspace(ts0,ts1,len(t_spec))
-            self.spectrum_timevec   = [datetime.datetime.utcfromtimestamp(x) for x in ts_vec]
-
-        f               = (np.fft.fftshift(f)).astype('float64') # Frequency needs to be in float64 for some reason...
-        Sxx             = np.fft.fftshift(Sxx,axes=0)
-        Sxx_db          = 10*np.log10(Sxx)
+        if xlim is None:
+            xlim = (sDate,eDate)
+
         if cmap is None:
             cmap = self.cmap
-        mpbl            = ax.pcolormesh(self.spectrum_timevec,f,Sxx_db,cmap=cmap)
 
-        if plot_colorbar:
-            cbar = fig.colorbar(mpbl,label='PSD [dB]')
+        if use_pyramid:
+            for day in spectrogram_pyramid.days_in(xlim[0],xlim[1]):
+                if not spectrogram_pyramid.is_current(self.data_dir,'ch0',self.station,day):
+                    spectrogram_pyramid.build_day(self.data_dir,'ch0',self.station,day)
+            mpbl    = spectrogram_pyramid.plot_ax(ax,self.station,cfreq,xlim[0],xlim[1],stat=pyramid_stat,cmap=cmap)
+            clabel  = 'PSD uncalibrated [dB]'   # one minute FFT levels as grape_fft_spectrogram.py
+        else:
+            mpbl    = self.plot_stft(cfreq,ax,xlim,cmap,window_length,hop,nfft,window)
+            clabel  = 'PSD [dB]'
+
+        if plot_colorbar and mpbl is not None:
+            cbar = ax.figure.colorbar(mpbl,ax=ax,label=clabel)
 
         sts     = solarContext.solarTimeseries(sDate,eDate,solar_lat,solar_lon)
         odct    = {'color':'white','lw':4,'alpha':0.75}
@@ -201,9 +399,6 @@ class GrapeDRF(object):
         if overlayEclipse:
             sts.overlayEclipse(ax,**odct)
 
-        if xlim is None:
-            xlim = (sDate,eDate)
-
         xticks  = ax.get_xticks()
         xtkls   = []
         for xtk in xticks:
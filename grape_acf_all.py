@@ -0,0 +1,132 @@
+# Program to read in the metadata and IQ data from a Grape receiver in digital_rf format
+# Complex autocorrelation analysis of all the center frequencies at once, from lags 0 to max_lag, see acf_engine.py
+# Doppler, spread and SNR from the one lag estimator of grape_acf_doppler_spread.py, the noise corrected pulse
+# pair and the multi-lag fit all come from the same ACF, so estimators can be compared without re-reading data.
+# Sends a table of every frequency and time window to a Parquet product file, see product_store.py, and plots the
+# pulse pair Doppler of each frequency
+#
+# Script needs three command line arguments:
+# 1. Directory to process 2. Start time in hour 3. Stop time in hour
+# An optional fourth argument 'CSV' also exports the table to a csv file
+#     e.g. python3 grape_acf_all.py ch0_W2NAF 12 20
+
+import digital_rf as drf
+import numpy as np
+import pylab as plt
+import csv                         # to write csv file for plotting and comparison in Excel
+import sys
+import os
+
+import load_metadata              # this is a module in this directory to read digital RF metadata
+import product_store              # this is a module in this directory to write results as Parquet files
+import channel_catalog            # this is a module in this directory to keep a catalog of channel metadata
+import acf_engine                 # this is a module in this directory for the vectorised ACF analysis
+import drf_reader                 # this is a module in this directory to read IQ data a block at a time
+
+base_directory='./'
+data_dir=os.path.join(base_directory,'data','psws_grapeDRF')
+output_dir=os.path.join(base_directory,'output')
+
+do = drf.DigitalRFReader(data_dir)
+
+# check for three command line arguments, optional fourth CSV
+csv_flag=False
+n = len(sys.argv)
+if n == 5 and sys.argv[4] == 'CSV':
+   csv_flag=True
+elif n != 4:
+   print ("Rerun with channel name and start and stop hours as three command line arguments")
+   exit()
+
+channel=sys.argv[1]
+hours_offset=int(sys.argv[2])  # Start time for data input and plot
+
+if hours_offset < 0 or hours_offset > 23:
+   print ("Start time (hours) must be between 0 and 23")
+   exit()
+
+if (float(sys.argv[3])-float(sys.argv[2])) <1:
+   print ("Stop time must be at least one hour greater than start time")
+   exit()
+
+################################################
+# Get metadata then set up constants and arrays
+################################################
+(date,freqList,s1,s0,fs,theCallsign,grid,lat,lon) = load_metadata.load_grape_drf_metadata(data_dir,channel)
+catalog=channel_catalog.load_catalog(data_dir,channel)   # continuous blocks, to find the gaps in the data
+s_day=channel_catalog.utc_to_sample(catalog,date)         # sample at 00:00 UTC, s0 is later if data starts late
+
+# Check sensible and available command line start and stop times
+if int(sys.argv[3]) >= ((s1-s_day)/10)/3600:
+   print ("End time specified beyond end of data set: Reading to last sample in data set")
+   length=int(np.floor(((((s1-s_day)/10)/3600)-hours_offset)*60))    # calculate length of data in minutes
+else:
+   length=int(np.floor((int(sys.argv[3])-hours_offset)*60))    # calculate length of data in minutes to be sure in data set
+
+print("Length of selected period ",length, " minutes")
+
+product_filename=product_store.product_fpath('ACF_all',theCallsign,None,date)
+csv_dir=os.path.join(output_dir,'csv',theCallsign)
+csv_filename=csv_dir+'/ACF_all_' + date + ".csv"
+
+time_window=60                               # 60 seconds for each processed data ensemble, as grape_acf_doppler_spread.py
+max_lag=4                                    # ACF lags 0 to 4 s/10, the multi-lag fit uses lags 1 to 4
+m_samples=int(fs*time_window)
+s=channel_catalog.utc_to_sample(catalog,date,hours_offset)   # sample at command line start time, UTC
+n_freq=len(freqList)
+
+time=np.round((np.arange(length)/60)+hours_offset,5)   # time in hours, rounded for csv file
+table={}
+
+########################################
+# digital_rf read in code and ACF analysis
+########################################
+# Get samples of all frequencies, sub_channel None, an hour at a time. max_lag extra samples for the lags at the
+# end of the last window. One ACF of every window and frequency of the block, gaps give NaN
+for (j,data) in drf_reader.read_blocks(do,channel,s,length,m_samples,None,n_extra=max_lag,catalog=catalog):
+  block_table=acf_engine.acf_table(data,fs,time_window,max_lag)
+  for key in block_table:
+    if key not in table:
+      table[key]=np.full((n_freq,length),np.nan)
+    table[key][:,j:j+block_table[key].shape[1]]=block_table[key]
+
+# Product of one row per time window and frequency, frequency by frequency
+columns=['level']
+headers=["Hour (UTC)","Freq (MHz)","Level (dB)"]
+for method in acf_engine.acf_methods:
+  columns=columns+['doppler_'+method,'spread_'+method,'snr_'+method]
+  headers=headers+["Doppler "+method+" (Hz)","Spread "+method+" (mHz)","SNR "+method+" (dB)"]
+rows={key:table[key].ravel() for key in columns}
+product_store.write_product(product_filename,np.tile(time,n_freq),rows,date,theCallsign,np.repeat(freqList,length),grid,lat,lon,
+                            {'time_window':time_window,'max_lag':max_lag})
+print("ACF table for all frequencies saved to ",product_filename)
+
+if csv_flag:
+  if not os.path.exists(csv_dir):
+    os.makedirs(csv_dir)
+  with open(csv_filename, 'w', encoding='UTF8',) as out_file:     # open a csv file for write, write metadata, headers then data rows
+    writer=csv.writer(out_file)
+    writer.writerow(["Date","Callsign","Grid","Lat","Lon"])
+    writer.writerow([date,theCallsign,grid,lat,lon])
+    writer.writerow(headers)
+    writer.writerows(np.column_stack([np.tile(time,n_freq),np.repeat(freqList,length)]+[np.round(rows[key],5) for key in columns]))
+  print("ACF table for all frequencies exported to ",csv_filename)
+
+###########################################
+# Plot of pulse pair Doppler of each frequency
+###########################################
+plot_dir=os.path.join(output_dir,'plots',theCallsign)   # plots go into a subdirectory by callsign
+if not os.path.exists(plot_dir):
+  os.makedirs(plot_dir)
+
+fig, axs= plt.subplots(n_freq,1,sharex=True,squeeze=False)
+for freq_index in range(0,n_freq):
+  ax=axs[freq_index,0]
+  ax.plot(time,table['doppler_pulse_pair'][freq_index],'.',color="black",markersize=2)
+  ax.set_ylabel(str(freqList[freq_index])+" MHz",fontsize=8)
+plt.suptitle("ACF pulse pair Doppler (Hz) " + theCallsign, fontsize=12)
+plt.xlabel("Time on " + date + " (hours UTC)")
+plt.gcf().set_size_inches(8, 1.5*n_freq+1, forward=True)
+plt.tight_layout()
+plt.savefig(plot_dir +"/ACF_Doppler_all_" + date + ".png", dpi=600)
+print("ACF Doppler plot saved")
@@ -14,6 +14,12 @@
 # 1. Directory to process 2. Index of array of frequency to plot
 # 3. Start time in hour   4. Stop time in hour
 #     e.g. python3 grape_digital_RF_metadata.py ch0_G4HZX 6 8 13
+# Optional --window and --hop give the seconds of data in each ACF window, default 60, and between the starts of
+# successive windows, default the window, so --window on its own gives disjoint windows of that length. A hop less
+# than the window gives overlapping windows for a smoother Doppler time series, e.g. --window 60 --hop 1, at about
+# the cost of the default from cumulative sums, see acf_engine.py
+#     e.g. python3 grape_acf_doppler_spread.py ch0_G4HZX 6 8 13 --window 60 --hop 1
+# Results go to a Parquet product file, see product_store.py, optional --csv also exports them to a csv file
 
 # Last modified 7 July 2025 for QEX article, to handle Grape 1 DRF with less metadata, and by callsign output directories
 # Gwyn Griffiths G3ZIL with thanks for Nathaniel Frissell W2NAF for metadata data_dict code
@@ -29,6 +35,10 @@ import os
 import maidenhead as mh           # lat lon to locator, used if locator not present, eg Grape 1 DRF metadata
 
 import load_metadata              # this is a module in this directory to read digital RF metadata
+import product_store              # this is a module in this directory to write results as Parquet files
+import channel_catalog            # this is a module in this directory to keep a catalog of channel metadata
+import acf_engine                 # this is a module in this directory for the vectorised ACF analysis
+import drf_reader                 # this is a module in this directory to read IQ data a block at a time
 
 base_directory='./'
 data_dir=os.path.join(base_directory,'data','psws_grapeDRF')
@@ -36,14 +46,29 @@ output_dir=os.path.join(base_directory,'output')
 
 do = drf.DigitalRFReader(data_dir)
 
-# check for four command line arguments
+# check for four command line arguments, then optional --window and --hop, each with a value in seconds, and --csv
+time_window=60                 # 60 seconds is default for each processed data ensemble, but could be changed for special uses
+hop=None                       # seconds between the starts of successive windows, default the window, i.e. no overlap
+csv_flag=False                 # export a csv file as well as the Parquet product
 n = len(sys.argv)
 if n<=4:
-   print ("Rerun with channel name, frequency index and start and stop hours as four command line arguments")
-   exit()
-if n>5:
-   print ("Rerun with channel name, frequency index and start and stop hours as four command line arguments")
+   print ("Rerun with channel name, frequency index and start and stop hours as four command line arguments, then optional --window and --hop seconds and --csv")
    exit()
+i=5
+while i < n:
+   if sys.argv[i] == '--window' and i+1 < n:
+     time_window=float(sys.argv[i+1])
+     i=i+2
+   elif sys.argv[i] == '--hop' and i+1 < n:
+     hop=float(sys.argv[i+1])
+     i=i+2
+   elif sys.argv[i] == '--csv':
+     csv_flag=True
+     i=i+1
+   else:
+     print ("Rerun with channel name, frequency index and start and stop hours as four command line arguments, then optional --window and --hop seconds and --csv")
+     exit()
+hop=time_window if hop is None else hop   # --window on its own gives disjoint windows of that length
 
 # assign first three command line arguments to variables, check time span and that end time > start time + one hour
 channel=sys.argv[1]
@@ -66,11 +91,13 @@ if (float(sys.argv[4])-float(sys.argv[3])) <1:
 # Call module function to read in metadata, draws on data_dict code from Nathaniel Frissell 
 
 (date,freqList,s1,s0,fs,theCallsign,grid,lat,lon) = load_metadata.load_grape_drf_metadata(data_dir,channel)
+catalog=channel_catalog.load_catalog(data_dir,channel)   # continuous blocks, to find the gaps in the data
+s_day=channel_catalog.utc_to_sample(catalog,date)         # sample at 00:00 UTC, s0 is later if data starts late
 
 # Check sensible and available command line start and stop times
-if int(sys.argv[4]) >= ((s1-s0)/10)/3600:
+if int(sys.argv[4]) >= ((s1-s_day)/10)/3600:
    print ("End time specified beyond end of data set: Reading to last sample in data set")
-   length=int(np.floor(((((s1-s0)/10)/3600)-hours_offset)*60))    # calculate length of data in minutes
+   length=int(np.floor(((((s1-s_day)/10)/3600)-hours_offset)*60))    # calculate length of data in minutes
 else:
    length=int(np.floor((int(sys.argv[4])-hours_offset)*60))    # calculate length of data in minutes to be sure in data set
 
@@ -81,62 +108,71 @@ frequency=freqList[freq_index]        # This comes from command line argument an
 ########################################
 # Set up constants and arrays
 ########################################
+m_samples=int(round(fs*time_window))
+hop_samples=int(round(fs*hop))
+if m_samples < 2 or hop_samples < 1 or hop_samples > m_samples:
+   print ("ACF --window must be at least two samples and --hop at least one sample and no more than the window")
+   exit()
+sliding=(hop_samples != m_samples or time_window != 60)
+length=int(np.floor((length*60*fs-m_samples)/hop_samples))+1   # number of windows that fit in the selected period
+
+suffix=''
+if sliding:                                   # not the default one minute product, so a separate file
+  suffix="_W{:g}_H{:g}".format(time_window,hop)
+product_filename=product_store.product_fpath('ACF',theCallsign,frequency,date,suffix)
 csv_dir=os.path.join(output_dir,'csv',theCallsign)
-if not os.path.exists(csv_dir):
-  os.makedirs(csv_dir)
-csv_filename=csv_dir+'/ACF_FWL_data_' + "_" + str(frequency) + "MHz_" + date + ".csv"    # 
-
-time_window=60                               # 60 seconds is default for each processed data ensemble, but could be changed for special uses
-length=int(np.floor(length*(60/time_window))) # in case time window changed, then alter length accordingly
-
-m_samples=int(fs*time_window)
-n_samples=int(length*m_samples+1)            # total length of input data in samples
-s=s0+hours_offset*3600*fs                    # calculate start time given command line start time offset
-
-freq=np.empty(n_samples)
-spread= np.empty(n_samples)
-level=np.empty(n_samples)
-time=np.empty(n_samples)
-real=np.empty(m_samples)
-dB_level=np.empty(length)
-data=np.zeros(m_samples)
+csv_filename=csv_dir+'/ACF_FWL_data_' + "_" + str(frequency) + "MHz_" + date + suffix + ".csv"    # 
+
+s=channel_catalog.utc_to_sample(catalog,date,hours_offset)   # sample at command line start time, UTC
 
 ########################################
 # digital_rf read in code
 ########################################
 
 do.get_channels()
-# get samples, these are i,q pairs. Starting at s
-input = do.read_vector(s, n_samples, channel)
 if len(freqList) > 1: 
-  data=input[:,freq_index]
+  sub_channel=freq_index
 else:                               # single channel Grape so 1 dimensional data array
-  data=input[:]
-print ("First data sample is ", data[0])
-
-with open(csv_filename, 'w', encoding='UTF8',) as out_file:     # open a csv file for write, write metadata, headers then data rows
- writer=csv.writer(out_file)
- writer.writerow(["Date","Callsign","Grid","Freq (MHz)","Lat","Lon"])
- writer.writerow([date,theCallsign,grid,str(frequency),lat,lon])
- writer.writerow(["Hour (UTC)","Doppler (Hz)","Spread (mHz)","Level (dB)"])
-
-# Analysis outer and inner loops
- for j in range (0,length):
-  R_T0=0
-  R_Ts=0
-  k=int(j*m_samples)
-  for i in range (0, m_samples):                        # analysis and average frequency and level every specified time window
-    R_T0=R_T0+data[i+k]*np.conjugate(data[i+k])         # ACF function at zero lag
-    R_Ts=R_Ts+data[i+k]*np.conjugate(data[i+1+k])       # ACF function at one lag
-    real[i]=np.real(data[i+k])  
-  freq[j]=round(-(1/(2*np.pi*0.1))*np.angle(R_Ts),5)    # round for csv file, 0.01 mHz resolution is OTT but useful for WW0WWV
-  level=np.std(real)+np.average(real)                   # matches expected from 20*log10(65535) as 16 bit full scale
-                                                        # with very small freq shifts have to add 'DC' component
-  dB_level[j]=round(20*np.log10(level),2)               # round for csv, 2 decimal places is sensible
-  spread[j]=(1.414/(2*np.pi*0.1))*np.sqrt(np.abs(np.log((R_T0/np.abs(R_Ts)))))*1000    # spread in milliHertz
-  spread[j]=round(spread[j],0)                          # round for csv file, 1 mHz resolution is sensible
-  time[j]=round(((j)/(60*(60/time_window)))+hours_offset,5)                # time in hours, rounded for csv file
-  writer.writerow([time[j],freq[j],spread[j],dB_level[j]])
+  sub_channel=None
+
+freq=np.empty(length)
+spread=np.empty(length)
+dB_level=np.empty(length)
+time=np.round((np.arange(length)*hop/3600)+hours_offset,5)   # time of window start in hours, rounded for csv file
+
+# Get samples, these are i,q pairs, starting at s an hour at a time. One extra sample for the one lag ACF
+# Analysis of all time windows in each block at once, then round
+# Sliding windows are read a hop at a time, with the extra samples for the last windows of the block to run on
+if sliding:
+  blocks=drf_reader.read_blocks(do,channel,s,length,hop_samples,sub_channel,max(1,int(3600/hop)),n_extra=m_samples-hop_samples+1,catalog=catalog)
+else:
+  blocks=drf_reader.read_blocks(do,channel,s,length,m_samples,sub_channel,n_extra=1,catalog=catalog)
+for (j,data) in blocks:
+  if j == 0:
+    print ("First data sample is ", data[0])
+  if sliding:
+    (block_freq,block_spread,block_level)=acf_engine.acf_doppler_spread_sliding(data,fs,time_window,hop)
+  else:
+    (block_freq,block_spread,block_level)=acf_engine.acf_doppler_spread(data,fs,time_window)
+  n=len(block_freq)
+  freq[j:j+n]=np.round(block_freq,5)                    # 0.01 mHz resolution is OTT but useful for WW0WWV
+  spread[j:j+n]=np.round(block_spread,0)                # 1 mHz resolution is sensible
+  dB_level[j:j+n]=np.round(block_level,2)               # 2 decimal places is sensible
+
+# Write all the results at once to the Parquet product file, and the csv file if asked for
+product_store.write_product(product_filename,time,{'doppler':freq,'spread':spread,'level':dB_level},
+                            date,theCallsign,frequency,grid,lat,lon,{'time_window':time_window,'hop':hop})
+print("ACF product saved to ",product_filename)
+
+if csv_flag:
+  if not os.path.exists(csv_dir):
+    os.makedirs(csv_dir)
+  with open(csv_filename, 'w', encoding='UTF8',) as out_file:     # open a csv file for write, write metadata, headers then data rows
+    writer=csv.writer(out_file)
+    writer.writerow(["Date","Callsign","Grid","Freq (MHz)","Lat","Lon"])
+    writer.writerow([date,theCallsign,grid,str(frequency),lat,lon])
+    writer.writerow(["Hour (UTC)","Doppler (Hz)","Spread (mHz)","Level (dB)"])
+    writer.writerows(np.column_stack((time,freq,spread,dB_level)))
 
 ###########################################
 # Plots of Doppler, Spread and Level
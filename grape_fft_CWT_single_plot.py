@@ -31,6 +31,9 @@ import csv                         # to write csv file for plotting and comparis
 import os
 
 import load_metadata              # this is a module in this directory to read digital RF metadata
+import channel_catalog            # this is a module in this directory to keep a catalog of channel metadata
+import spectrogram_engine         # this is a module in this directory for the batched FFT and zoom spectra
+import peak_refine                # this is a module in this directory to refine the CWT peaks all at once
 
 # set base directory for subsequent read operations and set up digital RF reader appropriate directory
 base_directory='./'
@@ -39,14 +42,18 @@ output_dir=os.path.join(base_directory,'output')
 
 do = drf.DigitalRFReader(data_dir)
 
-# check for four command line arguments
+# check for four or five command line arguments, optional fifth ZOOM refines peak Doppler with a chirp-z zoom spectrum
+zoom_flag=False
 n = len(sys.argv)
 if n<=4:
    print ("Rerun with channel name, frequency index and spectrum time and number of peaks as four command line arguments")
    exit()
 if n>5:
-   print ("Rerun with channel name, frequency index and spectrum time and number of peaks as four command line arguments")
-   exit()
+   if n == 6 and sys.argv[5] == 'ZOOM':
+     zoom_flag=True
+   else:
+     print ("Rerun with channel name, frequency index and spectrum time and number of peaks as four command line arguments")
+     exit()
 
 # assign first three command line arguments to variables, check time span and that end time > start time + one hour
 channel=sys.argv[1]
@@ -63,31 +70,6 @@ length=1                       # we'll get just one minute of data at hours_offs
 ##########################################################
 # Data processing functions
 ##########################################################
-# local peak search: takes array index of CWF identified peak, does local search n bins either side for a true peak, returns index
-def findLocalPeak (index, radius,level):
-  # This method finds if the true local peak is to one side or other of CWF peak, and if so returns its index
-  if index < 5 or index >594:
-     return index                     # This is special case at either end near -5 and +5 Hz where we cannot search. Should not happen
-  cwf_peak=level[index]
-  for i in range (index-radius,index+radius+1):
-     if level[i] > cwf_peak:
-       index=i
-       cwf_peak=level[i]
-  return index
-
-# Interpolate between frequency bins based on the weighted linear signal level at peak and either side
-def freqInterpolate (index, radius, x, level):
-  # This method interpolates in frequency space around true local peak returning an amplitude-weighted frequency
-  if index < 5 or index >594:
-     return x[index]                      # This is special case at either end near -5 and +5 Hz where we cannot search. Should not happen
-  sum=0
-  sum_weights=0
-  for i in range (index-radius,index+radius+1):
-      sum=sum+x[i]*10**(level[i]/20)      # Convert dB level to linear
-      sum_weights=sum_weights+10**(level[i]/20)
-  freq_interp=sum/sum_weights           # Interpolated peak frequency
-  return freq_interp
-
 def remove_adjacent(L):      # This function removes instances where a single peak has adjacent frequencies
   return [elem for i, elem in enumerate(L) if i == 0 or L[i-1]+1 != elem]
 
@@ -98,18 +80,15 @@ def remove_adjacent(L):      # This function removes instances where a single pe
 # Call module function to read in metadata, draws on data_dict code from Nathaniel Frissell 
 
 (date,freqList,s1,s0,fs,theCallsign,grid,lat,lon) = load_metadata.load_grape_drf_metadata(data_dir,channel)
+catalog=channel_catalog.load_catalog(data_dir,channel)   # continuous blocks, to find the gaps in the data
 
 Hann_factor=1.63     # This is the energy correction factor # https://community.sw.siemens.com/s/article/window-correction-factors
 time_window=60                       # 60 seconds
 m_samples=int(fs*time_window)
 n_samples=int(length*m_samples+1)    # how many samples at fs to read in
-s=s0+hours_offset*3600*fs            # calculate start time given command line start time offset
+s=channel_catalog.utc_to_sample(catalog,date,hours_offset)   # sample at command line start time, UTC
 frequency=freqList[freq_index]        # This comes from command line argument and metadata frequency list
 
-freq_peaks=np.empty(n_peaks)   # to hold candidate peaks
-level_peaks=np.empty(n_peaks)  # their signal level
-spec_widths=np.empty(n_peaks)  # and width estimate between half peak amplitude
-
 csv_dir=os.path.join(output_dir,'csv',theCallsign)
 if not os.path.exists(csv_dir):
   os.makedirs(csv_dir)
@@ -120,6 +99,9 @@ csv_filename=csv_dir+'/one_FFT_data_' + "_" + str(frequency) + "MHz_" + date + "
 ########################################
 
 do.get_channels()
+if not channel_catalog.is_covered(catalog,s,n_samples):
+  print ("Gap in the data at the time specified, choose another start time")
+  exit()
 # get samples, these are i,q pairs. Starting at s
 input = do.read_vector(s, n_samples, channel)
 if len(freqList) > 1: 
@@ -166,35 +148,32 @@ peaks = signal.find_peaks_cwt(yf, widths=np.arange(2,4))  # 2,4 is empirical sel
 
 peakind=remove_adjacent(peaks)                              # in case single peak shown as two adj freqs
 
-# find the index at four successively reducing maxima: algorithm finds first max, finds freq and level at that index, then sets max that index to zero
-# and iterates
+# find the indices of the n_peaks successively reducing maxima, then refine them all at once, see peak_refine.py:
+# look three bins either side to find true peak, estimate spectrum widths between half max amplitudes for each
+# peak, and interpolate the true peak frequency based on linear levels two bins either side
+index_cwf=peak_refine.strongest_peaks(np.zeros(len(peakind),dtype=int),np.asarray(peakind,dtype=int),yf[peakind],1,n_peaks)[0]
+(index_peaks,freq_peaks,level_peaks,width_bins)=peak_refine.refine_peaks(yf,index_cwf,x,local_radius=3,interp_radius=2,
+                                                                          rel_height=0.5,wlen=10)
+spec_widths=width_bins/time_window   # bins of 1/time_window Hz
+
 for i in range(0,n_peaks):
-    max=np.argmax(yf[peakind])
-    index_max=peakind[max]
-    index_max_original=index_max
-    freq_peaks[i]=x[index_max]
-    level_peaks[i]=yf[index_max]
-    print("\nCWF peak ",i," freq=", f"{freq_peaks[i]:.3f}", " Hz  at level=",f"{level_peaks[i]:.2f}"," dB at index ",index_max)
-
-# Now call function to look either side to find true peak, revise and print output
-    index_max=findLocalPeak(index_max,3,yf)
-    freq_peaks[i]=float(x[index_max])
-    level_peaks[i]=yf[index_max]
-    print("Revised CWF peak ",i," freq=", f"{freq_peaks[i]:.3f}", " Hz  at level=",f"{level_peaks[i]:.2f}", " dB at index_max ",index_max)
-
-# Now estimate spectrum widths between half max amplitudes for each peak
-    tops=np.ones((1,), dtype=int)*int(index_max)
-    (width,width_heights,left_ips,right_ips)=peak_widths(10**(yf/20),tops,rel_height=0.5, wlen=10)
-    spec_widths[i]=width[0]/time_window
+    if index_cwf[i] < 0:
+        print("\nCWF found only ",i," peaks")
+        break
+    print("\nCWF peak ",i," freq=", f"{x[index_cwf[i]]:.3f}", " Hz  at level=",f"{yf[index_cwf[i]]:.2f}"," dB at index ",index_cwf[i])
+    print("Revised CWF peak ",i," freq=", f"{float(x[index_peaks[i]]):.3f}", " Hz  at level=",f"{level_peaks[i]:.2f}", " dB at index_max ",index_peaks[i])
     print("Spec width w50 ",i," = ", f"{spec_widths[i]:.3f}", " Hz" )
-
-# Now interpolate the true peak frequency based on correlation level either side
-    freq_peaks[i]=freqInterpolate(index_max,2,x,yf)
     print("Interpolated CWF peak ",i," freq= ", f"{freq_peaks[i]:.3f}", " Hz" )
 
-# Need to remove the peak just found from the array list of peaks
-    to_remove=np.array([index_max_original])
-    peakind=np.setdiff1d(peakind,to_remove)
+# Optionally refine all the interpolated peaks at once with a chirp-z zoom spectrum of +/- one FFT bin around each
+if zoom_flag:
+  if len(freqList) > 1:
+    minute=data[0:m_samples,freq_index]
+  else:
+    minute=data[0:m_samples]
+  freq_peaks=spectrogram_engine.zoom_peak_frequency(np.tile(minute,(n_peaks,1)),float(fs),freq_peaks)
+  for i in range(0,n_peaks):
+    print("Zoom refined CWF peak ",i," freq= ", f"{freq_peaks[i]:.4f}", " Hz" )
 
 ###########################################
 # Plots of Spectrum and peaks
@@ -1,6 +1,7 @@
 # Program to read in the metadata and IQ data from a Grape receiver in digital_rf format
 # This is FFT variant experimenting with Continuous Wavelet Transform (CWT) peak finding, interpolation and tracking
-# Tracking using Facebook Prophet
+# Tracking of N propagation modes with a pluggable tracker, an alpha-beta or Kalman filter per mode or, for comparison,
+# Facebook Prophet as originally, see doppler_tracker.py. Settings in the optional [tracking] section of the config file
 # See https://github.com/MITHaystack/digital_rf/blob/master/docs/DigitalRF2.0.pdf for digital_rf stuff
 # hamsci.org/sites/default/files/Grape/2023-09-22%20Getting%20Started%20with%20Data%20Reporting%20Using%20A%20PSWS_V7.1.pdf
 # also has details.
@@ -15,6 +16,10 @@
 # 1. Directory to process                     2. Index of array of frequency to plot
 # 3. Start time decimal hours UTC             4. Duration in minutes
 #     e.g. python3 grape_fft_CWT_tracking_prophet_QEX.py ch0_W2NAF 8 14.3 15.5
+# Optional further arguments ZOOM, CSV and PARALLEL, see below. Results go to a Parquet product file, see product_store.py
+# Tracker settings, e.g. tracker = kalman or modes = 3, go in the [tracking] section of config/callsign_config.ini,
+# see config/G4HZX_config.ini, the defaults are an alpha-beta filter for each of two modes
+# PARALLEL splits a long span, e.g. a day or a week, into chunks for a pool of worker processes, see chunked_tracking.py
 
 # Last modified 27 June 2025 for use with QEX article submission
 # Gwyn Griffiths G3ZIL with thanks for Nathaniel Frissell W2NAF for metadata data_dict code
@@ -29,23 +34,16 @@ import pytz
 import scipy
 import sys
 import os
+import configparser
 from scipy import stats
 from scipy.fft import fft, fftfreq, fftshift
 from scipy import signal        # For the  Continuous Wavelet Transform (CWT)
-from prophet import Prophet
 
 import load_metadata              # this is a module in this directory to read digital RF metadata
-
-import logging
-logging.getLogger('prophet').setLevel(logging.WARNING) 
-logger = logging.getLogger('cmdstanpy')
-logger.addHandler(logging.NullHandler())
-logger.propagate = False
-logger.setLevel(logging.CRITICAL)
-
-from pandas import DataFrame
-from pandas import to_datetime
-from pandas import Timedelta
+import channel_catalog            # this is a module in this directory to keep a catalog of channel metadata
+import product_store              # this is a module in this directory to write results as Parquet files
+import doppler_tracker            # this is a module in this directory to track the Doppler of each mode
+import chunked_tracking           # this is a module in this directory to find peaks and track in chunks on worker processes
 
 # set base directory for subsequent read operations and set up digital RF reader appropriate directory
 base_directory='./'
@@ -54,14 +52,26 @@ output_dir=os.path.join(base_directory,'output')
 
 do = drf.DigitalRFReader(data_dir)
 
-# check for four command line arguments
+# check for four command line arguments, then optional ZOOM, refines peak Doppler with a chirp-z zoom spectrum,
+# CSV, exports the results to a csv file as well as the Parquet product file, and PARALLEL, finds the peaks, and
+# with Prophet tracks the modes, in chunks of minutes on worker processes, for the same results sooner on many cores
+zoom_flag=False
+csv_flag=False
+parallel_flag=False
 n = len(sys.argv)
 if n<=4:
    print ("Rerun with channel name, frequency index and start and end times as four command line arguments")
    exit()
-if n>5:
-   print ("Rerun with channel name, frequency index and start and end times as four command line arguments")
-   exit()
+for option in sys.argv[5:]:
+   if option == 'ZOOM':
+     zoom_flag=True
+   elif option == 'CSV':
+     csv_flag=True
+   elif option == 'PARALLEL':
+     parallel_flag=True
+   else:
+     print ("Rerun with channel name, frequency index and start and end times as four command line arguments, then optional ZOOM, CSV and PARALLEL")
+     exit()
 
 # assign first three command line arguments to variables, check time span and that end time > start time + one hour
 channel=sys.argv[1]
@@ -77,48 +87,9 @@ length=int(sys.argv[4])           # in minutes
 ##########################################################
 # Data processing functions
 ##########################################################
-# local peak search: takes array index of CWF identified peak, does local search n bins either side for a true peak, returns index
-def findLocalPeak (index, radius,level):
-  # This method finds if the true local peak is to one side or other of CWF peak, and if so returns its index
-  if index < 5 or index >594:
-     return index                     # This is special case at either end near -5 and +5 Hz where we cannot search. Should not happen
-  cwf_peak=level[index]
-  for i in range (index-radius,index+radius+1):
-     if level[i] > cwf_peak:
-       index=i
-       cwf_peak=level[i]
-  return index
-
-# Interpolate between frequency bins based on the weighted linear signal level at peak and either side
-def freqInterpolate (index, radius, x, level):
-  # This method interpolates in frequency space around true local peak returning an amplitude-weighted frequency
-  if index < 5 or index >594:
-     return x[index]                      # This is special case at either end near -5 and +5 Hz where we cannot search. Should not happen
-  sum=0
-  sum_weights=0
-  for i in range (index-radius,index+radius+1):
-      sum=sum+x[i]*10**(level[i]/20)      # Convert dB level to linear
-      sum_weights=sum_weights+10**(level[i]/20)
-  freq_interp=sum/sum_weights           # Interpolated peak frequency
-  return freq_interp
-
-# QC the frequency training set
-def trainingQc (freq,level,threshold):
-  # The frequency array may have outliers, especially if the level is under parameter: level_threshold dB.
-  # This function looks for levels under the threshold, replaces with NaN, finds the median, replaces NaNs with the median
-  # and returns a frequency array QC'd in this form
-  len_in=len(freq)
-  for n in range (0,len_in):
-      if level[n] <= threshold:
-         freq[n]=np.nan
-  raw_median=np.nanmedian(freq)
-  count=np.count_nonzero(np.isnan(freq))
-  if count < 8:
-      for n in range (0,len_in):
-        if np.isnan(freq[n]):
-          freq[n]=raw_median
-  median=np.median(freq)
-  return freq,median,count
+# Ordinal name of mode k, 1st, 2nd, ... for the output columns
+def modeName (k):
+  return ['1st','2nd','3rd'][k] if k < 3 else str(k+1)+'th'
 
 ########################################
 # Main code
@@ -126,32 +97,52 @@ def trainingQc (freq,level,threshold):
 # Call module function to read in metadata, draws on data_dict code from Nathaniel Frissell 
 
 (date,freqList,s1,s0,fs,theCallsign,grid,lat,lon) = load_metadata.load_grape_drf_metadata(data_dir,channel)
+catalog=channel_catalog.load_catalog(data_dir,channel)   # continuous blocks, to find the gaps in the data
 
 delta_f_threshold= 1      # Hz  If calculated Doppler differs by more than this from previous and level below threshold run cwf with (1,4)
 level_threshold=-80       # dB  Was 50 when PSWS scaling was 65535 full scale. -80 is appropriate for 1 full scale, else we get nan
 
+# Tracker settings, defaults then any from the [tracking] section of the callsign_config.ini file
+tracker='alpha_beta'                  # alpha_beta, kalman or prophet, see doppler_tracker.py
+n_modes=2                             # number of propagation modes to track
+assignment='hungarian'                # hungarian or nearest assignment of the peaks of each minute to the modes
+tracker_settings={'gate':0.5,'level_threshold':level_threshold}
+chunk=360                             # with PARALLEL, minutes in each chunk
+overlap=60                            # and minutes each chunk's tracking starts early, to stitch onto the one before
+workers=os.cpu_count()                # and worker processes
+config_file=os.path.join(base_directory,'config',theCallsign+'_config.ini')
+config = configparser.ConfigParser()
+if os.path.isfile(config_file):
+  config.read(config_file)
+  if config.has_section('tracking'):
+    tracker=config['tracking'].get('tracker',tracker)
+    n_modes=config['tracking'].getint('modes',n_modes)
+    assignment=config['tracking'].get('assignment',assignment)
+    chunk=config['tracking'].getint('chunk',chunk)
+    overlap=config['tracking'].getint('overlap',overlap)
+    workers=config['tracking'].getint('workers',workers)
+    for key in ['gate','alpha','beta','q','r','max_coast']:
+      if config['tracking'].get(key) is not None:
+        tracker_settings[key]=config['tracking'].getfloat(key)
+if tracker not in doppler_tracker.tracker_backends or assignment not in doppler_tracker.assignment_methods:
+   print ("tracker in config file must be one of ",doppler_tracker.tracker_backends," and assignment one of ",doppler_tracker.assignment_methods)
+   exit()
+n_train=10                            # first 10 minutes are the training set, assigned to modes by level and regression
+
 # Set up constants and arrays
 Hann_factor=1.63     # This is the energy correction factor # https://community.sw.siemens.com/s/article/window-correction-factors
 samp_rate=fs         # in Hz
 time_window=60       # 60 seconds
 m_samples=int(fs*time_window)
-n_samples=int(length*m_samples+1)     # how many samples at fs to read in
-s=s0+hours_offset*3600*fs             # s0 comes from the metadata
+s=channel_catalog.utc_to_sample(catalog,date,hours_offset)   # sample at command line start time, UTC
 frequency=freqList[freq_index]        # This comes from command line argument and metadata frequency list
 
-time=np.empty(length)
-level_1st=np.empty(length)
-level_2nd=np.empty(length)
-freq_1st=np.empty(length)
-freq_2nd=np.empty(length)
-freq_2nd_threshold=np.empty(length)
-dataset=np.zeros(m_samples, dtype=complex)
-synth=np.zeros(m_samples,dtype=complex)
-residual=np.zeros(m_samples,dtype=complex)
+time=(np.arange(length)/60)+hours_offset     # time in hours
+freq_modes=np.full((length,n_modes),np.nan)  # Doppler of the peaks of each minute, highest level first
+level_modes=np.full((length,n_modes),np.nan) # NaN stays for minutes skipped as they hold a gap in the data
 
+product_filename=product_store.product_fpath('CWF_Proph',theCallsign,frequency,date)
 csv_dir=os.path.join(output_dir,'csv',theCallsign)
-if not os.path.exists(csv_dir):
-  os.makedirs(csv_dir)
 csv_filename=csv_dir+'/CWF_Proph_data_' + "_" + str(frequency) + "MHz_" + date + ".csv"    #
 
 # digital_rf read in code
@@ -161,252 +152,151 @@ do.get_channels()
 unix_time=np.int64(s/10)
 plot_start = datetime.fromtimestamp(unix_time,pytz.utc).strftime('%Y-%m-%d %H:%M:%S')
 print ("Analysis at ",plot_start)
-print ("Time,freq_max_1st,level_max_1st,freq_max_2nd,level_max_2nd")
+print ("Time,freq_max_1st,level_max_1st,freq_max_2nd,level_max_2nd ...")
 
-# get samples, these are i,q pairs. Starting at s and going on for length*10*60
-input = do.read_vector(s, n_samples, channel)
 if len(freqList) > 1: 
-  data=input[:,freq_index]
+  sub_channel=freq_index
 else:                               # single channel Grape so 1 dimensional data array
-  data=input[:]
-
-# generate the x axis, which is frequency here 
-x=fftshift(fftfreq(m_samples,1/samp_rate))
-
-# generate a Hann window of length m_samples (i.e. 600 samples)
-window = signal.windows.hann(m_samples)
-
-with open(csv_filename, 'w', encoding='UTF8',) as out_file:  # open a csv file for write, write metadata, headers
- writer=csv.writer(out_file)
- writer.writerow(["Date","Callsign","Grid","Freq (MHz)","Lat","Lon"])
- writer.writerow([date,theCallsign,grid,str(frequency),lat,lon])
- writer.writerow(["Hour","Interp Dopp 1st (Hz)","Level 1st","Pred Dopp 1st (Hz)","Pred Dopp 1st Lower (Hz)","Pred Dopp 1st Upper (Hz)",\
- "Interp Dopp 2nd (Hz)","Level 2nd","Score"])
- 
- used_narrow_count=0
-
-# Now iterate over each one minute of data to calculate frequencies and levels in 1 minute intervals
- for j in range (0,length):
-    time[j]=((j)/60)+hours_offset                               # time in hours
-    k=int(j*m_samples)
-    yf=fftshift(fft(data[k:k+m_samples],norm="forward",overwrite_x=False)*Hann_factor)     # do the FFT and fftshift moves 0 Hz to centre
-    yf=20*np.log10(np.abs(yf))                                                                     # convert to dB
+  sub_channel=None
+
+used_narrow_count=0
+narrow=np.zeros(length,dtype=bool)           # minutes that use the (1,4) peaks
 
 ######################################################################################
-# Scipy find_peaks_cwt approach using continuous wavelet transform 
+# Continuous wavelet transform peaks as scipy find_peaks_cwt, for all minutes at once, see cwt_peaks.py
 # https://docs.scipy.org/doc/scipy/reference/generated/scipy.signal.find_peaks_cwt.html
+# get samples, these are i,q pairs, starting at s, FFT all minutes at once and find the n_modes highest peaks of
+# each minute with CWT widths (2,4), empirical selection for one-hop widths, and (1,4), the narrower setting tried
+# below, then refine them, see chunked_tracking.py. Minutes with a gap in the data are NaN. With PARALLEL the
+# minutes are split into chunks on worker processes
 #######################################################################################
-
-    peakind = signal.find_peaks_cwt(yf, widths=np.arange(2,4))           # 2,4 is empirical selection for one-hop widths
-
-    # find the index at maximum level
-    max=np.argmax(yf[peakind])                                    # This is easy
-    index_max_1st=peakind[max]
-    freq_max_1st=x[index_max_1st]
-    level_max_1st=yf[index_max_1st]
-
-    level_max_2nd=-999
-    for k in peakind:      
-      level=yf[k]
-      if level>level_max_2nd:
-         if level < level_max_1st:
-           level_max_2nd=level
-
-    index_max_2nd = [i for i, value in enumerate(yf) if abs(value - level_max_2nd) < 0.02]   # an enumerate approach for a neat, pythonic solution
-    index_max_2nd=index_max_2nd[0]                                                           # returns an array i.e. list kjust need 1st element
-    freq_max_2nd=x[index_max_2nd]
-    #print (f"{time[j]:.5f},{freq_max_1st:.3f},{level_max_1st:.3f},{freq_max_2nd:.3f},{level_max_2nd:.3f}")
-
-   # For second measurement onward look at:
-   # A)  Doppler differences to previous interval. If over delta_f threshold
-   #     AND level is below level threshold, or
-   # B)  Doppler and signal level are essentially the same for 1st and 2nd
-   # try signal.find_peaks_cwt with widths (1,4) reasoning here is there may be a narrow peak, missed by (2,4) and for A) reported peak
-   # is a low level peak in the skirts and for B) the two peaks cannot be resolved with (2,4) but might with (1,4)
-    used_narrow=0       # flag to show if we have used CWF (1,4), do not look either side as a follow-on, as might latch on to 1st peak
-    if j>0:
-      if (((freq_max_1st-freq_1st[j-1]) > delta_f_threshold) and (level_max_1st<level_threshold)) or \
-         (((freq_max_2nd-freq_2nd[j-1]) > delta_f_threshold) and (level_max_2nd<level_threshold)):
-         peakind = signal.find_peaks_cwt(yf, widths=np.arange(1,4))           # try with narrower cwf setting
-         # find the index at maximum level
-         max=np.argmax(yf[peakind])                                    # This is easy
-         index_max_1st=peakind[max]
-         freq_max_1st=x[index_max_1st]
-         level_max_1st=yf[index_max_1st]
-
-         level_max_2nd=-999
-         for k in peakind:      
-           level=yf[k]
-           if level>level_max_2nd:
-              if level < level_max_1st:
-                level_max_2nd=level
-
-         index_max_2nd = [i for i, value in enumerate(yf) if abs(value - level_max_2nd) < 0.02]   # an enumerate approach for a neat, pythonic solution
-         index_max_2nd=index_max_2nd[0]                                                           # returns an array i.e. list kjust need 1st element
-         freq_max_2nd=x[index_max_2nd]
-         level_1st[j]=yf[index_max_1st]
-         level_2nd[j]=yf[index_max_2nd]
-  #       print ("Tried (1,4)",f"{time[j]:.4f},{freq_max_1st:.3f},{level_max_1st:.3f},{freq_max_2nd:.3f},{level_max_2nd:.3f}")
-         used_narrow=1
-         used_narrow_count +=1   # increment how many times we have used narrow (1,4)
- 
-  # Only if wider CWF setting of (2,4) used we look either side of peak for a true maximum level. with (1,4) risk of rlatching on to other peak   
-    if used_narrow==0:                                         
-      # Now call new function to look either side to find true peak, revise and print output
-      index_max_1st=findLocalPeak(index_max_1st,1,yf)
-      index_max_2nd=findLocalPeak(index_max_2nd,2,yf)    # try two either side for the second peak
-      freq_max_1st=float(x[index_max_1st])
-      freq_max_2nd=float(x[index_max_2nd])
-      level_1st[j]=yf[index_max_1st]
-      level_2nd[j]=yf[index_max_2nd]
-#      print (f"{freq_max_1st:.3f},{level_1st[j]:.3f},{freq_max_2nd:.3f},{level_2nd[j]:.3f}")
-      
-    # Now interpolate the true peak frequency based on linear levels either side
-    # We do this if we used narrow (1,4) or (2,4)
-    freq_1st[j]=freqInterpolate(index_max_1st,2,x,yf) 
-    freq_2nd[j]=freqInterpolate(index_max_2nd,2,x,yf) 
-#    print (f"{freq_1st[j]:.3f},{level_1st[j]:.3f},{freq_2nd[j]:.3f},{level_2nd[j]:.3f}\n")
-
-    if level_2nd[j] > level_1st[j]:               # CWT output was 1st always higher level, but either side and interp can change so reorder
-      freq_1st[j], freq_2nd[j] = freq_2nd[j], freq_1st[j]            # swap frequencies
-      level_1st[j], level_2nd[j] = level_2nd[j], level_1st[j]        # and swap levels.  Now the first set has highest levels, exit Part 1.
-    print (f"{time[j]:.5f},{freq_1st[j]:.3f},{level_1st[j]:.3f},{freq_2nd[j]:.3f},{level_2nd[j]:.3f}")
+peaks=chunked_tracking.span_peaks(data_dir,channel,catalog,s,length,m_samples,fs,sub_channel,n_modes,zoom_flag,Hann_factor,
+                                  chunk if parallel_flag else None,workers if parallel_flag else 1)
+read_ok=peaks['read_ok']
+(freq_max,level_max)=(peaks['freq_max'],peaks['level_max'])         # (2,4) peaks as found, for the tests against the previous minute
+(freq_wide,level_wide)=(peaks['freq_wide'],peaks['level_wide'])
+(freq_narrow,level_narrow)=(peaks['freq_narrow'],peaks['level_narrow'])
+
+# Now iterate over each one minute of data to choose the setting, as it depends on the previous minute
+for j in range(0,length):
+   if not read_ok[j]:
+     continue
+
+  # For second measurement onward look at:
+  # A)  Doppler differences to previous interval. If over delta_f threshold
+  #     AND level is below level threshold, for any of the peaks, or
+  # B)  Doppler and signal level are essentially the same for 1st and 2nd
+  # use the peaks of find_peaks_cwt with widths (1,4) reasoning here is there may be a narrow peak, missed by (2,4) and for A) reported peak
+  # is a low level peak in the skirts and for B) the two peaks cannot be resolved with (2,4) but might with (1,4)
+   if j>0 and np.any(((freq_max[j]-freq_modes[j-1]) > delta_f_threshold) & (level_max[j]<level_threshold)):
+     (freq_modes[j],level_modes[j])=(freq_narrow[j],level_narrow[j])
+     narrow[j]=True
+     used_narrow_count +=1   # increment how many times we have used narrow (1,4)
+   else:
+     (freq_modes[j],level_modes[j])=(freq_wide[j],level_wide[j])
+   print (f"{time[j]:.5f},"+",".join(f"{freq_modes[j,k]:.3f},{level_modes[j,k]:.3f}" for k in range(0,n_modes)))
 
 ###### End of the For loop every minute of data, now have data as arrays
-   
- print("Narrow setting count: ", used_narrow_count)
-# The second peak may be low level, insufficient SNR, and a poor Doppler, if below set threshold set to NaN  
- for m in range(0,length):
-      if level_2nd[m] <= level_threshold:
-         freq_2nd_threshold[m]=np.nan
-      else:
-         freq_2nd_threshold[m]=freq_2nd[m]
+
+# Optionally replace the interpolated peak Doppler with the maximum of a chirp-z zoom spectrum of +/- one FFT bin
+# around it, 101 frequencies at 1/3 mHz spacing, computed for all minutes in one batch with the peaks
+if zoom_flag:
+   freq_modes[read_ok]=np.where(narrow[:,np.newaxis],peaks['zoom_narrow'],peaks['zoom_wide'])[read_ok]
+   print("Peak Doppler refined by zoom spectrum")
+  
+print("Narrow setting count: ", used_narrow_count)
+# The second and later peaks may be low level, insufficient SNR, and a poor Doppler, if below set threshold set to NaN
+freq_modes[:,1:][level_modes[:,1:] <= level_threshold]=np.nan
 #
 ######################################################
 # plot so far, i.e. with widths (2,4) and interpolated
 ###################################################### 
- plot_dir=os.path.join(output_dir,'plots',theCallsign)   # plots go into a subdirectory by callsign
- if not os.path.exists(plot_dir):
-    os.makedirs(plot_dir)
-
- fig1=plt.figure()     # plot the two rays
- plt.suptitle("Doppler sets A and B by amplitude " + theCallsign + " at " + str(frequency) + " MHz", fontsize=12)
- xaxis_title="Time on " + date + " (hours UTC)"
-
-# host = fig1.add_axes([0.15, 0.1, 0.8, 0.5], axes_class=HostAxes)
- dot_size_1st=((level_1st-level_threshold)*0.05)**2
- dot_size_2nd=((level_2nd-level_threshold)*0.065)**2  # scaling pair in that ratio needed to make  high and Low ray dot size match for first data point, same levels
-   
- plt.scatter(time, freq_1st, facecolors='none', edgecolors='k', s=dot_size_1st)
- print(len(time),len(freq_2nd_threshold))
- plt.scatter(time, freq_2nd_threshold, marker='.', s=dot_size_2nd, color='blue')
-# plt.axis([14.3,15.5,-0.2,0.8])
- plt.xlabel(xaxis_title)
- plt.ylabel("Doppler shift (Hz)")
- plt.gcf().set_size_inches(8, 3, forward=True)
- plt.tight_layout()
- plt.savefig(plot_dir +"/CWF_Proph_Raw" + "_" + str(frequency) + "MHz_" + date + ".png", dpi=600)
- plt.show()
+plot_dir=os.path.join(output_dir,'plots',theCallsign)   # plots go into a subdirectory by callsign
+if not os.path.exists(plot_dir):
+   os.makedirs(plot_dir)
+
+mode_colors=['blue','red','green','orange','purple']   # for the second and later modes, black open circles for the first
+def plotModes (freq,level):
+  # scaling pair 0.05 and 0.065 in that ratio needed to make high and Low ray dot size match for first data point, same levels
+  plt.scatter(time, freq[:,0], facecolors='none', edgecolors='k', s=((level[:,0]-level_threshold)*0.05)**2)
+  for k in range(1,n_modes):
+    plt.scatter(time, freq[:,k], marker='.', s=((level[:,k]-level_threshold)*0.065)**2, color=mode_colors[(k-1)%len(mode_colors)])
+  plt.xlabel(xaxis_title)
+  plt.ylabel("Doppler shift (Hz)")
+  plt.gcf().set_size_inches(8, 3, forward=True)
+  plt.tight_layout()
+
+fig1=plt.figure()     # plot the rays
+plt.suptitle("Doppler sets by amplitude " + theCallsign + " at " + str(frequency) + " MHz", fontsize=12)
+xaxis_title="Time on " + date + " (hours UTC)"
+plotModes(freq_modes,level_modes)
+plt.savefig(plot_dir +"/CWF_Proph_Raw" + "_" + str(frequency) + "MHz_" + date + ".png", dpi=600)
+plt.show()
 
 ##################
 #  Automatically form a training set using linear regression and test residuals one by onw.
 ##################
-# perform the initial regression on freq_1st against time
-res = stats.linregress(time[0:10],freq_1st[0:10])
-# Now go through each freq_1st to see if its residual is smaller than for the freq_2nd, if it is, swap, then recalculate
-for j in range(0,10):
-#   print (f"{time[j]:.5f},{freq_1st[j]:.3f},{level_1st[j]:.3f},{freq_2nd[j]:.3f},{level_2nd[j]:.3f}")
-   residual_initial=abs(freq_1st[j]-(res.slope*time[j]+res.intercept))
-   freq_1st_hold=freq_1st[j]
-   freq_1st[j]=freq_2nd_threshold[j]                                 # try a swap of 2nd and 1st
-   residual_swapped=abs(freq_1st[j]-(res.slope*time[j]+res.intercept))
-#   print("slope, intercept, residual init, residual swapped",res.slope,res.intercept,residual_initial, residual_swapped)
-   if residual_swapped < residual_initial:
-      print ("Swapping")
-      freq_2nd_threshold[j]=freq_1st_hold                            # we already swapped freq_2nd into 1st, here swap 1st into 2nd
-      level_1st[j], level_2nd[j] = level_2nd[j], level_1st[j]        # and swap levels
-   else:
-     freq_1st[j]=freq_1st_hold                                       # revert 1st that we had swapped for 2nd
+# perform the initial regression on the 1st peak against time
+# Now go through each 1st peak to see if its residual is smaller than for the 2nd, if it is, swap
+if n_modes > 1:
+  res = stats.linregress(time[0:n_train],freq_modes[0:n_train,0])
+  for j in range(0,n_train):
+     residual_initial=abs(freq_modes[j,0]-(res.slope*time[j]+res.intercept))
+     residual_swapped=abs(freq_modes[j,1]-(res.slope*time[j]+res.intercept))
+     if residual_swapped < residual_initial:
+        print ("Swapping")
+        freq_modes[j,[0,1]]=freq_modes[j,[1,0]]        # swap 2nd into 1st and 1st into 2nd
+        level_modes[j,[0,1]]=level_modes[j,[1,0]]      # and swap levels
 
 ##########################################################################################
-# Facebook Prophet as predictor for one step ahead
+# Track each mode one step ahead from the training set, see doppler_tracker.py
 #########################################################################################
-
-#t=np.reshape(time,(len(time),1))  # So that len(t) is (*,1) and len(weighted_1st.shape) is (*,)   # X and Y have different array directions
-
-with open(csv_filename, 'a', encoding='UTF8',) as out_file:  # open the csv file to write to
- writer=csv.writer(out_file)
-
- for j in range(0,10):                                   # Print out the training set
-  print (f"{time[j]:.5f},{freq_1st[j]:.3f},{level_1st[j]:.3f},{freq_2nd_threshold[j]:.3f},{level_2nd[j]:.3f}")
-  writer.writerow([time[j],freq_1st[j],level_1st[j],-999,-999,-999,freq_2nd_threshold[j],level_2nd[j]])
-
-# Now use the Prophet prediction one step ahead
- for j in range (10,length):       # First 10 i.e. (0-9) is the training set, manually checked and assigned to the two rays
-  score=0
-  
-  (training, median, count)=trainingQc(freq_1st[j-10:j], level_1st[j-10:j],level_threshold)    # GG function to perform QC sub with median if level 50 or below
-#  print("Training QC: ",time[j],median,count)   # diagnostic print median and count of level <=level_threshold, that is nan substituted with median
-#  print (training)
-  
-  df = DataFrame({'ds': time[j-10: j]*3600*1e9, 'y': training})
-  df['ds']= to_datetime(df['ds'])
-#  print (df)
-  prediction_time=df['ds'].iloc[-1] + Timedelta(minutes=3)  # Required prediction is one time slot ahead, but Prophet looks lagged, so try three
-#  print (prediction_time)
-
-# define the model
-  model = Prophet()
-# fit the model
-  model.fit(df)
-
-# define the period for which we want a prediction
-  future = list()
-  future.append([prediction_time])
-  future = DataFrame(future)
-  future.columns = ['ds']
-  future['ds']= to_datetime(future['ds'])
-
-# use the model to make a forecast
-  forecast = model.predict(future)
-# summarize the forecast
-#  print(forecast[['ds', 'yhat', 'yhat_lower', 'yhat_upper']].head())
-
-#  exit()
-  f_1st_pred=forecast['yhat'].iloc[-1]   # copy from pandas dataframe
-  f_1st_pred_l=forecast['yhat_lower'].iloc[-1]   # lower limit
-  f_1st_pred_u=forecast['yhat_upper'].iloc[-1]   # upper limit
-
-
-  if np.abs(f_1st_pred-freq_1st[j])>np.abs(f_1st_pred-freq_2nd_threshold[j]):  # suggests need to swap, increment score
-     score =score +1
-  if score >0:                                                         # try this...
-    freq_1st[j], freq_2nd_threshold[j] = freq_2nd_threshold[j], freq_1st[j]                # bigger difference for 1st, swap 1st and 2nd
-    level_1st[j], level_2nd[j] = level_2nd[j], level_1st[j]            # bigger difference for 1st, swap 1st and 2nd
-  print (f"{time[j]:.5f},{freq_1st[j]:.3f},{level_1st[j]:.3f},{f_1st_pred:.3f},{f_1st_pred_l:.3f},{f_1st_pred_u:.3f},{freq_2nd_threshold[j]:.3f},{level_2nd[j]:.3f}, {median:.3f},{count:.0f}")
-  writer.writerow([time[j],freq_1st[j],level_1st[j],f_1st_pred,f_1st_pred_l,f_1st_pred_u,freq_2nd_threshold[j],level_2nd[j],score])
+# With PARALLEL and Prophet, about a second a minute for each mode, in chunks on worker processes stitched at the
+# overlaps, see chunked_tracking.py. The filters take microseconds a minute so track the whole span in this process
+if parallel_flag and tracker == 'prophet':
+  (freq_track,level_track,pred,pred_lower,pred_upper,swapped)=chunked_tracking.track_chunks(time,freq_modes,level_modes,n_modes,tracker,
+                                                              assignment,n_train,chunk,overlap,workers,**tracker_settings)
+else:
+  (freq_track,level_track,pred,pred_lower,pred_upper,swapped)=doppler_tracker.track_modes(time,freq_modes,level_modes,n_modes,tracker,
+                                                                                           assignment,n_train,**tracker_settings)
+scores=np.where(np.arange(length) < n_train,np.nan,swapped.astype(float))   # 1 where peaks were not assigned in level order, NaN for the training set
+
+for j in range(0,length):     # Print out the training set then the tracked modes with their predictions
+  print (f"{time[j]:.5f},"+",".join(f"{freq_track[j,k]:.3f},{level_track[j,k]:.3f},{pred[j,k]:.3f}" for k in range(0,n_modes)))
+
+# Write all the results at once to the Parquet product file, and the csv file if asked for, before the level threshold
+columns={}
+for k in range(0,n_modes):
+  name=modeName(k)
+  columns.update({'doppler_'+name:freq_track[:,k],'level_'+name:level_track[:,k],'pred_doppler_'+name:pred[:,k],
+                  'pred_doppler_'+name+'_lower':pred_lower[:,k],'pred_doppler_'+name+'_upper':pred_upper[:,k]})
+columns['score']=scores
+product_store.write_product(product_filename,time,columns,date,theCallsign,frequency,grid,lat,lon,
+                            {'zoom':int(zoom_flag),'tracker':tracker,'assignment':assignment,'modes':n_modes})
+print("CWT tracking product saved to ",product_filename)
+
+if csv_flag:
+  if not os.path.exists(csv_dir):
+    os.makedirs(csv_dir)
+  with open(csv_filename, 'w', encoding='UTF8',) as out_file:  # open a csv file for write, write metadata, headers then data rows
+    writer=csv.writer(out_file)
+    writer.writerow(["Date","Callsign","Grid","Freq (MHz)","Lat","Lon"])
+    writer.writerow([date,theCallsign,grid,str(frequency),lat,lon])
+    # as the earlier two mode layout, predictions for the 1st mode only, then the Doppler and level of the other modes
+    writer.writerow(["Hour","Interp Dopp 1st (Hz)","Level 1st","Pred Dopp 1st (Hz)","Pred Dopp 1st Lower (Hz)","Pred Dopp 1st Upper (Hz)"]+\
+    sum([["Interp Dopp "+modeName(k)+" (Hz)","Level "+modeName(k)] for k in range(1,n_modes)],[])+["Score"])
+    others=lambda j: sum([[freq_track[j,k],level_track[j,k]] for k in range(1,n_modes)],[])
+    # training set rows as before have -999 for the prediction and no score
+    writer.writerows([[time[j],freq_track[j,0],level_track[j,0],-999,-999,-999]+others(j) for j in range(0,min(n_train,length))])
+    writer.writerows([[time[j],freq_track[j,0],level_track[j,0],pred[j,0],pred_lower[j,0],pred_upper[j,0]]+others(j)+[int(scores[j])]
+                      for j in range(n_train,length)])
 
 # I'll set a signal level threshold of level_threshold dB for accepting one-hop and credible Doppler, else set value  np.nan
-for i in range (0,length):
-  if level_1st[i]< level_threshold:
-     freq_1st[i]=np.nan
-  if level_2nd[i]< level_threshold:
-     freq_2nd_threshold[i]=np.nan
-
-fig2=plt.figure()     # plot the two rays
-plt.suptitle("Doppler sets A and B Assigned " + theCallsign + " at " + str(frequency) + " MHz", fontsize=12)
-
-#host = fig2.add_axes([0.15, 0.1, 0.8, 0.5], axes_class=HostAxes)
-
-plt.scatter(time, freq_1st, facecolors='none', edgecolors='k', s=dot_size_1st)
-plt.scatter(time, freq_2nd_threshold, marker='.', s=dot_size_2nd, color='blue')
-
-#plt.axis([14.3,15.5,-0.2,0.8])
-plt.xlabel(xaxis_title)
-plt.ylabel("Doppler shift (Hz)")
-plt.gcf().set_size_inches(8, 3, forward=True)
-plt.tight_layout()
+freq_track[level_track < level_threshold]=np.nan
 
+fig2=plt.figure()     # plot the rays
+plt.suptitle("Doppler sets Assigned " + theCallsign + " at " + str(frequency) + " MHz", fontsize=12)
+plotModes(freq_track,level_track)
 plt.savefig(plot_dir +"/CWF_Proph_Assigned" + "_" + str(frequency) + "MHz_" + date + ".png", dpi=600)
 
 plt.show()
@@ -0,0 +1,220 @@
+# Program to read in the metadata and IQ data from a Grape receiver in digital_rf format
+# Extracts the Doppler of N propagation modes as the N best ridges through the one minute FFT spectrogram by dynamic
+# programming (Viterbi), each a continuous trace of high level, see doppler_ridges.py. An alternative to the minute
+# by minute CWT peak finding and tracking of grape_fft_CWT_tracking_prophet.py, steadier through fades and gaps
+# See https://github.com/MITHaystack/digital_rf/blob/master/docs/DigitalRF2.0.pdf for digital_rf stuff
+# Data for the examples in this folder are in channels ch0_Callsign in this directory:
+# ch0_G4HZX is G4HZX    29 March 2025 partial eclipse use 15 MHz
+# ch1_W2NAF is W2NAF     8 April 2024 use 25 MHz
+# ch2_N8GA is N8GA      26 July 2024 use 10 MHz
+
+# Script needs four command line arguments:
+# 1. Directory to process                     2. Index of array of frequency to plot
+# 3. Start time decimal hours UTC             4. Duration in minutes
+#     e.g. python3 grape_fft_ridges.py ch0_W2NAF 8 14.4 80
+# Optional --modes gives the number of ridges, --synth the name of a synthspec.py output in output/csv/callsign,
+# without _synthspec.csv, to overlay and compare with, and --csv also exports the results to a csv file
+#     e.g. python3 grape_fft_ridges.py ch0_G4HZX 6 8 300 --modes 3 --synth G4HZX_2025-03-29 --csv
+# Results go to a Parquet product file, see product_store.py. Ridge settings, e.g. max_step or penalty, go in the
+# optional [ridges] section of config/callsign_config.ini, see config/G4HZX_config.ini
+
+import digital_rf as drf
+import numpy as np
+import pylab as plt
+import csv                      # to write csv file for plotting and comparison in Excel
+from datetime import datetime
+import pytz
+import sys
+import os
+import configparser
+
+import load_metadata              # this is a module in this directory to read digital RF metadata
+import channel_catalog            # this is a module in this directory to keep a catalog of channel metadata
+import spectrogram_archive        # this is a module in this directory for the archive of one minute spectrograms
+import spectrogram_render         # this is a module in this directory to draw spectrograms as contours or raster
+import product_store              # this is a module in this directory to write results as Parquet files
+import doppler_ridges             # this is a module in this directory to extract Doppler ridges by dynamic programming
+
+# set base directory for subsequent read operations and set up digital RF reader appropriate directory
+base_directory='./'
+data_dir=os.path.join(base_directory,'data','psws_grapeDRF')
+output_dir=os.path.join(base_directory,'output')
+
+do = drf.DigitalRFReader(data_dir)
+
+# check for four command line arguments, then optional --modes with a number, --synth with a file name and --csv
+n_ridges=None
+synth_name=None
+csv_flag=False
+n = len(sys.argv)
+if n<=4:
+   print ("Rerun with channel name, frequency index, start time and duration in minutes as four command line arguments, then optional --modes number, --synth name and --csv")
+   exit()
+i=5
+while i < n:
+   if sys.argv[i] == '--modes' and i+1 < n:
+     n_ridges=int(sys.argv[i+1])
+     i+=2
+   elif sys.argv[i] == '--synth' and i+1 < n:
+     synth_name=sys.argv[i+1]
+     i+=2
+   elif sys.argv[i] == '--csv':
+     csv_flag=True
+     i+=1
+   else:
+     print ("Rerun with channel name, frequency index, start time and duration in minutes as four command line arguments, then optional --modes number, --synth name and --csv")
+     exit()
+
+# assign first four command line arguments to variables
+channel=sys.argv[1]
+freq_index=int(sys.argv[2])       # Get index from metadata frequency list e.g. use grape_digital_RF_metadata.py or inspect PSWS spectrogram
+hours_offset=float(sys.argv[3])   # Start time for data input and plot
+
+if hours_offset < 0 or hours_offset > 23:
+   print ("Start time (hours) must be between 0 and 23")
+   exit()
+
+length=int(sys.argv[4])           # in minutes
+
+# Ordinal name of mode k, 1st, 2nd, ... for the output columns, as grape_fft_CWT_tracking_prophet.py
+def modeName (k):
+  return ['1st','2nd','3rd'][k] if k < 3 else str(k+1)+'th'
+
+################################################
+# Get metadata then set up constants and arrays
+################################################
+# Call module function to read in metadata, draws on data_dict code from Nathaniel Frissell
+(date,freqList,s1,s0,fs,theCallsign,grid,lat,lon) = load_metadata.load_grape_drf_metadata(data_dir,channel)
+catalog=channel_catalog.load_catalog(data_dir,channel)   # continuous blocks, to find the gaps in the data
+
+# Ridge settings, defaults then any from the [ridges] section of the callsign_config.ini file
+modes=2                   # number of ridges, one per propagation mode
+max_step=6                # bins, largest change of Doppler from one minute to the next, 1/60 Hz bins of the one minute FFT
+penalty=0.1               # dB per bin squared, the cost of each step against the level gained
+guard=3                   # bins either side of each ridge closed to the ridges after it
+min_snr=6                 # dB above the median level of the minute for a ridge to give a Doppler, else NaN
+config_file=os.path.join(base_directory,'config',theCallsign+'_config.ini')
+config = configparser.ConfigParser()
+if os.path.isfile(config_file):
+  config.read(config_file)
+  u_dopp_lim=config['plots'].getfloat('u_dopp_lim')
+  l_dopp_lim=config['plots'].getfloat('l_dopp_lim')
+  render=config['plots'].get('render','contour')  # contour, raster or preview, see spectrogram_render.py
+  color_map=config['plots'].get('color_map')
+  if config.has_section('ridges'):
+    modes=config['ridges'].getint('modes',modes)
+    max_step=config['ridges'].getint('max_step',max_step)
+    penalty=config['ridges'].getfloat('penalty',penalty)
+    guard=config['ridges'].getint('guard',guard)
+    min_snr=config['ridges'].getfloat('min_snr',min_snr)
+else:
+  print("No configuration file for the callsign in channel ", channel, "Look in ./config directory for examples and create one for this call")
+  sys.exit()
+if n_ridges is None:
+  n_ridges=modes
+if render not in spectrogram_render.render_modes:
+   print ("render in config file must be one of ",spectrogram_render.render_modes)
+   exit()
+
+time_window=60                        # 60 seconds of data for each FFT, i.e. each vertical 'line' in spectrogram
+m_samples=int(fs*time_window)         # Number of samples in time window, fs is from metadata, the sample rate
+frequency=freqList[freq_index]        # This comes from command line argument and metadata frequency list
+s=channel_catalog.utc_to_sample(catalog,date,hours_offset)   # sample at command line start time, UTC
+s=s-(s % m_samples)                   # on the minute, as the spectrogram archive
+hours_offset=float((s-channel_catalog.utc_to_sample(catalog,date))/fs/3600)
+time=(np.arange(length)/60)+hours_offset     # time in hours
+
+product_filename=product_store.product_fpath('Ridges',theCallsign,frequency,date)
+csv_dir=os.path.join(output_dir,'csv',theCallsign)
+csv_filename=csv_dir+'/Ridges_data_' + "_" + str(frequency) + "MHz_" + date + ".csv"
+
+unix_time=np.int64(s/10)
+plot_start = datetime.fromtimestamp(unix_time,pytz.utc).strftime('%Y-%m-%d %H:%M:%S')
+print ("Analysis at ",plot_start)
+
+########################################
+# Spectrogram from the archive of one minute spectrograms, computing and adding only the minutes not there yet
+########################################
+n_new=spectrogram_archive.update_minutes(do,catalog,channel,freq_index,s,length)
+print ("Minutes added to spectrogram archive ",n_new)
+(yf,zf_dB)=spectrogram_archive.read_minutes(catalog,channel,freq_index,s,length)
+levels=zf_dB.T                        # (minutes x frequency bins), NaN rows for the gaps
+
+########################################
+# Ridges within the plotted Doppler band
+########################################
+allowed=np.broadcast_to((yf >= l_dopp_lim) & (yf <= u_dopp_lim),levels.shape)
+(index,scores)=doppler_ridges.extract_ridges(levels,n_ridges,max_step,penalty,guard,allowed)
+(freq_ridge,level_ridge)=doppler_ridges.ridge_series(levels,index,yf,min_snr)
+print ("Ridge scores (dB) ",", ".join(f"{score:.1f}" for score in scores))
+
+print ("Time,"+",".join(f"doppler_{modeName(k)},level_{modeName(k)}" for k in range(0,n_ridges)))
+for j in range(0,length):
+  print (f"{time[j]:.5f},"+",".join(f"{freq_ridge[j,k]:.3f},{level_ridge[j,k]:.3f}" for k in range(0,n_ridges)))
+
+# Write all the results at once to the Parquet product file, and the csv file if asked for
+columns={}
+for k in range(0,n_ridges):
+  columns.update({'doppler_'+modeName(k):freq_ridge[:,k],'level_'+modeName(k):level_ridge[:,k]})
+product_store.write_product(product_filename,time,columns,date,theCallsign,frequency,grid,lat,lon,
+                            {'modes':n_ridges,'max_step':max_step,'penalty':penalty,'guard':guard,'min_snr':min_snr})
+print("Ridge product saved to ",product_filename)
+
+if csv_flag:
+  if not os.path.exists(csv_dir):
+    os.makedirs(csv_dir)
+  with open(csv_filename, 'w', encoding='UTF8',) as out_file:  # open a csv file for write, write metadata, headers then data rows
+    writer=csv.writer(out_file)
+    writer.writerow(["Date","Callsign","Grid","Freq (MHz)","Lat","Lon"])
+    writer.writerow([date,theCallsign,grid,str(frequency),lat,lon])
+    writer.writerow(["Hour"]+sum([["Dopp "+modeName(k)+" (Hz)","Level "+modeName(k)] for k in range(0,n_ridges)],[]))
+    writer.writerows([[time[j]]+sum([[freq_ridge[j,k],level_ridge[j,k]] for k in range(0,n_ridges)],[]) for j in range(0,length)])
+
+# Synthetic Doppler of each mode from synthspec.py, to overlay, and each ridge's rms difference from its closest mode
+synth={}
+if synth_name is not None:
+  synth_filename=csv_dir+'/'+synth_name+'_synthspec.csv'
+  if os.path.isfile(synth_filename):
+    synth=doppler_ridges.read_synthspec(synth_filename,date)
+    print ("Ridge,mode,rms difference (Hz),minutes compared")
+    for (k,(mode,rms,count)) in enumerate(doppler_ridges.compare_synthspec(time,freq_ridge,synth)):
+      print (f"{modeName(k)},{mode},{rms:.3f},{count}")
+  else:
+    print ("No synthspec file ",synth_filename)
+
+##########################################
+# now plot the ridges over the spectrogram, annotate and save
+##########################################
+plot_dir=os.path.join(output_dir,'plots',theCallsign)   # plots go into a subdirectory by callsign
+if not os.path.exists(plot_dir):
+  os.makedirs(plot_dir)
+
+# Levels from the PSD histograms stored with the archive, as grape_fft_spectrogram.py
+counts=spectrogram_archive.read_histogram(catalog,channel,freq_index,s,length)
+min_level=np.floor(spectrogram_archive.histogram_percentile(counts,10))  # 10% as min, to reduce background shading
+max_level=np.ceil(spectrogram_archive.histogram_percentile(counts,99.9))+3
+contour_levels=np.arange(min_level,max_level+6,3)
+
+fig, ax= plt.subplots()
+cs=spectrogram_render.plot_spectrogram(ax,time,yf,zf_dB,contour_levels,color_map,render)
+mode_colors=['k','blue','red','green','orange','purple']
+for k in range(0,n_ridges):
+  plt.plot(time,freq_ridge[:,k],color=mode_colors[k % len(mode_colors)],linewidth=1,label="Ridge "+modeName(k))
+for mode in synth:
+  (hours,doppler,color)=synth[mode]
+  plt.scatter(hours,doppler,s=4,color=color,label="Synth "+mode)
+
+plt.suptitle("Doppler ridges " + theCallsign + " at " + str(frequency) + " MHz")
+plt.xlabel("Time on " + date + " (hours UTC)")
+plt.ylabel("Doppler shift (Hz)")
+plt.gcf().set_size_inches(12, 4.5, forward=True)
+plt.xlim(time[0],time[-1])
+plt.ylim(l_dopp_lim,u_dopp_lim)
+plt.legend(loc='upper right',fontsize=8)
+cbar = fig.colorbar(cs)
+cbar.set_label("PSD uncalibrated (dB)", rotation=270, labelpad=25)
+plt.tight_layout()
+
+plt.savefig(spectrogram_render.save_fpath(plot_dir + "/Ridges" + "_" + str(frequency) + "MHz_" + date + ".png",render), dpi=spectrogram_render.render_dpi[render])
+print("Ridge plot saved")
+plt.show()
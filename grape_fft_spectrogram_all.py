@@ -0,0 +1,121 @@
+# Program to plot the spectrograms of all the center frequencies of a Grape receiver in digital_rf format in one pass
+# As grape_fft_spectrogram.py, but each hour of IQ data is read once for all frequencies and transformed in one
+# batched FFT, rather than one run of grape_fft_spectrogram.py per frequency re-reading the same data.
+# Spectrograms go into the spectrogram archive (see spectrogram_archive.py), so minutes already there are not
+# computed again, then a plot is saved for every frequency.
+
+# Script needs three command line arguments:
+# 1. Directory to process 2. Start time in hour 3. Stop time in hour
+#     e.g. python3 grape_fft_spectrogram_all.py ch0_G4HZX 8 13
+
+import numpy as np
+import matplotlib as mpl
+import pylab as plt
+import digital_rf as drf
+import sys
+import os
+import configparser
+
+import load_metadata              # this is a module in this directory to read digital RF metadata
+import channel_catalog            # this is a module in this directory to keep a catalog of channel metadata
+import spectrogram_archive        # this is a module in this directory for the archive of one minute spectrograms
+import spectrogram_render         # this is a module in this directory to draw spectrograms as contours or raster
+
+# set base directory for subsequent read operations and set up digital RF reader appropriate directory
+base_directory='./'
+data_dir=os.path.join(base_directory,'data','psws_grapeDRF')
+output_dir=os.path.join(base_directory,'output')
+
+do = drf.DigitalRFReader(data_dir)
+
+# check for three command line arguments
+n = len(sys.argv)
+if n != 4:
+   print ("Rerun with channel name and start and stop hours as three command line arguments")
+   exit()
+
+channel=sys.argv[1]
+hours_offset=int(sys.argv[2])  # Start time for data input and plot
+
+if hours_offset < 0 or hours_offset > 23:
+   print ("Start time (hours) must be between 0 and 23")
+   exit()
+
+if (float(sys.argv[3])-float(sys.argv[2])) <1:
+   print ("Stop time must be at least one hour greater than start time")
+   exit()
+
+################################################
+# Get metadata then set up constants and arrays
+################################################
+(date,freqList,s1,s0,fs,theCallsign,grid,lat,lon) = load_metadata.load_grape_drf_metadata(data_dir,channel)
+catalog=channel_catalog.load_catalog(data_dir,channel)   # continuous blocks, to find the gaps in the data
+s_day=channel_catalog.utc_to_sample(catalog,date)         # sample at 00:00 UTC, s0 is later if data starts late
+
+# get parameters from the callsign_config.ini file
+config_dir=os.path.join(base_directory,'config')
+config_file=config_dir + '/' + theCallsign + '_config.ini'
+config = configparser.ConfigParser()
+
+if os.path.isfile(config_file):
+  config.read(config_file)
+  u_dopp_lim=config['plots'].getfloat('u_dopp_lim')
+  l_dopp_lim=config['plots'].getfloat('l_dopp_lim')
+  render=config['plots'].get('render','contour')  # contour, raster or preview, see spectrogram_render.py
+  color_map=config['plots'].get('color_map')  # values include Greys,
+else:
+  print("No configuration file for the callsign in channel ", channel, "Look in ./config directory for examples and create one for this call")
+  sys.exit()
+
+if render not in spectrogram_render.render_modes:
+   print ("render in config file must be one of ",spectrogram_render.render_modes)
+   exit()
+
+# Check sensible and available command line start and stop times
+if int(sys.argv[3]) >= ((s1-s_day)/10)/3600:
+   print ("End time specified beyond end of data set: Reading to last sample in data set")
+   length=int(np.floor(((((s1-s_day)/10)/3600)-hours_offset)*60))    # calculate length of data in minutes
+else:
+   length=int(np.floor((int(sys.argv[3])-hours_offset)*60))    # calculate length of data in minutes to be sure in data set
+
+print("Length of selected period ",length, " minutes")
+
+s=channel_catalog.utc_to_sample(catalog,date,hours_offset)   # sample at command line start time, UTC
+
+########################################
+# FFT processing, all frequencies in one pass
+########################################
+n_new=spectrogram_archive.update_minutes_all(do,catalog,channel,s,length)
+print ("Minutes added to spectrogram archive ",n_new)
+
+##########################################
+# now plot, annotate and save each frequency
+##########################################
+plot_dir=os.path.join(output_dir,'plots',theCallsign)   # plots go into a subdirectory by callsign
+if not os.path.exists(plot_dir):
+  os.makedirs(plot_dir)
+xaxis_title="Time on " + date + " (hours UTC)"
+
+for freq_index in range(0,len(freqList)):
+  frequency=freqList[freq_index]
+  (yf,zf_dB)=spectrogram_archive.read_minutes(catalog,channel,freq_index,s,length)
+  x=np.linspace(hours_offset,hours_offset+np.ceil(length/60), zf_dB.shape[1])
+
+  plot_title="Doppler shift at " + theCallsign + " at " + str(frequency) + " MHz"
+
+  # Autoscale for PSD Y axis from the PSD histograms in the archive, as grape_fft_spectrogram.py
+  counts=spectrogram_archive.read_histogram(catalog,channel,freq_index,s,length)
+  if counts.sum() == 0:
+    print ("No data for ",frequency," MHz in the selected period")
+    continue
+  min_level=np.floor(spectrogram_archive.histogram_percentile(counts,10))  # 10% as min, to reduce background shading
+  max_level=np.ceil(spectrogram_archive.histogram_percentile(counts,99.9))+3
+  levels=np.arange(min_level,max_level+6,3)
+
+  # Contour plot, label, get colorbar and label, the same figure as grape_fft_spectrogram.py
+  (fig,ax)=spectrogram_render.doppler_figure(x,yf,zf_dB,levels,plot_title,xaxis_title,(hours_offset,hours_offset+np.ceil(length/60)),
+                                             (l_dopp_lim,u_dopp_lim),color_map,render)
+
+  plt.savefig(spectrogram_render.save_fpath(plot_dir + "/Spectrogram" + "_" + str(frequency) + "MHz_" + date + ".png",render), dpi=spectrogram_render.render_dpi[render])
+  plt.close(fig)
+  print("PSWS Spectrogram saved for ",frequency," MHz")
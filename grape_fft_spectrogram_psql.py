@@ -20,8 +20,6 @@ import digital_rf as drf
 import numpy as np
 import matplotlib as mpl
 import pylab as plt
-from scipy.fft import fft, fftfreq, fftshift
-from scipy import signal
 from datetime import datetime, timedelta
 import pytz
 import sys
@@ -29,6 +27,11 @@ import os
 import configparser
 
 import load_metadata              # this is a module in this directory to read digital RF metadata
+import channel_catalog            # this is a module in this directory to keep a catalog of channel metadata
+import spectrogram_engine         # this is a module in this directory for the batched FFT spectrogram
+import drf_reader                 # this is a module in this directory to read IQ data a block at a time
+import spectrogram_archive        # this is a module in this directory for the archive of one minute spectrograms
+import spectrogram_render         # this is a module in this directory to draw spectrograms as contours or raster
 
 # set base directory for subsequent read operations and set up digital RF reader appropriate directory
 base_directory='./'
@@ -68,27 +71,48 @@ if (float(sys.argv[4])-float(sys.argv[3])) <1:
 ################################################
 # Call module function to read in metadata, draws on data_dict code from Nathaniel Frissell 
 (date,freqList,s1,s0,fs,theCallsign,grid,lat,lon) = load_metadata.load_grape_drf_metadata(data_dir,channel)
+catalog=channel_catalog.load_catalog(data_dir,channel)   # continuous blocks, to find the gaps in the data
+s_day=channel_catalog.utc_to_sample(catalog,date)         # sample at 00:00 UTC, s0 is later if data starts late
 
 ################################################
 # get parameters from the callsign_config.ini file
 config_dir=os.path.join(base_directory,'config')
 config_file=config_dir + '/' + theCallsign + '_config.ini'
 config = configparser.ConfigParser()
+stft_hop=60                 # seconds between the start of successive FFTs, default no overlap
+stft_nfft=None              # FFT length, None is one per sample in the time window
+stft_window='hann'          # window type, Hann_factor below is for Hann
+zoom_band=None              # Doppler band (Hz) for a chirp-z zoom spectrogram, None is the full FFT
+zoom_bins=1200              # number of frequencies across zoom_band
 
 if os.path.isfile(config_file):
   config.read(config_file)
   u_dopp_lim=config['plots'].getfloat('u_dopp_lim')
   l_dopp_lim=config['plots'].getfloat('l_dopp_lim')
   legend_loc=config['plots'].get('legend')
+  if config.has_section('spectrogram'):          # optional short time FFT settings, see config/G4HZX_config.ini
+    stft_hop=config['spectrogram'].getfloat('hop',stft_hop)
+    stft_nfft=config['spectrogram'].getint('nfft',stft_nfft)
+    stft_window=config['spectrogram'].get('window',stft_window)
+    if config['spectrogram'].get('zoom_band') is not None:
+      zoom_band=[float(f) for f in config['spectrogram'].get('zoom_band').split(',')]
+      zoom_bins=config['spectrogram'].getint('zoom_bins',zoom_bins)
+      l_dopp_lim=max(l_dopp_lim,zoom_band[0])     # plot no wider than the zoom band
+      u_dopp_lim=min(u_dopp_lim,zoom_band[1])
+  render=config['plots'].get('render','contour')  # contour, raster or preview, see spectrogram_render.py
   color_map=config['plots'].get('color_map')  # values include Greys, 
 else:
   print("No configuration file for the callsign in channel ", channel, "Look in ./config directory for examples and create one for this call")
   sys.exit()
 ##################################################
+if render not in spectrogram_render.render_modes:
+   print ("render in config file must be one of ",spectrogram_render.render_modes)
+   exit()
+
 # Check sensible and available command line start and stop times
-if int(sys.argv[4]) >= ((s1-s0)/10)/3600:
+if int(sys.argv[4]) >= ((s1-s_day)/10)/3600:
    print ("End time specified beyond end of data set: Reading to last sample in data set")
-   length=int(np.floor(((((s1-s0)/10)/3600)-hours_offset)*60))    # calculate length of data in minutes
+   length=int(np.floor(((((s1-s_day)/10)/3600)-hours_offset)*60))    # calculate length of data in minutes
 else:
    length=int(np.floor((int(sys.argv[4])-hours_offset)*60))    # calculate length of data in minutes to be sure in data set
 
@@ -98,48 +122,54 @@ frequency=freqList[freq_index]        # This comes from command line argument an
 Hann_factor=1.63                      # Energy correction factor # https://community.sw.siemens.com/s/article/window-correction-factors
 time_window=60                        # 60 seconds of data for each FFT, i.e. each vertical 'line' in spectrogram
 m_samples=int(fs*time_window)         # Number of samples in time window, fs is from metadata, the sample rate
-n_samples=length*m_samples+1          # how many samples to read in, determined from length, diff of stop and start time in command line
 
-s=s0+hours_offset*3600*fs             # calculate start time given command line start time offset
-
-real=np.zeros(m_samples)         # plain numpy arrays
-im=np.zeros(m_samples)
-zf=np.empty(m_samples)           # this is an initially empty array, for the frequency axis, that we'll stack at each time interval
-data=np.empty(m_samples)
+s=channel_catalog.utc_to_sample(catalog,date,hours_offset)   # sample at command line start time, UTC
+hop_samples=int(fs*stft_hop)          # Number of samples between successive FFTs
+if hop_samples < 1 or m_samples % hop_samples != 0:
+   print ("Spectrogram hop in config file must divide into the ",time_window," s time window")
+   exit()
 
 ########################################
 # digital_rf read in code
 ########################################
 
 do.get_channels()
-# get samples, these are i,q pairs. Starting at s and going on for length*10*60
-input = do.read_vector(s, n_samples, channel)
 if len(freqList) > 1: 
-  data=input[:,freq_index]
+  sub_channel=freq_index
 else:                               # single channel Grape so 1 dimensional data array
-  data=input[:]
-
-print ("First data sample is ", data[0])
+  sub_channel=None
 
 ########################################
 # FFT processing
 ########################################
 # generate the x and y axes for the contour plot 
 
-x=np.linspace(hours_offset,hours_offset+int(length/60), length)
-yf=fftfreq(m_samples,1/fs)
-yf=fftshift(yf)                        # shift the zero frequency to the centre, avoids white line at zero on spectrogram
-
-# generate a Hann window of length m_samples (i.e. 600 samples)
-window = signal.windows.hann(m_samples)
-
-for j in range (0,length-1):
-   k=int(j*m_samples)
-   yt=fft(data[k:k+m_samples]*window,norm="forward",overwrite_x=False)*Hann_factor     # do the FFT
-   yt_abs=fftshift(np.abs(yt))        # shift zero frequency to centre
-   zf=np.column_stack((zf,yt_abs))    # stack the results in the 2D array zf for contour plotting
-
-zf_dB=10*np.log10(zf)	              # Log 10 for Power Spectral Density (PSD)
+# With the default settings of non-overlapping 60 s Hann windows the spectrogram comes from the archive of one
+# minute spectrograms, computing and adding only the minutes that are not there yet, see spectrogram_archive.py
+use_archive=(zoom_band is None and hop_samples == m_samples and stft_nfft in (None,m_samples) and stft_window == 'hann'
+             and s % m_samples == 0)
+if use_archive:
+  n_new=spectrogram_archive.update_minutes(do,catalog,channel,freq_index,s,length)
+  print ("Minutes added to spectrogram archive ",n_new)
+  (yf,zf_dB)=spectrogram_archive.read_minutes(catalog,channel,freq_index,s,length)
+else:
+  # Read i,q pairs an hour at a time starting at s, batched short time FFT of each block's frames: window, FFT,
+  # fftshift and log 10 for Power Spectral Density (PSD). Only one block of IQ data is held in memory at once
+  # Each block has m_samples-hop_samples extra samples so that overlapping frames run on across block boundaries
+  # yf is the frequency axis with zero frequency shifted to the centre, avoids white line at zero on spectrogram
+  zf_blocks=[]
+  n_extra=m_samples-hop_samples
+  for (j,data) in drf_reader.read_blocks(do,channel,s,length,m_samples,sub_channel,n_extra=n_extra,catalog=catalog):
+    if j == 0:
+      print ("First data sample is ", data[0])
+    n_frames=(len(data)-n_extra)//hop_samples
+    if zoom_band is None:
+      (yf,t,zf_block)=spectrogram_engine.stft_spectrogram(data,fs,time_window,stft_hop,stft_nfft,stft_window,Hann_factor,n_frames)
+    else:                             # only the Doppler band of interest, at finer resolution
+      (yf,t,zf_block)=spectrogram_engine.zoom_spectrogram(data,fs,zoom_band[0],zoom_band[1],zoom_bins,time_window,stft_hop,stft_window,Hann_factor,n_frames)
+    zf_blocks.append(zf_block)
+  zf_dB=np.hstack(zf_blocks)
+x=np.linspace(hours_offset,hours_offset+int(length/60), zf_dB.shape[1])
 
 ##########################################
 # now plot, annotate and save
@@ -154,29 +184,23 @@ xaxis_title="Time on " + date + " (hours UTC)"
 # Autoscale for PSD Y axis based on spectrogram values. Inevitably there are nans, so remove them and flatten array
 # Use these percentiles to set limits, but add 3 dB to max to be sure
 
-zf_dB_no_nan=zf_dB[~np.isnan(zf_dB)]
-min_level=np.floor(np.percentile(zf_dB_no_nan,10))  # 10% as min, to reduce background shading
-max_level=np.ceil(np.percentile(zf_dB_no_nan,99.9))+3
+# From the archive the percentiles come from the PSD histograms stored with it, without the whole matrix
+if use_archive:
+  counts=spectrogram_archive.read_histogram(catalog,channel,freq_index,s,length)
+  min_level=np.floor(spectrogram_archive.histogram_percentile(counts,10))  # 10% as min, to reduce background shading
+  max_level=np.ceil(spectrogram_archive.histogram_percentile(counts,99.9))+3
+else:
+  zf_dB_no_nan=zf_dB[~np.isnan(zf_dB)]
+  min_level=np.floor(np.percentile(zf_dB_no_nan,10))  # 10% as min, to reduce background shading
+  max_level=np.ceil(np.percentile(zf_dB_no_nan,99.9))+3
 levels=np.arange(min_level,max_level+6,3)
 
-fig, ax= plt.subplots()   # 
-
-# Contour plot, label, get colorbar and label
-cs=ax.contourf(x,yf,zf_dB, levels, cmap=color_map)
-
-plt.suptitle(plot_title)
-plt.xlabel(xaxis_title)
-plt.ylabel("Doppler shift (Hz)")
-plt.gcf().set_size_inches(12, 4.5, forward=True)
-plt.xlim(hours_offset,hours_offset+np.ceil(length/60))
-plt.ylim(l_dopp_lim,u_dopp_lim)
-
-cbar = fig.colorbar(cs)
-cbar.set_label("PSD uncalibrated (dB)", rotation=270, labelpad=25)
-plt.tight_layout()
+# Contour plot, label, get colorbar and label, see spectrogram_render.py
+(fig,ax)=spectrogram_render.doppler_figure(x,yf,zf_dB,levels,plot_title,xaxis_title,(hours_offset,hours_offset+np.ceil(length/60)),
+                                           (l_dopp_lim,u_dopp_lim),color_map,render)
 
 # Save the plot
-plt.savefig(plot_dir + "/Spectrogram" + "_" + str(frequency) + "MHz_" + date + ".png", dpi=600)
+plt.savefig(spectrogram_render.save_fpath(plot_dir + "/Spectrogram" + "_" + str(frequency) + "MHz_" + date + ".png",render), dpi=spectrogram_render.render_dpi[render])
 print("PSWS Spectrogram saved")
 
 ###################################################################################################
@@ -257,7 +281,7 @@ if db_flag == 'True':
     plt.legend(handles=[black_patch, blue_patch, green_patch, purple_patch, brown_patch, cyan_patch, lime_patch, orchid_patch],\
       ncol=2, loc=legend_loc)
      
-    plt.savefig(plot_dir + "/Spectrogram+Synth" + "_" + str(frequency) + "MHz_" + date + ".png", dpi=600)
+    plt.savefig(spectrogram_render.save_fpath(plot_dir + "/Spectrogram+Synth" + "_" + str(frequency) + "MHz_" + date + ".png",render), dpi=spectrogram_render.render_dpi[render])
   else:
     print("No data in the database to match SQL statement - check it - and or run pathfinder etc.")
 
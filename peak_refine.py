@@ -0,0 +1,106 @@
+# Module to refine spectral peaks, e.g. from CWT peak finding (see cwt_peaks.py), for many peaks at once
+# Replaces the per peak findLocalPeak and freqInterpolate loops of the CWT scripts. Each function takes arrays of
+# candidate bin indices, into one spectrum or into the rows of a (minutes x frequency bins) spectrogram, and gathers
+# the bins around all of them in one indexing operation. Index -1 marks no peak and gives NaN results.
+# Peaks within edge_bins, or the search radius if larger, of either end of the spectrum are not refined, as in the
+# earlier 5 and 594 bounds for 600 bins, here taken from the FFT length so any window length works.
+
+import numpy as np
+import warnings
+from scipy import signal
+
+edge_bins=5          # bins at each end, near -5 and +5 Hz for 10 Hz sampling, where peaks are left as found
+
+def search_bounds(n_bins,radius=0):
+    # First and last bin of a spectrum of n_bins that a search radius bins either side can refine
+    margin=max(radius,edge_bins)
+    return margin,n_bins-1-margin
+
+def _gather(levels,index,rows):
+    # levels as 2-D (rows x bins), rows and index as arrays of one shape, -1 indices as 0 to index safely
+    levels=np.atleast_2d(levels)
+    index=np.asarray(index,dtype=int)
+    if rows is None:
+        rows=np.zeros(index.shape,dtype=int)
+    rows=np.broadcast_to(np.asarray(rows,dtype=int),index.shape)
+    return levels,index,rows
+
+def strongest_peaks(minute,index,level,n_rows,n_peaks=2):
+    # Bin indices of the n_peaks highest level peaks of each minute, highest first, from flat arrays of peaks as
+    # returned by cwt_peaks.find_peaks_batch. A bin listed twice counts once
+    # Returns (n_rows x n_peaks), -1 where a minute has fewer peaks
+    order=np.lexsort((index,-np.asarray(level),minute))
+    (minute,index)=(np.asarray(minute)[order],np.asarray(index)[order])
+    first=np.ones(len(index),dtype=bool)
+    first[1:]=(minute[1:] != minute[:-1]) | (index[1:] != index[:-1])
+    (minute,index)=(minute[first],index[first])     # highest first within each minute, duplicates adjacent
+    rank=np.arange(len(index))-np.searchsorted(minute,minute)
+    top=np.full((n_rows,n_peaks),-1,dtype=int)
+    keep=rank < n_peaks
+    top[minute[keep],rank[keep]]=index[keep]
+    return top
+
+def local_peak(levels,index,radius,rows=None):
+    # Index of the highest bin within radius bins either side of each index, the index itself unless a bin is
+    # strictly higher, the first of equal higher bins. levels is a spectrum or, with rows, a spectrogram
+    (levels,index,rows)=_gather(levels,index,rows)
+    (low,high)=search_bounds(levels.shape[1],radius)
+    ok=(index >= low) & (index <= high)
+    centre=np.where(ok,index,low)
+    window=levels[rows[...,np.newaxis],centre[...,np.newaxis]+np.arange(-radius,radius+1)]
+    moved=ok & (np.max(window,axis=-1) > levels[rows,centre])
+    return np.where(moved,centre-radius+np.argmax(window,axis=-1),index)
+
+def interpolate_frequency(levels,index,x,rows=None,radius=2,method='weighted'):
+    # Peak frequency between bins from the levels (dB) around each index, x the frequency of each bin
+    # weighted    mean of x over radius bins either side weighted by linear amplitude, as freqInterpolate
+    # parabolic   vertex of the parabola through the peak bin and one either side, in dB
+    # Peaks near the ends give x at the index, no peak (-1) gives NaN
+    (levels,index,rows)=_gather(levels,index,rows)
+    x=np.asarray(x)
+    if method == 'parabolic':
+        radius=1
+    elif method != 'weighted':
+        raise ValueError("method must be weighted or parabolic, not {!s}".format(method))
+    (low,high)=search_bounds(levels.shape[1],radius)
+    ok=(index >= low) & (index <= high)
+    centre=np.where(ok,index,low)
+    cols=centre[...,np.newaxis]+np.arange(-radius,radius+1)
+    window=levels[rows[...,np.newaxis],cols]
+    with np.errstate(divide='ignore',invalid='ignore'):
+        if method == 'weighted':
+            weights=10**(window/20)                # convert dB level to linear
+            freq=np.sum(x[cols]*weights,axis=-1)/np.sum(weights,axis=-1)
+        else:
+            (a,b,c)=(window[...,0],window[...,1],window[...,2])
+            freq=x[centre]+0.5*(a-c)/(a-2*b+c)*(x[1]-x[0])
+    freq=np.where(ok,freq,x[np.maximum(index,0)])
+    return np.where(index >= 0,freq,np.nan)
+
+def peak_width(levels,index,rows=None,rel_height=0.5,wlen=10):
+    # Width in bins of each peak at rel_height of its prominence in linear amplitude, scipy.signal.peak_widths
+    # within a window of wlen bins, so peaks of different minutes do not interact. NaN near the ends or no peak
+    (levels,index,rows)=_gather(levels,index,rows)
+    n_bins=levels.shape[1]
+    (low,high)=search_bounds(n_bins,wlen//2)
+    ok=(index >= low) & (index <= high)
+    width=np.full(index.shape,np.nan)
+    if np.any(ok):
+        (used,row_of)=np.unique(rows[ok],return_inverse=True)
+        amplitude=(10**(levels[used]/20)).ravel()  # the rows with peaks end to end
+        with warnings.catch_warnings():            # a peak on a plateau has width 0, not worth a warning per batch
+            warnings.filterwarnings('ignore',message='some peaks have')
+            width[ok]=signal.peak_widths(amplitude,row_of*n_bins+index[ok],rel_height=rel_height,wlen=wlen)[0]
+    return width
+
+def refine_peaks(levels,index,x,rows=None,local_radius=1,interp_radius=2,method='weighted',rel_height=0.5,wlen=10):
+    # All the refinements for arrays of candidate peaks: the highest bin within local_radius (0 to keep the index),
+    # its interpolated frequency, level and width in bins
+    # Returns index, frequency, level and width, NaN frequency, level and width where there is no peak (-1)
+    (levels,index,rows)=_gather(levels,index,rows)
+    if local_radius > 0:
+        index=local_peak(levels,index,local_radius,rows)
+    freq=interpolate_frequency(levels,index,x,rows,interp_radius,method)
+    level=np.where(index >= 0,levels[rows,np.maximum(index,0)],np.nan)
+    width=peak_width(levels,index,rows,rel_height,wlen)
+    return index,freq,level,width
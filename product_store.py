@@ -0,0 +1,63 @@
+# Module to write and read the per-window result tables (products) of the ACF and CWT tracking scripts in a typed
+# columnar format, Parquet through pandas and pyarrow, rather than a csv file written a row at a time.
+# Each product file holds one table with callsign, frequency and UTC time as columns so that products of many
+# days, stations and frequencies concatenate into one table, and the station metadata (date, grid, lat, lon)
+# as file attributes. Loading months of per-minute products is then one read per file with no csv parsing.
+# csv in the earlier layout, metadata and header rows then the data, remains an optional export in the scripts.
+# Files go into ./output/products/callsign/name_frequencyMHz_YYYY-MM-DD.parquet
+
+import numpy as np
+import os
+import glob
+import pandas as pd
+
+base_directory='./'
+product_dir=os.path.join(base_directory,'output','products')
+
+def product_fpath(name,callsign,frequency,date,suffix='',directory=product_dir):
+    # File for product name, e.g. ACF or CWF_Proph, of callsign at frequency in MHz, None for all frequencies,
+    # on date a YYYY-MM-DD string. suffix distinguishes non-default settings, e.g. _W60_H1
+    if frequency is None:
+        fname=name+'_'+date+suffix+'.parquet'
+    else:
+        fname=name+'_'+str(frequency)+'MHz_'+date+suffix+'.parquet'
+    return os.path.join(directory,callsign,fname)
+
+def write_product(fpath,hour,columns,date,callsign,frequency,grid,lat,lon,attrs=None):
+    # Write a product table to fpath. hour is the time of each row in hours from 00:00 UTC on date, the time column
+    # rounds it to 0.1 s as the scripts round hours to 5 decimal places. columns is a dictionary of equal length
+    # 1-D arrays in column order. frequency in MHz is a single value or one per row.
+    # attrs is a dictionary of further settings kept with the file, e.g. the ACF window and hop
+    # Returns the DataFrame as written
+    hour=np.asarray(hour,dtype=np.float64)
+    df=pd.DataFrame({'time':pd.Timestamp(date,tz='UTC')+pd.to_timedelta(np.round(hour*3600,1),unit='s'),
+                     'hour':hour,
+                     'callsign':pd.Categorical(np.full(len(hour),callsign)),
+                     'frequency':np.broadcast_to(np.asarray(frequency,dtype=np.float64),hour.shape)})
+    for key in columns:
+        df[key]=np.asarray(columns[key])
+    df.attrs={'date':date,'callsign':callsign,'grid':grid,'lat':float(lat),'lon':float(lon)}
+    if attrs is not None:
+        df.attrs.update(attrs)
+
+    if not os.path.exists(os.path.dirname(fpath)):
+        os.makedirs(os.path.dirname(fpath))
+    tmp_fpath=fpath+'.tmp'
+    df.to_parquet(tmp_fpath,index=False)         # pandas keeps df.attrs in the Parquet file metadata
+    os.replace(tmp_fpath,fpath)
+    return df
+
+def read_product(pattern):
+    # One DataFrame of all the product files matching pattern, a path or glob, e.g.
+    #     read_product('output/products/G4HZX/ACF_15.0MHz_2025-03-*.parquet')
+    # attrs are those of the first file, callsign, frequency and time columns tell the rows of each file apart
+    fpaths=sorted(glob.glob(pattern))
+    if len(fpaths) == 0:
+        raise FileNotFoundError("No product files match {!s}".format(pattern))
+    dfs=[pd.read_parquet(fpath) for fpath in fpaths]
+    if len(dfs) == 1:
+        return dfs[0]
+    df=pd.concat(dfs,ignore_index=True)
+    df['callsign']=df['callsign'].astype('category')
+    df.attrs=dfs[0].attrs
+    return df
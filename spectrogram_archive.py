@@ -0,0 +1,262 @@
+# Module to keep an append-only archive of one minute Doppler spectrograms, so that repeat and near real time
+# runs of grape_fft_spectrogram.py only compute the minutes that are new since the last run
+# There is one netCDF4 file per channel, frequency and day holding the spectrogram of all 1440 minutes and a flag
+# per minute showing whether it has been computed. A minute is only computed once all its samples are in the DRF
+# files, so the minutes of an hour file that is still being written are picked up by the next update.
+# Each minute also has a histogram of its PSD values in fixed dB bins. Histograms add, so the percentiles that set
+# the plot colour scale come from the sum over any range of minutes, days, frequencies or stations without
+# reading the spectrograms again.
+# The archive is also the one minute level of the spectrogram pyramid, see spectrogram_pyramid.py.
+#
+# Update the archive for all frequencies of a channel, or one frequency index, with e.g.
+#     python3 spectrogram_archive.py ch0_G4HZX [6]
+# Files go into ./data/spectrogram_archive/channel/frequencyMHz/YYYY-MM-DD.nc
+
+import numpy as np
+import os
+import sys
+from datetime import datetime
+import pytz
+import netCDF4
+import digital_rf as drf
+
+import channel_catalog            # this is a module in this directory to keep a catalog of channel metadata
+import drf_reader                 # this is a module in this directory to read IQ data a block at a time
+import spectrogram_engine         # this is a module in this directory for the batched FFT spectrogram
+
+base_directory='./'
+archive_dir=os.path.join(base_directory,'data','spectrogram_archive')
+time_window=60                    # seconds per FFT, each archive column is one minute
+Hann_factor=1.63                  # Energy correction factor, as grape_fft_spectrogram.py
+minutes_per_day=1440
+hist_lo=-100.0                    # dB, lower edge of the first bin of the PSD histograms
+hist_step=0.25                    # dB per histogram bin
+hist_bins=800                     # so to +100 dB, values beyond either end are counted in the end bins
+
+def archive_fpath(channel,frequency,day,directory=archive_dir):
+    # File for channel, frequency in MHz as given by the metadata, and day a date
+    return os.path.join(directory,channel,str(frequency)+'MHz',day.strftime('%Y-%m-%d')+'.nc')
+
+def open_archive(fpath,channel,frequency,day,fs):
+    # Open the archive file for appending, creating it with no minutes computed if it does not exist yet
+    if os.path.exists(fpath):
+        nc=netCDF4.Dataset(fpath,'a')
+        if 'hist' not in nc.variables:            # file written before the archive held histograms
+            add_histogram(nc)
+        return nc
+    if not os.path.exists(os.path.dirname(fpath)):
+        os.makedirs(os.path.dirname(fpath))
+    m_samples=int(fs*time_window)
+    tmp_fpath=fpath+'.tmp'
+    with netCDF4.Dataset(tmp_fpath,'w') as nc:
+        nc.channel=channel
+        nc.frequency=float(frequency)
+        nc.date=day.strftime('%Y-%m-%d')
+        nc.fs=float(fs)
+        nc.time_window=time_window
+        nc.Hann_factor=Hann_factor
+        nc.createDimension('doppler',m_samples)
+        nc.createDimension('minute',minutes_per_day)
+        yf=nc.createVariable('yf','f8',('doppler',))
+        yf[:]=np.fft.fftshift(np.fft.fftfreq(m_samples,1/fs))
+        # chunks of one hour, so that appending an hour rewrites one chunk
+        nc.createVariable('zf_dB','f4',('doppler','minute'),fill_value=np.float32(np.nan),chunksizes=(m_samples,60))
+        nc.createVariable('computed','i1',('minute',),fill_value=np.int8(0))
+        add_histogram(nc)
+    os.replace(tmp_fpath,fpath)
+    return netCDF4.Dataset(fpath,'a')
+
+def add_histogram(nc):
+    # Add the PSD histogram variable to an archive file, filled in from the spectrogram of minutes already computed
+    # in files written before the archive held histograms
+    nc.hist_lo=hist_lo
+    nc.hist_step=hist_step
+    nc.createDimension('level',hist_bins)
+    nc.createVariable('hist','u2',('minute','level'),fill_value=np.uint16(0),zlib=True,chunksizes=(60,hist_bins))
+    computed=np.flatnonzero(np.asarray(nc.variables['computed'][:]))
+    for (r0,r1) in runs(computed):
+        zf=np.ma.filled(nc.variables['zf_dB'][:,r0:r1],np.nan)
+        nc.variables['hist'][r0:r1,:]=level_histogram(zf)
+
+def level_histogram(zf_dB):
+    # Histogram of the PSD values in each column of zf_dB (doppler x minute), NaN left out
+    # Returns counts (minute x hist_bins), bin k from hist_lo+k*hist_step dB
+    n_minutes=zf_dB.shape[1]
+    valid=~np.isnan(zf_dB)
+    k=np.clip(np.floor((zf_dB[valid]-hist_lo)/hist_step),0,hist_bins-1).astype(np.int64)
+    minute=np.broadcast_to(np.arange(n_minutes),zf_dB.shape)[valid]
+    counts=np.bincount(minute*hist_bins+k,minlength=n_minutes*hist_bins)
+    return counts.reshape(n_minutes,hist_bins)
+
+def histogram_percentile(counts,q):
+    # Percentile q (0 to 100) of the PSD values counted in counts, the sum of level_histogram over any minutes,
+    # interpolated within the bin so within hist_step of np.percentile of the values. NaN if nothing is counted
+    cum=np.cumsum(counts,dtype=np.float64)
+    if len(cum) == 0 or cum[-1] == 0:
+        return np.nan
+    target=max(q/100*cum[-1],np.finfo(np.float64).tiny)
+    k=min(int(np.searchsorted(cum,target)),hist_bins-1)      # first bin reaching the target count
+    below=cum[k]-counts[k]
+    return hist_lo+(k+(target-below)/counts[k])*hist_step
+
+def day_spans(catalog,s,length):
+    # Split length minutes from sample index s into the part in each day: list of (day, first minute of the day,
+    # end minute of the day, sample index of 00:00 UTC of the day). s must be on a whole minute
+    fs=float(channel_catalog.sample_rate(catalog))
+    m_samples=int(fs*time_window)
+    spans=[]
+    minute=int(s)//m_samples                    # minutes since the epoch
+    end=minute+length
+    while minute < end:
+        day=datetime.fromtimestamp(minute*time_window,pytz.utc).date()
+        day_minute=minute%minutes_per_day
+        n=min(minutes_per_day-day_minute,end-minute)
+        spans.append((day,day_minute,day_minute+n,(minute-day_minute)*m_samples))
+        minute=minute+n
+    return spans
+
+def runs(minutes):
+    # Sorted list of minutes as a list of (start,end) runs of consecutive minutes
+    result=[]
+    for m in minutes:
+        if len(result) > 0 and result[-1][1] == m:
+            result[-1][1]=m+1
+        else:
+            result.append([m,m+1])
+    return result
+
+def update_minutes(do,catalog,channel,freq_index,s,length,directory=archive_dir):
+    # Compute and append the minutes of length minutes from sample index s that are not yet in the archive and
+    # whose data is complete. do is a digital_rf DigitalRFReader. Returns the number of minutes computed
+    fs=float(channel_catalog.sample_rate(catalog))
+    m_samples=int(fs*time_window)
+    freqList=catalog['center_frequencies']
+    frequency=freqList[freq_index]
+    if len(freqList) > 1:
+        sub_channel=freq_index
+    else:                               # single channel Grape so 1 dimensional data array
+        sub_channel=None
+
+    n_new=0
+    for (day,m0,m1,s_day) in day_spans(catalog,s,length):
+        fpath=archive_fpath(channel,frequency,day,directory)
+        with open_archive(fpath,channel,frequency,day,fs) as nc:
+            computed=np.asarray(nc.variables['computed'][m0:m1])
+            todo=[m for m in range(m0,m1) if computed[m-m0] == 0 and
+                  channel_catalog.is_covered(catalog,s_day+m*m_samples,m_samples)]
+            for (r0,r1) in runs(todo):
+                for (j,data) in drf_reader.read_blocks(do,channel,s_day+r0*m_samples,r1-r0,m_samples,sub_channel,catalog=catalog):
+                    (yf,zf_block)=spectrogram_engine.fft_spectrogram(data,fs,time_window,Hann_factor)
+                    nc.variables['zf_dB'][:,r0+j:r0+j+zf_block.shape[1]]=zf_block
+                    nc.variables['hist'][r0+j:r0+j+zf_block.shape[1],:]=level_histogram(zf_block)
+                nc.sync()                           # spectra are on disk before they are flagged as computed
+                nc.variables['computed'][r0:r1]=1
+        n_new=n_new+len(todo)
+    return n_new
+
+def update_minutes_all(do,catalog,channel,s,length,directory=archive_dir):
+    # As update_minutes, but for every center frequency in one pass: each block of all frequencies is read once
+    # and transformed in one batched FFT. A minute is computed if any frequency is missing it.
+    # Returns the number of minutes computed
+    fs=float(channel_catalog.sample_rate(catalog))
+    m_samples=int(fs*time_window)
+    freqList=catalog['center_frequencies']
+
+    n_new=0
+    for (day,m0,m1,s_day) in day_spans(catalog,s,length):
+        ncs=[open_archive(archive_fpath(channel,frequency,day,directory),channel,frequency,day,fs) for frequency in freqList]
+        try:
+            computed=np.min([np.asarray(nc.variables['computed'][m0:m1]) for nc in ncs],axis=0)
+            todo=[m for m in range(m0,m1) if computed[m-m0] == 0 and
+                  channel_catalog.is_covered(catalog,s_day+m*m_samples,m_samples)]
+            for (r0,r1) in runs(todo):
+                for (j,data) in drf_reader.read_blocks(do,channel,s_day+r0*m_samples,r1-r0,m_samples,None,catalog=catalog):
+                    (yf,zf_blocks)=spectrogram_engine.fft_spectrogram_multi(data,fs,time_window,Hann_factor)
+                    for (nc,zf_block) in zip(ncs,zf_blocks):
+                        nc.variables['zf_dB'][:,r0+j:r0+j+zf_block.shape[1]]=zf_block
+                        nc.variables['hist'][r0+j:r0+j+zf_block.shape[1],:]=level_histogram(zf_block)
+                for nc in ncs:
+                    nc.sync()
+                    nc.variables['computed'][r0:r1]=1
+        finally:
+            for nc in ncs:
+                nc.close()
+        n_new=n_new+len(todo)
+    return n_new
+
+def read_minutes(catalog,channel,freq_index,s,length,directory=archive_dir):
+    # Spectrogram of length minutes from sample index s as stored in the archive
+    # Returns yf and zf_dB (m_samples x length), NaN for minutes not computed
+    fs=float(channel_catalog.sample_rate(catalog))
+    m_samples=int(fs*time_window)
+    frequency=catalog['center_frequencies'][freq_index]
+    yf=np.fft.fftshift(np.fft.fftfreq(m_samples,1/fs))
+    zf_dB=np.full((m_samples,length),np.nan)
+    k=0
+    for (day,m0,m1,s_day) in day_spans(catalog,s,length):
+        fpath=archive_fpath(channel,frequency,day,directory)
+        if os.path.exists(fpath):
+            with netCDF4.Dataset(fpath,'r') as nc:
+                zf=np.ma.filled(nc.variables['zf_dB'][:,m0:m1],np.nan)
+                computed=np.asarray(nc.variables['computed'][m0:m1])
+                zf[:,computed == 0]=np.nan
+                zf_dB[:,k:k+m1-m0]=zf
+                yf=np.asarray(nc.variables['yf'][:])
+        k=k+m1-m0
+    return yf,zf_dB
+
+def read_day(channel,frequency,day,directory=archive_dir):
+    # Spectrogram of every minute of day, a date, for frequency in MHz as given by the metadata, as stored in the
+    # archive, without a catalog. Returns yf, zf_dB (doppler x 1440) with NaN for minutes not computed, and the
+    # number of minutes computed, or None, None and 0 if the archive has no file for the day
+    fpath=archive_fpath(channel,frequency,day,directory)
+    if not os.path.exists(fpath):
+        return None,None,0
+    with netCDF4.Dataset(fpath,'r') as nc:
+        yf=np.asarray(nc.variables['yf'][:])
+        zf_dB=np.ma.filled(nc.variables['zf_dB'][:,:],np.nan)
+        computed=np.asarray(nc.variables['computed'][:]) != 0
+    zf_dB[:,~computed]=np.nan
+    return yf,zf_dB,int(computed.sum())
+
+def read_histogram(catalog,channel,freq_index,s,length,directory=archive_dir):
+    # Sum of the PSD histograms of the computed minutes of length minutes from sample index s, for
+    # histogram_percentile. Sums from several frequencies or channels may be added for a common colour scale
+    frequency=catalog['center_frequencies'][freq_index]
+    counts=np.zeros(hist_bins,dtype=np.int64)
+    for (day,m0,m1,s_day) in day_spans(catalog,s,length):
+        fpath=archive_fpath(channel,frequency,day,directory)
+        if os.path.exists(fpath):
+            with netCDF4.Dataset(fpath,'r') as nc:
+                if 'hist' not in nc.variables:      # not yet updated since the archive held histograms
+                    continue
+                computed=np.asarray(nc.variables['computed'][m0:m1]) != 0
+                hist=np.ma.filled(nc.variables['hist'][m0:m1,:],0)
+                counts=counts+hist[computed].sum(axis=0,dtype=np.int64)
+    return counts
+
+def update_channel(data_dir,channel,freq_indices=None,directory=archive_dir):
+    # Bring the archive up to date for every day of channel, for freq_indices, default all frequencies
+    catalog=channel_catalog.load_catalog(data_dir,channel)
+    fs=float(channel_catalog.sample_rate(catalog))
+    m_samples=int(fs*time_window)
+    do=drf.DigitalRFReader(data_dir)
+    s=(catalog['s0']//m_samples)*m_samples        # back to the start of the minute
+    length=(catalog['s1']-s)//m_samples+1
+    if freq_indices is None:                      # all frequencies from one read of the data
+        n_new=update_minutes_all(do,catalog,channel,s,length,directory)
+        print("Spectrogram archive for ",channel," all frequencies: ",n_new," new minutes")
+        return
+    for freq_index in freq_indices:
+        n_new=update_minutes(do,catalog,channel,freq_index,s,length,directory)
+        print("Spectrogram archive for ",channel," ",catalog['center_frequencies'][freq_index]," MHz: ",n_new," new minutes")
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or len(sys.argv) > 3:
+        print ("Rerun with channel name and optional frequency index as command line arguments")
+        exit()
+    data_dir=os.path.join(base_directory,'data','psws_grapeDRF')
+    if len(sys.argv) == 3:
+        update_channel(data_dir,sys.argv[1],[int(sys.argv[2])])
+    else:
+        update_channel(data_dir,sys.argv[1])
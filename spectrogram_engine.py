@@ -0,0 +1,160 @@
+# Module to calculate the Doppler spectrogram of Grape IQ data in one batched FFT
+# The IQ vector is reshaped into a (minutes x m_samples) view, the Hann window and Hann_factor are applied
+# in a single broadcast and one multi-threaded scipy.fft call transforms all rows.
+# This replaces the per-minute FFT loop that grew the spectrogram with np.column_stack, copying the whole
+# accumulated matrix once per minute.
+# stft_spectrogram is the general form, a short time FFT with window length, hop, nfft and window type as
+# parameters. Overlapping frames are strided views into the IQ vector, so all frames are still transformed in one
+# call and e.g. 10 s hops cost one FFT per frame rather than a re-read per offset. fft_spectrogram and
+# GrapeDRF.plot_ax both use it.
+# zoom_spectrogram and zoom_peak_frequency use the chirp-z transform (scipy.signal.ZoomFFT) to evaluate only a
+# chosen Doppler band, e.g. +/-2 Hz, at fine frequency resolution for all frames at once. This is cheaper than
+# zero padding the whole +/-5 Hz FFT to the same resolution.
+
+import numpy as np
+from scipy.fft import fft, fftfreq, fftshift
+from scipy import signal
+from scipy.signal import ZoomFFT
+
+def frame_view(data,m_samples,hop_samples,n_frames):
+    # (n_frames x m_samples) view of data, frame i starting at sample i*hop_samples, no copy
+    if hop_samples == m_samples:                     # one row per time window
+        return np.reshape(data[0:n_frames*m_samples],(n_frames,m_samples))
+    n_needed=(n_frames-1)*hop_samples+m_samples if n_frames > 0 else m_samples
+    return np.lib.stride_tricks.sliding_window_view(data[0:n_needed],m_samples)[::hop_samples]
+
+def stft_spectrogram(data,fs,window_length=60,hop=None,nfft=None,window='hann',Hann_factor=1.63,n_frames=None,workers=-1,
+                     scaling='magnitude'):
+    # data is the complex IQ vector for one frequency, fs the sample rate
+    # window_length and hop are in seconds, hop defaults to window_length, i.e. no overlap
+    # nfft is the FFT length in samples, default window_length*fs; larger zero pads for a finer frequency grid
+    # window is any scipy.signal.get_window window name e.g. 'hann', 'hamming', 'blackman' or ('kaiser',8)
+    # Hann_factor is the energy correction factor for the window, 1.63 for Hann, change it with the window
+    # n_frames is the number of frames to process, default is as many whole frames as there are in data
+    # scaling 'magnitude' is 10*log10 of the Hann_factor corrected FFT magnitude, as the Grape scripts have always
+    # plotted. 'density' is the power spectral density in dB as scipy.signal.spectrogram, its default constant
+    # detrend and periodic window, |X|**2/(fs*sum(window**2)), Hann_factor not applied
+    # Returns the frequency axis yf (zero frequency centred), t the start time of each frame in seconds
+    # from the start of data, and zf_dB the PSD in dB as (nfft x n_frames) with one column per frame
+    m_samples=int(round(fs*window_length))           # Number of samples in window
+    if hop is None:
+        hop=window_length
+    hop_samples=int(round(fs*hop))
+    if nfft is None:
+        nfft=m_samples
+    if nfft < m_samples:
+        raise ValueError("nfft {!s} is shorter than the window of {!s} samples".format(nfft,m_samples))
+    if n_frames is None:
+        n_frames=max((len(data)-m_samples)//hop_samples+1,0)
+    n_needed=(n_frames-1)*hop_samples+m_samples if n_frames > 0 else 0
+    if len(data) < n_needed:
+        raise ValueError("Need {!s} samples for {!s} frames, only {!s} available".format(n_needed,n_frames,len(data)))
+
+    if scaling not in ('magnitude','density'):
+        raise ValueError("scaling must be 'magnitude' or 'density', not {!s}".format(scaling))
+    frames=frame_view(data,m_samples,hop_samples,n_frames)
+    yf=fftshift(fftfreq(nfft,1/fs))
+    t=np.arange(n_frames)*hop_samples/fs
+    if scaling == 'density':
+        taper=signal.get_window(window,m_samples)    # periodic, as scipy.signal.spectrogram
+        frames=frames-np.mean(frames,axis=1,keepdims=True)
+        yt=fft(frames*taper,n=nfft,axis=1,overwrite_x=True,workers=workers)
+        zf=fftshift(np.abs(yt)**2,axes=1)/(fs*np.sum(taper**2))
+        return yf,t,10*np.log10(zf.T)
+    taper=signal.get_window(window,m_samples,fftbins=False)         # symmetric, as signal.windows.hann(m_samples)
+
+    yt=fft(frames*taper,n=nfft,axis=1,norm="forward",overwrite_x=True,workers=workers)  # workers=-1 uses all CPU cores
+    yt*=Hann_factor*nfft/m_samples                   # Energy correction factor, scaled by window not nfft so levels do not depend on nfft
+    zf=fftshift(np.abs(yt),axes=1)                   # shift zero frequency to centre, avoids white line at zero
+
+    zf_dB=10*np.log10(zf.T)                          # Log 10 for Power Spectral Density (PSD), frequency down the rows
+    return yf,t,zf_dB
+
+def fft_spectrogram(data,fs,time_window=60,Hann_factor=1.63,length=None,workers=-1):
+    # data is the complex IQ vector for one frequency, fs the sample rate and time_window the seconds per FFT
+    # length is the number of time windows to process, default is as many whole windows as there are in data
+    # Returns the frequency axis yf (zero frequency centred) and zf_dB, the PSD in dB as (m_samples x length)
+    # with one column per time window, i.e. the same layout as the contour plotting code expects
+    m_samples=int(fs*time_window)                     # Number of samples in time window
+    if length is None:
+        length=len(data)//m_samples
+    if len(data) < length*m_samples:
+        raise ValueError("Need {!s} samples for {!s} time windows, only {!s} available".format(length*m_samples,length,len(data)))
+    (yf,t,zf_dB)=stft_spectrogram(data,fs,time_window,Hann_factor=Hann_factor,n_frames=length,workers=workers)
+    return yf,zf_dB
+
+def fft_spectrogram_multi(data,fs,time_window=60,Hann_factor=1.63,length=None,workers=-1):
+    # As fft_spectrogram, but for all center frequencies at once. data is (samples x frequencies) as read by
+    # DigitalRFReader.read_vector with no sub channel. One FFT call transforms the whole
+    # (frequencies x time windows x m_samples) array
+    # Returns yf and zf_dB as (frequencies x m_samples x length)
+    m_samples=int(fs*time_window)
+    if data.ndim == 1:                               # single channel Grape
+        data=data[:,np.newaxis]
+    if length is None:
+        length=data.shape[0]//m_samples
+    if data.shape[0] < length*m_samples:
+        raise ValueError("Need {!s} samples for {!s} time windows, only {!s} available".format(length*m_samples,length,data.shape[0]))
+
+    frames=np.reshape(data[0:length*m_samples].T,(data.shape[1],length,m_samples))
+    window=signal.windows.hann(m_samples)
+
+    yt=fft(frames*window,axis=2,norm="forward",overwrite_x=True,workers=workers)
+    yt*=Hann_factor
+    zf=fftshift(np.abs(yt),axes=2)
+
+    yf=fftshift(fftfreq(m_samples,1/fs))
+    zf_dB=10*np.log10(np.swapaxes(zf,1,2))         # frequency down the rows of each center frequency
+    return yf,zf_dB
+
+def zoom_spectrum(frames,fs,f1,f2,n_bins,window='hann',Hann_factor=1.63,centres=None):
+    # Chirp-z spectrum of each row of frames, (n_frames x m_samples), at n_bins frequencies from f1 to f2 Hz
+    # inclusive. centres, one frequency in Hz per frame, offsets the band of each frame to centre+f1..centre+f2,
+    # done by shifting each frame down by its centre so that one ZoomFFT still serves all frames
+    # Scaled as stft_spectrogram. Returns yf, the n_bins band frequencies relative to the centres, and
+    # zf_dB as (n_bins x n_frames)
+    frames=np.atleast_2d(frames)
+    m_samples=frames.shape[1]
+    taper=signal.get_window(window,m_samples,fftbins=False)
+    tapered=frames*taper
+    if centres is not None:
+        t=np.arange(m_samples)/fs
+        tapered=tapered*np.exp(-2j*np.pi*np.outer(centres,t))
+    zoom=ZoomFFT(m_samples,[f1,f2],m=n_bins,fs=fs,endpoint=True)
+    yt=zoom(tapered,axis=1)*(Hann_factor/m_samples)  # as norm="forward" and the energy correction factor
+    yf=np.linspace(f1,f2,n_bins)
+    zf_dB=10*np.log10(np.abs(yt).T)
+    return yf,zf_dB
+
+def zoom_spectrogram(data,fs,f1,f2,n_bins,window_length=60,hop=None,window='hann',Hann_factor=1.63,n_frames=None):
+    # As stft_spectrogram, but only the Doppler band f1 to f2 Hz at n_bins frequencies, by chirp-z transform
+    # Returns yf, t and zf_dB as (n_bins x n_frames)
+    m_samples=int(round(fs*window_length))
+    if hop is None:
+        hop=window_length
+    hop_samples=int(round(fs*hop))
+    if n_frames is None:
+        n_frames=max((len(data)-m_samples)//hop_samples+1,0)
+    n_needed=(n_frames-1)*hop_samples+m_samples if n_frames > 0 else 0
+    if len(data) < n_needed:
+        raise ValueError("Need {!s} samples for {!s} frames, only {!s} available".format(n_needed,n_frames,len(data)))
+    frames=frame_view(data,m_samples,hop_samples,n_frames)
+    (yf,zf_dB)=zoom_spectrum(frames,fs,f1,f2,n_bins,window,Hann_factor)
+    t=np.arange(n_frames)*hop_samples/fs
+    return yf,t,zf_dB
+
+def zoom_peak_frequency(frames,fs,freqs,half_width=None,n_bins=101,window='hann'):
+    # Refine the peak frequency in each row of frames, given approximate peak frequencies freqs (one per row),
+    # by the maximum of a chirp-z spectrum of n_bins from freqs-half_width to freqs+half_width, all rows at once
+    # half_width defaults to one FFT bin, 1/(m_samples/fs) Hz, i.e. 1/60 Hz for 60 s frames
+    # Rows whose freqs is NaN, e.g. no data, are returned as NaN
+    frames=np.atleast_2d(frames)
+    freqs=np.asarray(freqs,dtype=np.float64)
+    if half_width is None:
+        half_width=fs/frames.shape[1]
+    refined=np.full(len(freqs),np.nan)
+    ok=np.isfinite(freqs)
+    if np.any(ok):
+        (yf,zf_dB)=zoom_spectrum(frames[ok],fs,-half_width,half_width,n_bins,window,centres=freqs[ok])
+        refined[ok]=freqs[ok]+yf[np.argmax(zf_dB,axis=0)]
+    return refined
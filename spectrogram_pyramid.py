@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# Multi-resolution spectrogram pyramid for fast day, week and month plots of Grape DRF data
+# The one minute level (600 Doppler bins x 1440 minutes) is the spectrogram archive, see spectrogram_archive.py,
+# kept for each station in ./data/spectrogram_archive/station/, so a day is transformed once, by the archive, and
+# only the minutes it does not have yet. Each station, center frequency and day has one .npz file holding the
+# 5 minute, 30 minute and 3 hour levels reduced from the archive by mean and by max power.
+# plot_ax picks the coarsest level that still gives at least one column per pixel of the axes, so that a month
+# overview draws about as many columns as a one hour plot.
+#
+# Build the pyramid for a station and day, or a range of days, with e.g.
+#     python3 spectrogram_pyramid.py w2naf 2024-04-08 [2024-04-09]
+# Files go into ./output/pyramid/station/cfreqMHz/YYYY-MM-DD.npz, after updating the archive for the day
+import os
+import sys
+import datetime
+
+import numpy as np
+
+import matplotlib as mpl
+
+import digital_rf as drf
+
+import channel_catalog
+import column_store
+import spectrogram_archive
+
+pyramid_dir = os.path.join('output','pyramid')
+levels      = [1,5,30,180]      # minutes per column of each level, the one minute level is the archive
+pyramid_version = 3             # increase when the contents change, so that older pyramids are rebuilt
+
+def cfreq_str(cfreq):
+    # Center frequency as used in file names, 20.0 and 20 both give '20'
+    return '{:g}'.format(float(cfreq))
+
+def day_fpath(station,cfreq,day,directory=pyramid_dir):
+    return os.path.join(directory,station,cfreq_str(cfreq)+'MHz',day.strftime('%Y-%m-%d')+'.npz')
+
+def archive_directory(station):
+    # Spectrogram archive of a GrapeDRF station, whose channel is ch0 as for every station
+    return os.path.join(spectrogram_archive.archive_dir,station)
+
+def read_archive_day(channel,station,cfreq,day):
+    # One minute spectrogram of cfreq for day from the station's archive, as spectrogram_archive.read_day
+    # The archive names files by the metadata frequency, a float, so 20 and 20.0 both find 20.0MHz
+    return spectrogram_archive.read_day(channel,float(cfreq),day,archive_directory(station))
+
+def reduce_level(zf_dB,n):
+    # Reduce the columns of zf_dB (bins x minutes) n at a time by mean and max of the power,
+    # minutes with no data (NaN) are left out. Returns (mean_dB,max_dB) as float32
+    # zf_dB is 10*log10 of the FFT magnitude, as spectrogram_engine.fft_spectrogram, so the power is
+    # 10**(zf_dB/5) and the reduced levels go back to the same scale by 5*log10
+    n_bins,n_minutes = zf_dB.shape
+    power   = 10**(zf_dB.reshape(n_bins,n_minutes//n,n).astype(np.float64)/5)
+    with np.errstate(all='ignore'):
+        mean_dB = 5*np.log10(np.nanmean(power,axis=2))
+        max_dB  = 5*np.log10(np.nanmax(power,axis=2))
+    return mean_dB.astype(np.float32),max_dB.astype(np.float32)
+
+def build_day(data_dir,channel,station,day,directory=pyramid_dir):
+    # Bring the station's spectrogram archive up to date for day, a datetime.date, every center frequency in one
+    # pass over the DRF data, then reduce each frequency's day to the coarser levels. Minutes with no data are NaN.
+    catalog     = channel_catalog.load_catalog(data_dir,channel,os.path.join(channel_catalog.catalog_dir,station))
+    do          = drf.DigitalRFReader(data_dir)
+    s_day       = channel_catalog.utc_to_sample(catalog,day.strftime('%Y-%m-%d'))
+    spectrogram_archive.update_minutes_all(do,catalog,channel,s_day,spectrogram_archive.minutes_per_day,
+                                           archive_directory(station))
+
+    t0          = datetime.datetime(day.year,day.month,day.day,tzinfo=datetime.timezone.utc).timestamp()
+    drf_mtime   = column_store.drf_day_mtime(os.path.join(data_dir,channel),day)
+    for cfreq in catalog['center_frequencies']:
+        yf,zf_dB,n_computed = read_archive_day(channel,station,cfreq,day)
+        arrays  = {}
+        arrays['yf']        = yf
+        arrays['t0']        = t0
+        arrays['drf_mtime'] = drf_mtime
+        arrays['version']   = pyramid_version
+        arrays['n_computed'] = n_computed         # minutes in the archive the levels were reduced from
+        for n in levels[1:]:
+            arrays['level_{!s}_mean'.format(n)],arrays['level_{!s}_max'.format(n)] = reduce_level(zf_dB,n)
+
+        fpath   = day_fpath(station,cfreq,day,directory)
+        if not os.path.exists(os.path.dirname(fpath)):
+            os.makedirs(os.path.dirname(fpath))
+        tmp_fpath   = fpath+'.tmp.npz'
+        np.savez(tmp_fpath,**arrays)
+        os.replace(tmp_fpath,fpath)
+    print('Spectrogram pyramid for {!s} {!s} written to {!s}'.format(station,day,os.path.join(directory,station)))
+
+def is_current(data_dir,channel,station,day,directory=pyramid_dir):
+    # True if the pyramid of every center frequency of channel for day is newer than the DRF data, of the current
+    # version and reduced from the minutes now in the archive
+    catalog     = channel_catalog.load_catalog(data_dir,channel,os.path.join(channel_catalog.catalog_dir,station))
+    drf_mtime   = column_store.drf_day_mtime(os.path.join(data_dir,channel),day)
+    for cfreq in catalog['center_frequencies']:
+        fpath   = day_fpath(station,cfreq,day,directory)
+        if not os.path.exists(fpath):
+            return False
+        with np.load(fpath) as npz:
+            if int(npz['drf_mtime']) < drf_mtime or int(npz.get('version',1)) != pyramid_version:
+                return False
+            n_computed  = int(npz['n_computed'])
+        if read_archive_day(channel,station,cfreq,day)[2] != n_computed:
+            return False
+    return True
+
+def days_in(sDate,eDate):
+    # Dates of the days overlapping sDate to eDate
+    days    = []
+    day     = sDate.date()
+    while datetime.datetime(day.year,day.month,day.day) < eDate:
+        days.append(day)
+        day = day + datetime.timedelta(days=1)
+    return days
+
+def choose_level(sDate,eDate,n_pixels):
+    # Coarsest level with at least one column per pixel, the one minute level if none has
+    minutes = (eDate-sDate).total_seconds()/60.
+    level   = levels[0]
+    for n in levels:
+        if minutes/n >= n_pixels:
+            level = n
+    return level
+
+def load_level(station,cfreq,sDate,eDate,level,stat='mean',directory=pyramid_dir,channel='ch0'):
+    # Columns of one level of the pyramid between sDate and eDate, naive UTC datetimes.
+    # stat is 'mean' or 'max', not used for the one minute level, which is read from the archive. Days not
+    # built are NaN. Returns (timevec,yf,zf_dB), timevec the datetime at the start of each column
+    key     = 'level_{!s}_{!s}'.format(level,stat)
+    n_cols  = 1440//level
+    yf      = None
+    zfs     = []
+    days    = days_in(sDate,eDate)
+    for day in days:
+        fpath   = day_fpath(station,cfreq,day,directory)
+        if level == 1:
+            yf_day,zf_day,n_computed = read_archive_day(channel,station,cfreq,day)
+            if yf_day is None:
+                print('No spectrogram archive for {!s} {!s} MHz {!s}, run spectrogram_pyramid.py to build it'.format(station,cfreq,day))
+            else:
+                yf  = yf_day
+            zfs.append(zf_day)
+        elif os.path.exists(fpath):
+            with np.load(fpath) as npz:
+                zfs.append(npz[key])
+                yf = npz['yf']
+        else:
+            print('No spectrogram pyramid {!s}, run spectrogram_pyramid.py to build it'.format(fpath))
+            zfs.append(None)
+    if yf is None:
+        return None,None,None
+    zfs     = [zf if zf is not None else np.full((len(yf),n_cols),np.nan,dtype=np.float32) for zf in zfs]
+    zf_dB   = np.hstack(zfs)
+    t_start = datetime.datetime(days[0].year,days[0].month,days[0].day)
+    timevec = np.array([t_start + datetime.timedelta(minutes=level*i) for i in range(zf_dB.shape[1])])
+    tf      = np.logical_and(timevec >= sDate - datetime.timedelta(minutes=level), timevec < eDate)
+    return timevec[tf],yf,zf_dB[:,tf]
+
+def plot_ax(ax,station,cfreq,sDate,eDate,stat='mean',cmap=None,n_pixels=None,directory=pyramid_dir):
+    # Spectrogram of cfreq from sDate to eDate from the pyramid, at the level matching the width of ax in pixels.
+    # Returns the pcolormesh, or None if there is no pyramid for the time span
+    if n_pixels is None:
+        n_pixels    = ax.get_window_extent().width
+    level   = choose_level(sDate,eDate,n_pixels)
+    timevec,yf,zf_dB = load_level(station,cfreq,sDate,eDate,level,stat,directory)
+    if zf_dB is None:
+        msg = 'ERROR: No spectrogram pyramid for {!s} MHz'.format(cfreq)
+        ax.text(0.5,0.5,msg,ha='center',va='center',transform=ax.transAxes)
+        print(msg)
+        return None
+    if cmap is None:
+        cmap = mpl.colors.LinearSegmentedColormap.from_list(" ", ["black","darkgreen","green","yellow","red"])
+    # Columns are placed at their centres
+    timevec = timevec + datetime.timedelta(minutes=level/2.)
+    mpbl    = ax.pcolormesh(timevec,yf,zf_dB,cmap=cmap,shading='nearest')
+    ax.set_xlim(sDate,eDate)
+    return mpbl
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3 or len(sys.argv) > 4:
+        print('Rerun with station and start date YYYY-MM-DD, and optionally end date, as command line arguments')
+        sys.exit()
+    station     = sys.argv[1]
+    sDate       = datetime.datetime.strptime(sys.argv[2],'%Y-%m-%d')
+    if len(sys.argv) == 4:
+        eDate   = datetime.datetime.strptime(sys.argv[3],'%Y-%m-%d')
+    else:
+        eDate   = sDate + datetime.timedelta(days=1)
+    data_dir    = os.path.join('data','psws_grapeDRF',station)
+    for day in days_in(sDate,eDate):
+        if is_current(data_dir,'ch0',station,day):
+            print('Spectrogram pyramid for {!s} {!s} is up to date'.format(station,day))
+        else:
+            build_day(data_dir,'ch0',station,day)
@@ -0,0 +1,74 @@
+# Module to draw a spectrogram on a matplotlib axes in one of three render modes, set by render in the [plots]
+# section of the config/callsign_config.ini file:
+#   contour  filled contours with ax.contourf, as before, for publication figures, saved at 600 dpi
+#   raster   the same contour levels and colours drawn as one rasterized image, no contour tessellation, 600 dpi
+#   preview  as raster but saved at 100 dpi to a _preview file, for dashboards and bulk runs over many stations and days
+# The raster modes use a discrete colormap with one colour per pair of contour levels, so they look as contourf
+# with the contours following pixel edges rather than interpolated between them.
+# doppler_figure draws the whole Doppler spectrogram figure, title, labels, limits and colorbar, as saved by
+# grape_fft_spectrogram.py and grape_fft_spectrogram_all.py, so the scripts draw it the same way.
+
+import numpy as np
+import os
+import matplotlib as mpl
+import matplotlib.pyplot as plt
+
+render_modes=['contour','raster','preview']
+render_dpi={'contour':600,'raster':600,'preview':100}
+
+def contour_colormap(levels,cmap=None):
+    # Discrete colormap and norm giving each value the colour contourf gives the band of levels it is in
+    # contourf colours a band by its mid value scaled between the first and last level. Values outside the
+    # levels, and NaN, are not filled by contourf so are transparent here too
+    cmap=mpl.colormaps.get_cmap(cmap)
+    levels=np.asarray(levels,dtype=float)
+    layers=0.5*(levels[:-1]+levels[1:])
+    colors=cmap(mpl.colors.Normalize(levels[0],levels[-1])(layers))
+    band_cmap=mpl.colors.ListedColormap(colors)
+    band_cmap.set_under('none')
+    band_cmap.set_over('none')
+    band_cmap.set_bad('none')
+    return band_cmap,mpl.colors.BoundaryNorm(levels,len(layers))
+
+def pixel_edges(centres):
+    # Extent of pixels centred on evenly spaced centres, half a step beyond the first and last
+    if len(centres) < 2:
+        return centres[0]-0.5,centres[0]+0.5
+    step=(centres[-1]-centres[0])/(len(centres)-1)
+    return centres[0]-step/2,centres[-1]+step/2
+
+def plot_spectrogram(ax,x,yf,zf_dB,levels,cmap=None,render='contour'):
+    # Draw zf_dB (len(yf) x len(x)) on ax in render mode, x and yf evenly spaced as from np.linspace and np.fft
+    # Returns the mappable for fig.colorbar
+    if render not in render_modes:
+        raise ValueError('render must be one of {!s}, not {!s}'.format(render_modes,render))
+    if render == 'contour':
+        return ax.contourf(x,yf,zf_dB,levels,cmap=cmap)
+    (band_cmap,norm)=contour_colormap(levels,cmap)
+    (x0,x1)=pixel_edges(x)
+    (y0,y1)=pixel_edges(yf)
+    return ax.imshow(np.ma.masked_invalid(zf_dB),cmap=band_cmap,norm=norm,origin='lower',aspect='auto',
+                     interpolation='nearest',extent=(x0,x1,y0,y1),rasterized=True)
+
+def doppler_figure(x,yf,zf_dB,levels,title,xlabel,xlim,ylim,cmap=None,render='contour'):
+    # New figure of the spectrogram zf_dB, as plot_spectrogram, with title, axis labels, time and Doppler limits
+    # and a colorbar. The figure is left current so that the caller can draw over it. Returns (fig,ax)
+    (fig,ax)=plt.subplots()
+    cs=plot_spectrogram(ax,x,yf,zf_dB,levels,cmap,render)
+    fig.suptitle(title)
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel("Doppler shift (Hz)")
+    fig.set_size_inches(12, 4.5, forward=True)
+    ax.set_xlim(xlim)
+    ax.set_ylim(ylim)
+    cbar=fig.colorbar(cs)
+    cbar.set_label("PSD uncalibrated (dB)", rotation=270, labelpad=25)
+    fig.tight_layout()
+    return fig,ax
+
+def save_fpath(fpath,render):
+    # Plot file name for render mode, previews have _preview added so they do not replace the full plot
+    if render == 'preview':
+        (root,ext)=os.path.splitext(fpath)
+        return root+'_preview'+ext
+    return fpath